@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+"""直播间弹幕发送进程, 从队列中批量取出消息发送到直播服务
+同时只有一个进程发送, 其他进程等待接管; 丢失发送进程锁时退出, 由进程管理工具重启
+使用方法：
+python runlivemsg.py Production
+"""
+import os
+import sys
+
+
+if __name__ == "__main__":
+    env = sys.argv[1] if len(sys.argv) > 1 else 'Local'
+    if env not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+    os.environ['WXENV'] = env
+    reload(sys)
+    sys.setdefaultencoding('utf-8')
+
+    from wanx.platforms.xlive import LiveMsgQueue
+    LiveMsgQueue.work()
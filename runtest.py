@@ -17,6 +17,24 @@ if __name__ == "__main__":
     suite.addTest(FunTestCase("test_spam"))
     suite.addTest(FunTestCase("test_pinyin"))
     suite.addTest(FunTestCase("test_config"))
+    suite.addTest(FunTestCase("test_user_group"))
+    suite.addTest(FunTestCase("test_hot_video_rank"))
+    suite.addTest(FunTestCase("test_cursor"))
+    suite.addTest(FunTestCase("test_search_index"))
+    suite.addTest(FunTestCase("test_live_msg_queue"))
+    suite.addTest(FunTestCase("test_red_packet_schedule"))
+    suite.addTest(FunTestCase("test_gift_board"))
+    suite.addTest(FunTestCase("test_message_digest"))
+    suite.addTest(FunTestCase("test_message_delete"))
+    suite.addTest(FunTestCase("test_video_counter"))
+    suite.addTest(FunTestCase("test_activity_vids"))
+    suite.addTest(FunTestCase("test_following_timeline"))
+    suite.addTest(FunTestCase("test_spam_review"))
+    suite.addTest(FunTestCase("test_live_history"))
+    suite.addTest(FunTestCase("test_pubsub_mux"))
+    suite.addTest(FunTestCase("test_unique_stats"))
+    suite.addTest(FunTestCase("test_credit_ledger"))
+    suite.addTest(FunTestCase("test_task_progress"))
 
     suite.addTest(ApiTestCase("test_task"))
 
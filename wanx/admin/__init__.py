@@ -8,6 +8,7 @@ from wanx.admin.comment import ReplyAdmin
 from wanx.base.xmongo import DB
 from wanx.models.home import BugReport
 from .base import WxFileAdmin
+from .stats import UniqueStatsReport
 from .msg import SysMsgAdmin, LetterAdmin, SuggestionAdmin, BugReportAdmin
 from .user import UserAdmin, UserTrafficLogAdmin, GroupAdmin, UserGroupAdmin
 from .xconfig import ConfigAdmin, VersionConfigAdmin, ProvinceAdmin
@@ -111,6 +112,7 @@ admin.add_view(OfflineGameAdmin(DB['games'], endpoint='offline_games', name=u'
 admin.add_view(DisableVideoAdmin(DB['videos'], endpoint='disable_videos', name=u'无效视频', category=u'统计管理'))
 admin.add_view(CommentAdmin(DB['comments'], name=u'视频评论', category=u'统计管理'))
 admin.add_view(ReplyAdmin(DB['replies'], name=u'评论回复', category=u'统计管理'))
+admin.add_view(UniqueStatsReport(name=u'去重访问统计', category=u'统计管理'))
 
 admin.add_view(ProductAdmin(Product, name=u'物品配置', category=u'经济管理'))
 admin.add_view(TaskAdmin(Task, name=u'任务配置', category=u'经济管理'))
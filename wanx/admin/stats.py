@@ -0,0 +1,45 @@
+# -*- coding: utf8 -*-
+from flask import request
+from flask.ext.admin import BaseView, expose
+
+from wanx.models.stats import UniqueStats
+
+import datetime
+
+
+class UniqueStatsReport(BaseView):
+    """去重访问统计报表
+    """
+    TARGETS = [('visit', u'活跃设备'), ('video', u'视频观看'), ('live', u'直播观看'),
+               ('activity', u'活动访问')]
+
+    @expose('/')
+    def index(self):
+        values = request.values
+        ttype = values.get('type', 'visit')
+        if ttype not in dict(self.TARGETS):
+            ttype = 'visit'
+        oid = values.get('oid', '').strip()
+        try:
+            date = datetime.datetime.strptime(values.get('date', ''), '%Y-%m-%d').date()
+        except ValueError:
+            date = datetime.date.today()
+
+        target = UniqueStats.VISIT
+        if ttype != 'visit':
+            target = getattr(UniqueStats, ttype.upper()) % (oid) if oid else None
+
+        daily = week = month = None
+        if target:
+            begin = date.replace(day=1)
+            daily = UniqueStats.daily(target, begin, date)
+            week = UniqueStats.week(target, date)
+            month = UniqueStats.month(target, date)
+        return self.render('unique_stats.html',
+                           targets=self.TARGETS,
+                           ttype=ttype,
+                           oid=oid,
+                           date=date.strftime('%Y-%m-%d'),
+                           daily=daily,
+                           week=week,
+                           month=month)
@@ -60,6 +60,94 @@ POPULAR_VIDEO = {
     "time_range": 7 * 24 * 60 * 60,
     "max_video_num": 30
 }
+# 人气视频实时排行: 热度按半衰期(秒)衰减, 各行为的热度权重, 每个排行保留的视频数量,
+# 衰减后热度低于min_score的视频在整理时删除
+HOT_VIDEO = {
+    "half_life": 2 * 24 * 60 * 60,
+    "weights": {"play": 1, "like": 5, "comment": 10, "gift": 20},
+    "max_len": 500,
+    "min_score": 0.5,
+    "expire": 7 * 24 * 60 * 60,
+}
+
+# 搜索: 结果缓存时间, 关键字最大长度, 热词统计数量, 预取热词数量
+SEARCH = {
+    "cache_expire": 60,
+    "max_keyword_len": 30,
+    "hot_num": 1000,
+    "prefetch_num": 100,
+}
+
+# 直播间列表快照: 刷新间隔(秒), 超过max_stale秒未刷新成功时同步刷新
+LIVE_SNAPSHOT = {
+    "ttl": 5,
+    "max_stale": 30,
+}
+
+# 主播直播时长汇总: 每次重新扫描检查点之前的天数(结束时间延迟写入的直播), 已汇总直播id的保留时间(秒)
+LIVE_HISTORY = {
+    "rescan_days": 3,
+    "done_expire": 30 * 24 * 60 * 60,
+}
+
+# 送礼排行: 日榜和周榜的保留时间(秒)
+GIFT_BOARD = {
+    "day_ttl": 8 * 24 * 60 * 60,
+    "week_ttl": 5 * 7 * 24 * 60 * 60,
+    "anchor_all_ttl": 30 * 24 * 60 * 60,
+}
+
+# 直播红包弹幕调度: 执行间隔(秒), 随机延迟(秒), 红包索引最长重建间隔(秒)
+RED_PACKET_SCHEDULE = {
+    "interval": 5,
+    "jitter": 0.5,
+    "reload": 30,
+}
+
+# 评论&点赞消息合并: 合并时间窗口(秒), 写回数据库的间隔(秒)
+MSG_DIGEST = {
+    "window": 600,
+    "flush_interval": 10,
+}
+
+# 播放量&点赞数延迟写回: 写回数据库的间隔(秒), 每次每个模型最多写回的对象数
+COUNTER = {
+    "flush_interval": 5,
+    "batch": 1000,
+}
+
+# 任务进度写回: 写回数据库的间隔(秒), 每次最多写回的用户数
+TASK_PROGRESS = {
+    "flush_interval": 10,
+    "batch": 500,
+}
+
+# 去重访问统计: 每天的统计和合并结果的保留时间(秒)
+UNIQUE_STATS = {
+    "ttl": 92 * 24 * 60 * 60,
+}
+
+# 长连接消息通知: 每个进程的最大等待连接数, 单个用户的最大等待连接数, 每个连接缓存的消息数
+ASYNC_MSG = {
+    "max_waiters": 50000,
+    "max_channel_waiters": 10,
+    "queue_size": 10,
+}
+
+# 直播间弹幕发送队列: 每批取出的消息数, 并发发送的直播间数, 最大重试次数,
+# 重试间隔(秒, 按次数指数增长), 死信队列最大长度, 发送进程锁的过期时间(秒)
+LIVE_MSG = {
+    "batch": 100,
+    "workers": 8,
+    "max_retries": 5,
+    "backoff": 2,
+    "dead_len": 10000,
+    "leader_ttl": 30,
+}
+
+# 关注视频时间线: 每个用户最多保留的视频数量, 粉丝数超过阈值的用户不推送(读取时合并)
+TIMELINE_MAX_LEN = 500
+TIMELINE_FANOUT_LIMIT = 2000
 
 # 推荐关注用户数量
 RECOMMEND_ATTENTION = 15
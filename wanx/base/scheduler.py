@@ -0,0 +1,115 @@
+# -*- coding: utf8 -*-
+"""
+定时任务调度
+"""
+from wanx.base.log import print_log
+from wanx.base.xredis import Redis
+
+import os
+import random
+import socket
+import threading
+import time
+
+
+class PeriodicTask(object):
+    """按固定节拍执行的定时任务
+    - 同一进程内任务串行执行, 上一次未结束时不会启动下一次, 错过的节拍合并到下一次执行
+    - 每次执行前随机延迟0~jitter秒, 避免多个任务同时启动
+    - 集群内通过Redis锁选出一个进程执行, 其他进程作为备份, 锁过期后接管;
+      执行期间后台线程持续续期, 执行时间超过锁过期时间也不会被其他进程接管
+    任务函数参数为(since, until), 表示本次需要处理的时间窗口, 返回本次处理的数量
+    """
+    LEADER_KEY = 'scheduler:leader:%(name)s'  # 当前执行任务的进程
+    STATS_KEY = 'scheduler:stats:%(name)s'  # 任务执行统计(hash)
+
+    # 锁仍属于当前进程时续期
+    RENEW_SCRIPT = Redis.register_script("""
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('EXPIRE', KEYS[1], ARGV[2])
+        end
+        return 0
+    """)
+
+    def __init__(self, name, func, interval, jitter=0):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.instance = '%s:%s' % (socket.gethostname(), os.getpid())
+        self.ttl = int(interval * 3) + 1
+
+    @property
+    def leader_key(self):
+        return self.LEADER_KEY % ({'name': self.name})
+
+    def renew(self):
+        return bool(self.RENEW_SCRIPT(keys=[self.leader_key], args=[self.instance, self.ttl]))
+
+    def is_leader(self):
+        if Redis.set(self.leader_key, self.instance, nx=True, ex=self.ttl):
+            return True
+        return self.renew()
+
+    def keepalive(self, stop):
+        """执行期间定时续期, stop被设置时结束
+        """
+        while not stop.wait(max(self.ttl / 3.0, 1)):
+            try:
+                if not self.renew():
+                    print_log('scheduler', '[%s] leader lock lost' % (self.name))
+                    return
+            except Exception, e:
+                print_log('scheduler', '[%s] %s' % (self.name, str(e)))
+
+    def execute(self, since, until):
+        stop = threading.Event()
+        t = threading.Thread(target=self.keepalive, args=(stop,))
+        t.daemon = True
+        t.start()
+        try:
+            return self.func(since, until) or 0
+        finally:
+            stop.set()
+
+    def record(self, lag, cost, work, skipped):
+        key = self.STATS_KEY % ({'name': self.name})
+        pipe = Redis.pipeline(transaction=False)
+        pipe.hmset(key, {'instance': self.instance, 'last_run': time.time(),
+                         'lag': round(lag, 3), 'cost': round(cost, 3), 'work': work})
+        pipe.hincrby(key, 'runs', 1)
+        pipe.hincrby(key, 'total_work', work)
+        if skipped:
+            pipe.hincrby(key, 'skipped', skipped)
+        pipe.execute()
+
+    def stats(self):
+        return Redis.hgetall(self.STATS_KEY % ({'name': self.name}))
+
+    def run_forever(self):
+        since = tick = time.time()
+        while True:
+            delay = tick + random.uniform(0, self.jitter) - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            # 下一个节拍, 执行超时则跳过错过的节拍, 时间窗口覆盖跳过的部分
+            now = time.time()
+            skipped = 0
+            next_tick = tick + self.interval
+            while next_tick <= now:
+                next_tick += self.interval
+                skipped += 1
+
+            try:
+                if self.is_leader():
+                    until = time.time()
+                    work = self.execute(since, until)
+                    self.record(until - tick, time.time() - until, work, skipped)
+                    since = until
+                else:
+                    # 非leader不处理, 接管后从接管时开始计算
+                    since = time.time()
+            except Exception, e:
+                print_log('scheduler', '[%s] %s' % (self.name, str(e)))
+            tick = next_tick
@@ -3,50 +3,116 @@ from wanx import app
 
 import esm
 import os
+import threading
+import time
 
 
 class Spam(object):
-    INDEX_MAP = dict()
+    """敏感词过滤
+    每种类型的关键词文件只构建一次自动机, 所有线程共享;
+    关键词文件修改后(按RELOAD_INTERVAL检查修改时间)自动重新加载
+    """
+    INDEX_MAP = dict()  # {ktype: (index, fname, mtime, checked_at)}
+    RELOAD_INTERVAL = 30  # 检查关键词文件是否修改的间隔(秒)
 
-    @classmethod
-    def create_index(cls, ktype='default'):
-        if ktype in cls.INDEX_MAP:
-            return cls.INDEX_MAP[ktype]
-
-        index = esm.Index()
+    _lock = threading.Lock()
 
+    @classmethod
+    def keyword_file(cls, ktype='default'):
         kw_path = app.config.get('BASE_DIR') or os.path.abspath(os.path.join(app.root_path, '../'))
         fname = os.path.join(kw_path, 'files/%s_keywords.txt' % (ktype))
         if not os.path.isfile(fname):
             fname = os.path.join(kw_path, 'files/default_keywords.txt')
             if not os.path.isfile(fname):
-                return False
+                return None
+        return fname
 
+    @classmethod
+    def _build_index(cls, fname):
+        index = esm.Index()
         with open(fname, 'r') as f:
             for line in f:
                 line = line.strip()
                 if line:
                     index.enter(line)
-
         index.fix()
-        cls.INDEX_MAP['ktype'] = index
         return index
 
     @classmethod
-    def filter_words(cls, content, ktype='default'):
+    def create_index(cls, ktype='default'):
+        now = time.time()
+        item = cls.INDEX_MAP.get(ktype)
+        if item and now - item[3] < cls.RELOAD_INTERVAL:
+            return item[0]
+
+        with cls._lock:
+            item = cls.INDEX_MAP.get(ktype)
+            if item and now - item[3] < cls.RELOAD_INTERVAL:
+                return item[0]
+
+            fname = cls.keyword_file(ktype)
+            if not fname:
+                return None
+            mtime = os.path.getmtime(fname)
+            if item and item[1] == fname and item[2] == mtime:
+                index = item[0]
+            else:
+                index = cls._build_index(fname)
+            cls.INDEX_MAP[ktype] = (index, fname, mtime, now)
+        return index
+
+    @classmethod
+    def reload(cls, ktype=None):
+        """立即重新加载关键词文件, 不传ktype则重新加载全部类型
+        """
+        with cls._lock:
+            if ktype is None:
+                cls.INDEX_MAP.clear()
+            else:
+                cls.INDEX_MAP.pop(ktype, None)
+
+    @staticmethod
+    def _encode(content):
+        if isinstance(content, unicode):
+            return content.encode('utf8')
+        return content
+
+    @classmethod
+    def query(cls, content, ktype='default'):
+        """返回命中的敏感词[((start, end), word), ...], 位置为utf8编码后的字节偏移
+        """
         if not content:
-            return False
+            return []
         index = cls.create_index(ktype)
-        content = content.encode('utf8')
-        return index.query(content) != []
+        if not index:
+            return []
+        return index.query(cls._encode(content))
+
+    @classmethod
+    def filter_words(cls, content, ktype='default'):
+        return cls.query(content, ktype) != []
 
     @classmethod
     def replace_words(cls, content, ktype='default', replace_str='*'):
+        """替换敏感词, 与原实现一致始终返回utf8编码的str
+        """
+        content = cls._encode(content)
         if not content:
             return content
-        index = cls.create_index(ktype)
-        content = content.encode('utf8')
-        ret = index.query(content)
-        for r in ret:
-            content = content.replace(r[1], replace_str * len(r[1].decode('utf8')))
-        return content
+        replace_str = cls._encode(replace_str)
+        hits = cls.query(content, ktype)
+        if not hits:
+            return content
+
+        # 合并重叠的命中区间, 一次遍历完成替换
+        ret = list()
+        pos = 0
+        for (start, end), _ in sorted(hits):
+            if end <= pos:
+                continue
+            start = max(start, pos)
+            ret.append(content[pos:start])
+            ret.append(replace_str * len(content[start:end].decode('utf8', 'ignore')))
+            pos = end
+        ret.append(content[pos:])
+        return ''.join(ret)
@@ -159,10 +159,10 @@ def validate_login(func, data):
 
     from wanx.models.user import Group, UserGroup
     gid = Group.allowed_login_group()
-    whitelist = UserGroup.group_user_ids(gid) if gid else []
     # 因为装饰器已经重新构造了函数，所以需要通过函数名（或函数代码，比较麻烦）来判断
     login_func_names = ('login', 'partner_login', 'platform_login', 'register_phone', 'refresh_token')
-    if func.__name__ in login_func_names and data['user']['user_id'] not in whitelist:
+    if func.__name__ in login_func_names and \
+            not (gid and UserGroup.user_in_group(str(gid), data['user']['user_id'])):
         return error.LoginRefuse
     return data
 
@@ -0,0 +1,122 @@
+# -*- coding: utf8 -*-
+"""列表接口统一分页游标
+游标由上一页最后一条记录的(排序值, 唯一id)编码而成, 按排序值倒序、id倒序定位下一页,
+翻页成本与页数无关, 数据被过滤或新增时也不会出现重复和缺页
+"""
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from redis import exceptions
+from wanx.base.xredis import Redis
+
+import base64
+
+
+def encode(score, oid):
+    """生成游标
+    """
+    if score is None or oid is None:
+        return None
+    raw = '%r:%s' % (float(score), oid)
+    return base64.urlsafe_b64encode(raw).rstrip('=')
+
+
+def decode(token):
+    """解析游标, 首页或无效游标返回(None, None)
+    """
+    if not token:
+        return None, None
+    try:
+        token = str(token)
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        score, oid = raw.split(':', 1)
+        return float(score), oid
+    except (TypeError, ValueError, UnicodeError):
+        return None, None
+
+
+def _before(score, key, cursor_score, cursor_key):
+    return score < cursor_score or (score == cursor_score and key < cursor_key)
+
+
+def sort_items(items, key=None):
+    """按(排序值, id)倒序排列[(member, score), ...]
+    """
+    key = key or (lambda m: m)
+    return sorted(items, key=lambda x: (x[1], key(x[0])), reverse=True)
+
+
+def zset_page(redis_key, pagesize, cursor=None, load=None, key=None):
+    """按分数倒序读取有序集合中游标之后的pagesize个成员
+    load: 缓存不存在时的加载函数
+    key: 成员转换为游标id的函数, 默认为成员本身
+    返回: [(member, score), ...]
+    """
+    if load and not Redis.exists(redis_key):
+        load()
+    score, oid = decode(cursor)
+    try:
+        if score is None:
+            num = pagesize
+            items = Redis.zrevrange(redis_key, 0, num - 1, withscores=True)
+        else:
+            # 与游标分数相同的成员可能已经返回过, 需要多取出来再过滤
+            num = pagesize + Redis.zcount(redis_key, repr(score), repr(score))
+            items = Redis.zrevrangebyscore(redis_key, repr(score), '-inf', start=0,
+                                           num=num, withscores=True)
+        if key and len(items) >= num:
+            # Redis按成员排列同分成员, 与游标id的顺序不同, 取出最后一个分数的全部成员再按游标id排序
+            last = items[-1][1]
+            items = [(m, s) for m, s in items if s != last] + \
+                Redis.zrangebyscore(redis_key, repr(last), repr(last), withscores=True)
+    except exceptions.ResponseError:
+        # 列表为空时key对应的value是一个string
+        items = []
+    key = key or (lambda m: m)
+    if score is not None:
+        items = [(m, s) for m, s in items if _before(s, key(m), score, oid)]
+    return sort_items(items, key)[:pagesize]
+
+
+# mongo倒序排列时排序字段为空(null或不存在)的记录排在最后, 游标中记为负无穷
+NULL_SCORE = float('-inf')
+
+
+def mongo_score(value):
+    """mongo记录的排序值转换为游标分数
+    """
+    return NULL_SCORE if value is None else value
+
+
+def mongo_cond(field, cursor):
+    """mongo按(field, _id)倒序分页的查询条件, 游标分数由mongo_score生成
+    """
+    score, oid = decode(cursor)
+    if score is None:
+        return {}
+    try:
+        oid = ObjectId(oid)
+    except (InvalidId, TypeError):
+        return {}
+    if score == NULL_SCORE:
+        return {field: None, '_id': {'$lt': oid}}
+    return {'$or': [{field: {'$lt': score}}, {field: score, '_id': {'$lt': oid}},
+                    {field: None}]}
+
+
+def paginate(fetch, load, pagesize, cursor=None, key=None):
+    """按游标读取一页数据, 被过滤掉的记录继续向后读取补齐
+    fetch(cursor, num): 返回游标之后的num条记录[(id, score), ...]
+    load(ids): 返回ids对应的有效数据列表
+    返回: (数据列表, 下一页游标, 是否最后一页)
+    """
+    key = key or (lambda m: m)
+    objs = list()
+    end_page = False
+    while len(objs) < pagesize and not end_page:
+        num = pagesize - len(objs)
+        items = fetch(cursor, num)
+        if items:
+            objs.extend(load([_id for _id, _ in items]))
+            cursor = encode(items[-1][1], key(items[-1][0]))
+        end_page = len(items) < num
+    return objs, cursor, end_page
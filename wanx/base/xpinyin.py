@@ -2,8 +2,10 @@
 from __future__ import unicode_literals
 from wanx import app
 
+import array
 import os.path
 import re
+import threading
 
 PinyinToneMark = {
     0: u"aoeiuv\u00fc",
@@ -16,16 +18,62 @@ PinyinToneMark = {
 
 class Pinyin(object):
     """translate chinese hanzi to pinyin by python
+    拼音表在进程内共享, 首次使用时加载为按码位索引的数组
     """
 
     kw_path = app.config.get('BASE_DIR') or os.path.abspath(os.path.join(app.root_path, '../'))
     data_path = os.path.join(kw_path, 'files/Mandarin.dat')
 
+    _tables = {}
+    _lock = threading.Lock()
+    _shared = None
+
     def __init__(self, data_path=data_path):
-        self.dict = {}
+        self.data_path = data_path
+
+    @classmethod
+    def shared(cls):
+        """进程内共享的实例
+        """
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    @staticmethod
+    def _parse(data_path):
+        """解析拼音文件: (起始码位, 码位到读音序号的数组, 读音列表)
+        只保留每个字的第一个读音
+        """
+        readings = {}
         for line in open(data_path):
             k, v = line.split('\t')
-            self.dict[k] = v
+            readings[int(k, 16)] = v.split()[0].strip()
+        base = min(readings)
+        syllables = sorted(set(readings.itervalues()))
+        index = dict((syl, i + 1) for i, syl in enumerate(syllables))
+        codes = array.array(b'H', [0]) * (max(readings) - base + 1)
+        for cp, syl in readings.iteritems():
+            codes[cp - base] = index[syl]
+        return base, codes, [None] + syllables
+
+    @property
+    def table(self):
+        table = self._tables.get(self.data_path)
+        if table is None:
+            with self._lock:
+                table = self._tables.get(self.data_path)
+                if table is None:
+                    table = self._tables[self.data_path] = self._parse(self.data_path)
+        return table
+
+    def reading(self, char):
+        """汉字的第一个读音(如QIU1), 非汉字返回None
+        """
+        base, codes, syllables = self.table
+        i = ord(char) - base
+        if 0 <= i < len(codes):
+            return syllables[codes[i]]
+        return None
 
     def decode_pinyin(self, s):
         s = s.lower()
@@ -72,14 +120,12 @@ class Pinyin(object):
         result = []
         flag = 1
         for char in chars:
-            key = "%X" % ord(char)
-            try:
-                result.append(self.decode_pinyin(
-                    self.dict[key].split()[0].strip().lower())
-                    if show_tone_marks
-                    else self.dict[key].split()[0].strip()[:-1].lower())
+            syl = self.reading(char)
+            if syl:
+                result.append(self.decode_pinyin(syl.lower())
+                              if show_tone_marks else syl[:-1].lower())
                 flag = 1
-            except KeyError:
+            else:
                 if flag:
                     result.append(char)
                 else:
@@ -89,19 +135,18 @@ class Pinyin(object):
         return splitter.join(result)
 
     def get_initial(self, char=u'你'):
-        try:
-            return self.dict["%X" % ord(char)].split(" ")[0][0]
-        except KeyError:
-            return char
+        syl = self.reading(char)
+        return syl[0] if syl else char
 
     def get_initials(self, chars=u'你好', splitter=u'-'):
         result = []
         flag = 1
         for char in chars:
-            try:
-                result.append(self.dict["%X" % ord(char)].split(" ")[0][0])
+            syl = self.reading(char)
+            if syl:
+                result.append(syl[0])
                 flag = 1
-            except KeyError:
+            else:
                 if flag:
                     result.append(char)
                 else:
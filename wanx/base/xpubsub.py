@@ -0,0 +1,104 @@
+# -*- coding: utf8 -*-
+"""
+进程内共享的redis订阅连接
+"""
+from gevent.lock import Semaphore
+from gevent.queue import Queue, Full, Empty
+from wanx.base import const
+from wanx.base.log import print_log
+from wanx.base.xredis import MRedis
+
+import gevent
+import os
+import socket
+
+
+class PubSubMux(object):
+    """订阅复用: 每个进程只使用一个订阅连接, 收到的消息通过内存队列分发给等待的greenlet
+    - 频道的第一个等待者订阅频道, 最后一个等待者离开时取消订阅
+    - 进程内等待者总数和单个频道的等待者数量有上限, 超出时wait直接返回None(由调用者降级处理)
+    - 每个等待者的队列有长度限制, 队列满时丢弃新消息
+    """
+
+    def __init__(self, client, max_waiters=None, max_channel_waiters=None, queue_size=None):
+        self.client = client
+        self.max_waiters = max_waiters or const.ASYNC_MSG['max_waiters']
+        self.max_channel_waiters = max_channel_waiters or const.ASYNC_MSG['max_channel_waiters']
+        self.queue_size = queue_size or const.ASYNC_MSG['queue_size']
+        # 每个进程一个控制频道, 保证订阅连接在没有等待者时也处于订阅状态
+        self.control_channel = 'async:mux:%s:%s' % (socket.gethostname(), os.getpid())
+        self.waiters = dict()  # {channel: set(queue)}
+        self.count = 0
+        self.stats = {'delivered': 0, 'dropped': 0, 'rejected': 0}
+        self.pubsub = None
+        self.listener = None
+        self._lock = Semaphore()
+
+    def _execute(self, method, *channels):
+        # 订阅连接同一时间只允许一个greenlet写入
+        with self._lock:
+            getattr(self.pubsub, method)(*channels)
+
+    def _listen(self):
+        while True:
+            try:
+                for item in self.pubsub.listen():
+                    if item['type'] == 'message':
+                        self.dispatch(item['channel'], item['data'])
+            except Exception, e:
+                print_log('pubsub', '[listen]: %s' % (str(e)))
+                gevent.sleep(1)
+
+    def start(self):
+        if self.listener is not None and not self.listener.dead:
+            return
+        if self.pubsub is None:
+            self.pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self._execute('subscribe', self.control_channel)
+        self.listener = gevent.spawn(self._listen)
+
+    def dispatch(self, channel, data):
+        for queue in list(self.waiters.get(channel, ())):
+            try:
+                queue.put_nowait(data)
+                self.stats['delivered'] += 1
+            except Full:
+                self.stats['dropped'] += 1
+
+    def wait(self, channel, timeout):
+        """等待频道的下一条消息, 超时或超过等待者上限时返回None
+        """
+        queues = self.waiters.get(channel)
+        if self.count >= self.max_waiters or \
+                (queues and len(queues) >= self.max_channel_waiters):
+            self.stats['rejected'] += 1
+            return None
+
+        self.start()
+        queue = Queue(maxsize=self.queue_size)
+        if not queues:
+            queues = self.waiters[channel] = set()
+        queues.add(queue)
+        self.count += 1
+        try:
+            if len(queues) == 1:
+                self._execute('subscribe', channel)
+            return queue.get(timeout=timeout)
+        except Empty:
+            return None
+        except Exception, e:
+            print_log('pubsub', '[subscribe]: %s' % (str(e)))
+            return None
+        finally:
+            queues.discard(queue)
+            self.count -= 1
+            if not queues and self.waiters.get(channel) is queues:
+                del self.waiters[channel]
+                try:
+                    self._execute('unsubscribe', channel)
+                except Exception, e:
+                    print_log('pubsub', '[unsubscribe]: %s' % (str(e)))
+
+
+# 用户消息通知
+MsgMux = PubSubMux(MRedis)
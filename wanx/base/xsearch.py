@@ -0,0 +1,259 @@
+# -*- coding: utf8 -*-
+"""基于redis的倒排索引搜索
+中文按单字和二元组切分, 英文数字按前缀切分, 可选索引中文的全拼和首字母前缀;
+模型增删改时增量更新索引, 通过scripts/rebuild_search_index.py从mongo重建后才用于搜索
+"""
+from wanx.base.xpinyin import Pinyin
+from wanx.base.xredis import Redis
+
+import hashlib
+import json
+import re
+
+
+TOKEN_RE = re.compile(u'[\u4e00-\u9fff]+|[0-9a-z]+')
+MAX_PREFIX = 20  # 前缀的最大长度
+
+
+def _text(value):
+    if not value:
+        return u''
+    if not isinstance(value, unicode):
+        value = str(value).decode('utf8', 'ignore')
+    return value.lower()
+
+
+def _is_ascii(run):
+    return ord(run[0]) < 128
+
+
+def _prefixes(word):
+    return [word[:i] for i in xrange(1, min(len(word), MAX_PREFIX) + 1)]
+
+
+def index_terms(text, pinyin=False):
+    """文本需要写入索引的词项
+    """
+    terms = set()
+    for run in TOKEN_RE.findall(_text(text)):
+        if _is_ascii(run):
+            terms.update(_prefixes(run))
+            continue
+        terms.update(run)
+        terms.update(run[i:i + 2] for i in xrange(len(run) - 1))
+        if pinyin:
+            py = Pinyin.shared()
+            # 从每个字开始的全拼和首字母前缀, 支持"wzry"、"rongyao"这类搜索
+            for i in xrange(len(run)):
+                sub = run[i:i + MAX_PREFIX]
+                terms.update(_prefixes(py.get_pinyin(sub, u'')))
+                terms.update(_prefixes(py.get_initials(sub, u'').lower()))
+    return terms
+
+
+def query_terms(keyword):
+    """搜索关键字对应的词项, 文档需要包含全部词项
+    """
+    terms = set()
+    for run in TOKEN_RE.findall(_text(keyword)):
+        if _is_ascii(run):
+            terms.add(run[:MAX_PREFIX])
+        elif len(run) == 1:
+            terms.add(run)
+        else:
+            terms.update(run[i:i + 2] for i in xrange(len(run) - 1))
+    return terms
+
+
+class SearchIndex(object):
+    """倒排索引
+    """
+    TERM_KEY = 'search:%(name)s:term:%(term)s'  # 包含词项的文档id集合
+    DOC_KEY = 'search:%(name)s:doc:%(oid)s'  # 文档的词项集合, 用于更新和删除
+    RANK_KEY = 'search:%(name)s:rank'  # 文档的排序值
+    VERSION_KEY = 'search:%(name)s:version'  # 索引版本号, 文档变化或索引重建时递增, 用于失效搜索结果缓存
+    READY_KEY = 'search:%(name)s:ready'  # 索引已通过重建建立的标记
+    TOUCH_KEY = 'search:%(name)s:touch'  # 文档变化时递增版本号的去抖标记
+    REBUILDING_KEY = 'search:%(name)s:rebuilding'  # 索引重建中的标记
+    PENDING_KEY = 'search:%(name)s:pending'  # 重建期间变化的文档(hash), 重建完成后重新写入
+    RESULT_KEY = 'search:%(name)s:result:%(digest)s'  # 搜索结果临时缓存
+    RESULT_EXPIRE = 10
+    TOUCH_INTERVAL = 1  # 文档变化时递增版本号的最小间隔(秒)
+    REBUILD_EXPIRE = 24 * 60 * 60  # 重建标记的过期时间, 重建进程异常退出时自动清除
+    REBUILD_NAME = 'rebuild:%s'  # 重建时临时索引的名称
+
+    def __init__(self, name, pinyin=False):
+        self.name = name
+        self.pinyin = pinyin
+
+    def _term_key(self, term):
+        return self.TERM_KEY % ({'name': self.name, 'term': term})
+
+    def _doc_key(self, oid):
+        return self.DOC_KEY % ({'name': self.name, 'oid': oid})
+
+    @property
+    def rank_key(self):
+        return self.RANK_KEY % ({'name': self.name})
+
+    @property
+    def version_key(self):
+        return self.VERSION_KEY % ({'name': self.name})
+
+    @property
+    def ready_key(self):
+        return self.READY_KEY % ({'name': self.name})
+
+    @property
+    def touch_key(self):
+        return self.TOUCH_KEY % ({'name': self.name})
+
+    @property
+    def rebuilding_key(self):
+        return self.REBUILDING_KEY % ({'name': self.name})
+
+    @property
+    def pending_key(self):
+        return self.PENDING_KEY % ({'name': self.name})
+
+    def touch(self):
+        """文档的过滤条件(如状态)变化时递增版本号
+        """
+        Redis.incr(self.version_key)
+
+    def ready(self):
+        """索引是否已经通过rebuild建立, 未建立时调用方使用数据库查询
+        """
+        return bool(Redis.exists(self.ready_key))
+
+    def _index(self, oid, text, rank):
+        """写入文档的索引, 返回词项是否变化
+        """
+        doc_key = self._doc_key(oid)
+        terms = set(t.encode('utf8') for t in index_terms(text, self.pinyin))
+        old_terms = Redis.smembers(doc_key)
+        pipe = Redis.pipeline(transaction=False)
+        for term in old_terms - terms:
+            pipe.srem(self._term_key(term), oid)
+        for term in terms - old_terms:
+            pipe.sadd(self._term_key(term), oid)
+        pipe.delete(doc_key)
+        if terms:
+            pipe.sadd(doc_key, *terms)
+        pipe.zadd(self.rank_key, rank, oid)
+        pipe.execute()
+        return terms != old_terms
+
+    def _unindex(self, oid):
+        doc_key = self._doc_key(oid)
+        pipe = Redis.pipeline(transaction=False)
+        for term in Redis.smembers(doc_key):
+            pipe.srem(self._term_key(term), oid)
+        pipe.delete(doc_key)
+        pipe.zrem(self.rank_key, oid)
+        pipe.execute()
+
+    def _record(self, oid, doc):
+        """重建期间记录变化的文档, 避免被重建的索引覆盖
+        """
+        if Redis.exists(self.rebuilding_key):
+            Redis.hset(self.pending_key, oid, json.dumps(doc))
+
+    def add(self, oid, text, rank):
+        """添加或更新文档的索引, 词项变化时递增版本号(每TOUCH_INTERVAL秒最多一次)
+        """
+        oid = str(oid)
+        if self._index(oid, text, rank) and \
+                Redis.set(self.touch_key, 1, nx=True, ex=self.TOUCH_INTERVAL):
+            Redis.incr(self.version_key)
+        self._record(oid, [text, rank])
+
+    def remove(self, oid):
+        """删除文档的索引
+        """
+        oid = str(oid)
+        self._unindex(oid)
+        Redis.incr(self.version_key)
+        self._record(oid, None)
+
+    def search(self, keyword, limit=100):
+        """按排序值倒序返回包含关键字的文档id
+        """
+        terms = sorted(t.encode('utf8') for t in query_terms(keyword))
+        if not terms:
+            return []
+        version = Redis.get(self.version_key) or '0'
+        digest = hashlib.md5('|'.join(terms + [version])).hexdigest()
+        key = self.RESULT_KEY % ({'name': self.name, 'digest': digest})
+        if not Redis.exists(key):
+            # 集合的分数为1, 取最大值即为文档的排序值
+            keys = [self.rank_key] + [self._term_key(t) for t in terms]
+            pipe = Redis.pipeline(transaction=False)
+            pipe.zinterstore(key, keys, aggregate='MAX')
+            pipe.expire(key, self.RESULT_EXPIRE)
+            pipe.execute()
+        return Redis.zrevrange(key, 0, limit - 1)
+
+    def _keys(self):
+        return Redis.scan_iter(match='search:%s:*' % (self.name), count=1000)
+
+    def _apply_pending(self):
+        pipe = Redis.pipeline()
+        pipe.hgetall(self.pending_key)
+        pipe.delete(self.pending_key)
+        docs = pipe.execute()[0]
+        for oid, doc in docs.iteritems():
+            doc = json.loads(doc)
+            if doc is None:
+                self._unindex(oid)
+            else:
+                self._index(oid, *doc)
+
+    def rebuild(self, docs):
+        """重建索引: 先写入临时索引, 再逐个RENAME替换, 重建期间原索引可以正常搜索;
+        重建期间变化的文档在替换后重新写入
+        docs: [(oid, text, rank), ...]
+        """
+        tmp = SearchIndex(self.REBUILD_NAME % (self.name), self.pinyin)
+        for key in list(tmp._keys()):
+            Redis.delete(key)
+        pipe = Redis.pipeline()
+        pipe.delete(self.pending_key)
+        pipe.setex(self.rebuilding_key, self.REBUILD_EXPIRE, 1)
+        pipe.execute()
+        count = 0
+        for oid, text, rank in docs:
+            tmp._index(str(oid), text, rank)
+            count += 1
+
+        # 新索引中不存在的词项和文档以及旧的搜索结果需要删除, 版本号等标记保留
+        meta = set([self.version_key, self.ready_key, self.touch_key,
+                    self.rebuilding_key, self.pending_key])
+        stale = set(key for key in self._keys() if key not in meta)
+        prefix = 'search:%s:' % (tmp.name)
+        tmp_keys = list(tmp._keys())
+        for key in tmp_keys:
+            if key == tmp.rank_key:
+                continue
+            new_key = 'search:%s:%s' % (self.name, key[len(prefix):])
+            Redis.rename(key, new_key)
+            stale.discard(new_key)
+        stale.discard(self.rank_key)
+        for key in stale:
+            Redis.delete(key)
+        # 排序值最后替换, 索引为空时删除
+        if tmp.rank_key in tmp_keys:
+            Redis.rename(tmp.rank_key, self.rank_key)
+        else:
+            Redis.delete(self.rank_key)
+
+        # 先在标记清除前重新写入, 清除标记后再写入期间新记录的文档
+        self._apply_pending()
+        Redis.delete(self.rebuilding_key)
+        self._apply_pending()
+        if Redis.exists(self.rank_key):
+            Redis.set(self.ready_key, 1)
+        else:
+            Redis.delete(self.ready_key)
+        Redis.incr(self.version_key)
+        return count
@@ -1,9 +1,12 @@
 # -*- coding: utf8 -*-
 from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from wanx.base.xmysql import MYDB
 from wanx.base.xredis import Redis
 from wanx.base.util import cached_object
 from wanx.base import const
+from wanx.base.log import print_log
 from wanx.base.xmongo import DB
 
 import cPickle as cjson
@@ -11,6 +14,33 @@ import datetime
 import peewee as pw
 import time
 
+# 扣除已写回的增量并删除对象缓存, 增量全部写回后移出待写回集合
+COUNTER_DONE_SCRIPT = Redis.register_script("""
+    for i = 2, #ARGV, 2 do
+        local left = redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+        if left == 0 then
+            redis.call('HDEL', KEYS[1], ARGV[i])
+        end
+    end
+    redis.call('DEL', KEYS[2])
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        redis.call('SREM', KEYS[3], ARGV[1])
+    end
+    return 1
+""")
+
+
+def counters_done(delta_key, cache_key, dirty_key, member, deltas, client=None):
+    """计数增量写回数据库后调用
+    delta_key: 增量(hash), cache_key: 对象缓存, dirty_key: 待写回集合, member: 待写回集合中的成员
+    deltas: 已写回的增量{field: n}
+    """
+    args = [member]
+    for field, n in deltas.iteritems():
+        args.extend([field, n])
+    return COUNTER_DONE_SCRIPT(keys=[delta_key, cache_key, dirty_key], args=args, client=client)
+
+
 class ObjectDict(dict):
     """Makes a dictionary behave like an object, with attribute-style access.
     """
@@ -40,6 +70,10 @@ class Document(ObjectDict):
 
     ENABLE_LOCAL_CACHE = False  # 启用内存缓存
 
+    COUNTER_FIELDS = ()  # 延迟写回的计数字段
+    COUNTER_DELTA = 'counter:%(name)s:%(oid)s'  # 未写回数据库的计数增量(hash)
+    COUNTER_DIRTY = 'counter:dirty:%(name)s'  # 有未写回增量的对象id(set)
+
     @classmethod
     def init(cls):
         return cls({
@@ -54,24 +88,50 @@ class Document(ObjectDict):
         return cls(obj)
 
     @classmethod
-    def get_one(cls, oid, check_online=False):
-        obj = None
-        if not oid:
-            return obj
-
-        key = cls.OBJECT_KEY % ({'name': cls.__name__.lower(), 'oid': str(oid)})
-        # 先从本地内存中获取
-        if cls.ENABLE_LOCAL_CACHE and hasattr(cls, 'CACHED_OBJS'):
-            obj = cls.CACHED_OBJS.get(key)
+    def _get_objects(cls, ids):
+        """批量获取对象, 本地内存未命中的对象及其计数增量通过一次pipeline从缓存获取
+        本地内存中保存的是已合并计数增量的对象
+        """
+        name = cls.__name__.lower()
+        local = cls.ENABLE_LOCAL_CACHE and hasattr(cls, 'CACHED_OBJS')
+        objs = dict()
+        missing = list()
+        for oid in ids:
+            if not oid or str(oid) in objs:
+                continue
+            key = cls.OBJECT_KEY % ({'name': name, 'oid': str(oid)})
+            # 先从本地内存中获取
+            obj = cls.CACHED_OBJS.get(key) if local else None
+            objs[str(oid)] = obj
+            if not obj:
+                missing.append(str(oid))
 
         # 从缓存中获取
-        if not obj:
-            obj = Redis.get(key)
-            obj = cls(cjson.loads(obj)) if obj else cls._load_object(oid)
-            # 存入本地内存
-            if cls.ENABLE_LOCAL_CACHE and hasattr(cls, 'CACHED_OBJS') and obj:
-                cls.CACHED_OBJS[key] = obj
+        if missing:
+            pipe = Redis.pipeline(transaction=False)
+            for oid in missing:
+                pipe.get(cls.OBJECT_KEY % ({'name': name, 'oid': oid}))
+                if cls.COUNTER_FIELDS:
+                    pipe.hmget(cls.COUNTER_DELTA % ({'name': name, 'oid': oid}),
+                               *cls.COUNTER_FIELDS)
+            rets = pipe.execute()
+            step = 2 if cls.COUNTER_FIELDS else 1
+            for i, oid in enumerate(missing):
+                obj = rets[i * step]
+                obj = cls(cjson.loads(obj)) if obj else cls._load_object(oid)
+                if obj and cls.COUNTER_FIELDS:
+                    cls._merge_counters(obj, rets[i * step + 1])
+                # 存入本地内存
+                if local and obj:
+                    cls.CACHED_OBJS[cls.OBJECT_KEY % ({'name': name, 'oid': oid})] = obj
+                objs[oid] = obj
+        return [objs.get(str(oid)) if oid else None for oid in ids]
 
+    @classmethod
+    def get_one(cls, oid, check_online=False):
+        if not oid:
+            return None
+        obj = cls._get_objects([oid])[0]
         if not obj or (check_online and obj.offline):
             return None
         return obj
@@ -81,23 +141,82 @@ class Document(ObjectDict):
         if not ids:
             return []
         ret = list()
-        # 使用mget方式一次性从缓存获取
-        # keys = []
-        # for _id in ids:
-        #     key = cls.OBJECT_KEY % ({'name': cls.__name__.lower(), 'oid': str(_id)})
-        #     keys.append(key)
-
-        # objs = Redis.mget(keys)
-        # for obj in objs:
-        #     obj = cls(cjson.loads(obj)) if obj else cls.get_one(_id, check_online=check_online)
-        #     if obj and not obj.offline:
-        #         ret.append(obj)
-        for _id in ids:
-            obj = cls.get_one(_id, check_online=check_online)
-            if obj:
-                ret.append(obj)
+        for obj in cls._get_objects(ids):
+            if not obj or (check_online and obj.offline):
+                continue
+            ret.append(obj)
         return ret
 
+    @classmethod
+    def _merge_counters(cls, obj, deltas):
+        """合并未写回数据库的计数增量
+        """
+        for field, delta in zip(cls.COUNTER_FIELDS, deltas):
+            if delta:
+                obj[field] = (obj.get(field) or 0) + int(delta)
+        return obj
+
+    @classmethod
+    def incr_counter(cls, oid, field, num=1):
+        """计数增量先记录在Redis中, 由定时任务(runtimedtasks.py)批量写回数据库, 不删除对象缓存
+        """
+        name = cls.__name__.lower()
+        pipe = Redis.pipeline(transaction=False)
+        pipe.hincrby(cls.COUNTER_DELTA % ({'name': name, 'oid': str(oid)}), field, num)
+        pipe.sadd(cls.COUNTER_DIRTY % ({'name': name}), str(oid))
+        pipe.execute()
+
+    @classmethod
+    def flush_counters(cls, num=1000):
+        """把计数增量批量写回数据库, 返回写回的对象数
+        先$inc写回数据库再扣除Redis中的增量, 写回期间读取到的计数不会变少, 写回失败时增量保留到下次
+        """
+        name = cls.__name__.lower()
+        dirty = cls.COUNTER_DIRTY % ({'name': name})
+        oids = Redis.srandmember(dirty, num)
+        if not oids:
+            return 0
+        pipe = Redis.pipeline(transaction=False)
+        for oid in oids:
+            pipe.hgetall(cls.COUNTER_DELTA % ({'name': name, 'oid': oid}))
+        ops = list()
+        op_oids = list()
+        done = list()
+        for oid, deltas in zip(oids, pipe.execute()):
+            deltas = dict((f, int(n)) for f, n in deltas.iteritems())
+            inc = dict((f, n) for f, n in deltas.iteritems() if n)
+            if inc:
+                ops.append(UpdateOne({'_id': ObjectId(oid)}, {'$inc': inc}))
+                op_oids.append(oid)
+            done.append((oid, deltas))
+        if ops:
+            try:
+                cls.collection.bulk_write(ops, ordered=False)
+            except BulkWriteError, e:
+                # 部分写入失败时只扣除写入成功的增量, 失败的保留到下次
+                failed = set(op_oids[err['index']] for err in e.details.get('writeErrors', []))
+                done = [(oid, d) for oid, d in done if oid not in failed]
+                ops = [op for op, oid in zip(ops, op_oids) if oid not in failed]
+                print_log('counter', '[flush_counters] %s: %s failed' % (name, len(failed)))
+
+        pipe = Redis.pipeline(transaction=False)
+        for oid, deltas in done:
+            counters_done(cls.COUNTER_DELTA % ({'name': name, 'oid': oid}),
+                          cls.OBJECT_KEY % ({'name': name, 'oid': oid}), dirty, oid, deltas,
+                          client=pipe)
+        pipe.execute()
+        # 写回前从数据库读取的对象可能在脚本删除缓存后才写入缓存, 再删除一次
+        if done:
+            Redis.delete(*[cls.OBJECT_KEY % ({'name': name, 'oid': oid}) for oid, _ in done])
+        cls.counters_flushed([oid for oid, _ in done])
+        return len(ops)
+
+    @classmethod
+    def counters_flushed(cls, oids):
+        """计数写回数据库后的处理, 如清除排序缓存
+        """
+        pass
+
     def create_model(self):
         ret = self.collection.insert_one(self)
         return ret.inserted_id
@@ -11,7 +11,7 @@ from wanx.base.log import print_log
 from wanx.models import Document
 from wanx.base.xredis import Redis
 from wanx.base.xmongo import DB, LIVE_DB
-from wanx.base import util, const
+from wanx.base import util, const, xcursor, xsearch
 from wanx.models.user import User
 from wanx import app
 import pymongo
@@ -290,6 +290,44 @@ class ActivityVideo(Document):
     TOP_COMPETE_VIDEO_IDS = 'top:compete:%(aid)s'  # 活动参赛视频排序
     TOP_VIDEO_END = 'top:video:end:%(aid)s'  # 活动结束时参数视频根据配置排序
     TOP_MANUAL_TOP = 'top:manual:top:%(aid)s'
+    ACTIVITY_VIDS = 'activity:videos:vids'  # 参加过活动的视频id(set)
+    RECENT_VIDS = 'activity:videos:vids:recent'  # 最近参加活动的视频id(set), 加载ACTIVITY_VIDS后合并
+    RECENT_EXPIRE = 60
+
+    # 记录最近参加活动的视频, ACTIVITY_VIDS存在时直接添加, 为空数据占位时删除
+    ADD_VID_SCRIPT = Redis.register_script("""
+        redis.call('SADD', KEYS[2], ARGV[1])
+        redis.call('EXPIRE', KEYS[2], ARGV[2])
+        local t = redis.call('TYPE', KEYS[1])['ok']
+        if t == 'set' then
+            redis.call('SADD', KEYS[1], ARGV[1])
+        elseif t ~= 'none' then
+            redis.call('DEL', KEYS[1])
+        end
+        return 1
+    """)
+
+    # 合并加载期间新增的视频, 避免加载读取数据库之后新增的视频丢失
+    MERGE_VIDS_SCRIPT = Redis.register_script("""
+        local t = redis.call('TYPE', KEYS[1])['ok']
+        local recent = redis.call('SMEMBERS', KEYS[2])
+        if t == 'none' or #recent == 0 then
+            return 0
+        end
+        local ttl = redis.call('TTL', KEYS[1])
+        if t ~= 'set' then
+            redis.call('DEL', KEYS[1])
+        end
+        for _, vid in ipairs(recent) do
+            redis.call('SADD', KEYS[1], vid)
+        end
+        if ttl > 0 then
+            redis.call('EXPIRE', KEYS[1], ttl)
+        end
+        return #recent
+    """)
+
+    COUNTER_FIELDS = ('vv', 'like_count')
 
     def format(self):
         author = User.get_one(str(self.author), check_online=False)
@@ -331,17 +369,36 @@ class ActivityVideo(Document):
 
             Redis.delete(self.TOP_VIDEO_END % ({'aid': str(self.activity_id)}))
             Redis.delete(self.TOP_MANUAL_TOP % ({'aid': str(self.activity_id)}))
+
+            self.search_index(self.activity_id).add(_id, self.title, self.create_at)
+            self._add_vid(self.video_id)
         return _id
 
     def update_model(self, data={}):
         obj = super(ActivityVideo, self).update_model(data)
         if obj:
+            if 'title' in data.get('$set', {}):
+                self.search_index(obj.activity_id).add(obj._id, obj.title, obj.create_at)
+
             Redis.delete(self.TOP_COMPETE_VIDEO_IDS % ({'aid': str(self.activity_id)}))
 
             Redis.delete(self.TOP_VIDEO_END % ({'aid': str(self.activity_id)}))
             Redis.delete(self.TOP_MANUAL_TOP % ({'aid': str(self.activity_id)}))
+
+            if str(obj.video_id) != str(self.video_id):
+                self._remove_vid(self.video_id)
+                self._add_vid(obj.video_id)
         return obj
 
+    @classmethod
+    def counters_flushed(cls, oids):
+        # 播放量&点赞数写回后清除所在活动的排序
+        aids = set(str(av.activity_id) for av in cls.get_list(oids, check_online=False))
+        for aid in aids:
+            Redis.delete(cls.TOP_COMPETE_VIDEO_IDS % ({'aid': aid}))
+            Redis.delete(cls.TOP_VIDEO_END % ({'aid': aid}))
+            Redis.delete(cls.TOP_MANUAL_TOP % ({'aid': aid}))
+
     def delete_model(self):
         ret = super(ActivityVideo, self).delete_model()
         if ret:
@@ -355,6 +412,10 @@ class ActivityVideo(Document):
 
             Redis.delete(self.TOP_VIDEO_END % ({'aid': str(self.activity_id)}))
             Redis.delete(self.TOP_MANUAL_TOP % ({'aid': str(self.activity_id)}))
+
+            self.search_index(self.activity_id).remove(self._id)
+            self._remove_vid(self.video_id)
+
             from wanx.models.video import Video
             video = Video.get_one(str(self.video_id))
             if video:
@@ -376,8 +437,62 @@ class ActivityVideo(Document):
         doc.vote = 0
         return cls(doc)
 
+    @classmethod
+    @util.cached_set(lambda cls: cls.ACTIVITY_VIDS, snowslide=True)
+    def _load_activity_vids(cls):
+        vids = cls.collection.distinct('video_id')
+        return tuple(str(vid) for vid in vids)
+
+    @classmethod
+    def _add_vid(cls, vid):
+        cls.ADD_VID_SCRIPT(keys=[cls.ACTIVITY_VIDS, cls.RECENT_VIDS],
+                           args=[str(vid), cls.RECENT_EXPIRE])
+
+    @classmethod
+    def _remove_vid(cls, vid):
+        # 同一视频可能参加多个活动, 仍有记录时保留
+        if cls.collection.find_one({'video_id': ObjectId(str(vid))}, {'_id': 1}):
+            return
+        Redis.srem(cls.RECENT_VIDS, str(vid))
+        try:
+            Redis.srem(cls.ACTIVITY_VIDS, str(vid))
+        except exceptions.ResponseError:
+            Redis.delete(cls.ACTIVITY_VIDS)
+
+    @classmethod
+    def in_activity(cls, vid):
+        """视频是否参加过活动, 没有参加时播放&点赞等操作不再查询活动视频
+        """
+        pipe = Redis.pipeline(transaction=False)
+        pipe.type(cls.ACTIVITY_VIDS)
+        pipe.sismember(cls.ACTIVITY_VIDS, str(vid))
+        rtype, ret = pipe.execute(raise_on_error=False)
+        if rtype == 'none':
+            cls._load_activity_vids()
+            cls.MERGE_VIDS_SCRIPT(keys=[cls.ACTIVITY_VIDS, cls.RECENT_VIDS])
+            pipe = Redis.pipeline(transaction=False)
+            pipe.type(cls.ACTIVITY_VIDS)
+            pipe.sismember(cls.ACTIVITY_VIDS, str(vid))
+            rtype, ret = pipe.execute(raise_on_error=False)
+            if rtype == 'none':
+                # 其他请求正在加载, 直接查询数据库
+                return cls.collection.find_one({'video_id': ObjectId(str(vid))},
+                                               {'_id': 1}) is not None
+        # 没有活动视频时为字符串占位
+        return rtype == 'set' and ret is True
+
+    @classmethod
+    def search_index(cls, aid):
+        """活动参赛视频标题搜索索引
+        """
+        return xsearch.SearchIndex('activity_video:%s' % (aid))
+
     @classmethod
     def search(cls, keyword, activity_id):
+        index = cls.search_index(activity_id)
+        if index.ready():
+            return [ObjectId(avid) for avid in index.search(keyword)]
+
         ids = cls.collection.find(
             {
                 'title': {'$regex': keyword, '$options': 'i'},
@@ -399,6 +514,19 @@ class ActivityVideo(Document):
         avids = [str(v['_id']) for v in activity_videos]
         return avids
 
+    @classmethod
+    def popular_video_items(cls, aid, sort, pagesize, cursor=None):
+        """按(sort, _id)倒序分页获取参赛视频
+        返回: [(avid, sort_value), ...]
+        """
+        cond = {'activity_id': ObjectId(aid)}
+        cond.update(xcursor.mongo_cond(sort, cursor))
+        activity_videos = cls.collection.find(
+            cond,
+            {'_id': 1, sort: 1}
+        ).sort([(sort, pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]).limit(pagesize)
+        return [(str(v['_id']), xcursor.mongo_score(v.get(sort))) for v in activity_videos]
+
     @classmethod
     @util.cached_zset(lambda cls, aid: cls.LATEST_VIDEO_IDS % ({'aid': aid}), snowslide=True)
     def _load_latest_video_ids(cls, aid):
@@ -424,6 +552,11 @@ class ActivityVideo(Document):
 
         return list(avideo_ids)
 
+    @classmethod
+    def latest_video_items(cls, aid, pagesize, cursor=None):
+        key = cls.LATEST_VIDEO_IDS % ({'aid': aid})
+        return xcursor.zset_page(key, pagesize, cursor, lambda: cls._load_latest_video_ids(aid))
+
     @classmethod
     def user_compete_video_ids(cls, aid, uid):
         videos = list(cls.collection.find(
@@ -537,6 +670,8 @@ class ActivityVideo(Document):
 
     @classmethod
     def get_activity_video(cls, aid=None, vid=None):
+        if not cls.in_activity(vid):
+            return []
         if not aid:
             avideos = list(cls.collection.find({'video_id': ObjectId(vid)}))
             return avideos
@@ -549,6 +684,8 @@ class ActivityVideo(Document):
 
     @classmethod
     def get_activity_video_by_vid(cls, vid):
+        if not cls.in_activity(vid):
+            return None
         activity_video = cls.collection.find_one({'video_id': ObjectId(vid)})
         return cls(activity_video) if activity_video else None
 
@@ -5,7 +5,7 @@ from redis import exceptions
 from wanx.models import Document
 from wanx.base.xredis import Redis
 from wanx.base.xmongo import DB
-from wanx.base import util, const
+from wanx.base import util, const, xcursor
 from wanx.base.cachedict import CacheDict
 from wanx.models.user import User
 
@@ -44,6 +44,9 @@ class Comment(Document):
             video = Video.get_one(str(self.video), check_online=False)
             video.update_model({'$inc': {'comment_count': 1}})
 
+            from wanx.models.video import HotVideoRank
+            HotVideoRank.record(video, 'comment')
+
             key = self.VIDEO_COMMENT_IDS % ({'vid': str(self.video)})
             # 列表为空时key对应的value是一个string
             try:
@@ -114,6 +117,12 @@ class Comment(Document):
             ids = []
         return list(ids)
 
+    @classmethod
+    def video_comment_items(cls, video_id, pagesize, cursor=None):
+        key = cls.VIDEO_COMMENT_IDS % ({'vid': video_id})
+        return xcursor.zset_page(key, pagesize, cursor,
+                                 lambda: cls._load_video_comment_ids(video_id))
+
     @classmethod
     def video_comment_count(cls, video_id):
         key = cls.VIDEO_COMMENT_IDS % ({'vid': video_id})
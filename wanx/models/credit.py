@@ -1,5 +1,6 @@
 # -*- coding: utf8 -*-
 from wanx.base import util, const
+from wanx.base.xmysql import MYDB
 from wanx.models import BaseModel
 
 import datetime
@@ -48,52 +49,154 @@ class UserCredit(BaseModel):
 
         return uc
 
-    def _change_gem(self, num, action):
-        self.gem += num
-        self.save()
-        # 增加交易记录
-        UserGemLog.create(user_id=self.user_id, gem=num, action=action)
-
-    def add_gem(self, num, action):
-        self._change_gem(num, action) if num > 0 else None
-
-    def reduce_gem(self, num, action):
-        self._change_gem(-num, action) if num > 0 else None
-
-    def _change_gold(self, num, action):
-        self.gold += num
-        self.save()
-        # 增加交易记录
-        UserGoldLog.create(user_id=self.user_id, gold=num, action=action)
-
-    def add_gold(self, num, action):
-        self._change_gold(num, action) if num > 0 else None
-
-    def reduce_gold(self, num, action):
-        self._change_gold(-num, action) if num > 0 else None
-
-    def reduce_money(self, num, action='gift'):
-        if num > 0:
-            before = self.current_money
-            self.current_money -= abs(num)
-            after = self.current_money
-            UserMoneyLog.create(user_id=self.user_id, money=num,before=before,after=after, action=action)
-            self.save()
-            return
-        else:
-            return
-
-    def add_get_money(self, num,action='gift'):
-        before = self.current_money
-        self.current_money += abs(int(num))
-        after = self.current_money
-        UserMoneyLog.create(user_id=self.user_id, money=num,before=before,after=after, action=action)
-        self.get_money += abs(int(num))
-        self.save()
-
-    def add_cost_money(self, num):
-        self.cost_money += abs(int(num))
-        self.save()
+    @classmethod
+    def _is_duplicate(cls, err):
+        # 根据唯一索引冲突的错误信息判断, 不额外加锁读取, 避免与其他事务的插入间隙锁死锁
+        args = getattr(err, 'args', ())
+        return len(args) >= 2 and args[0] == 1062 and 'credit_operation_op_key' in str(args[1])
+
+    @classmethod
+    def _apply_changes(cls, changes, action, op_key=None):
+        """修改余额, 返回(是否成功, 是否执行了修改), 重复的操作返回(True, False)
+        """
+        logs = dict()
+        now = datetime.datetime.now()
+        try:
+            with MYDB.atomic():
+                if op_key:
+                    CreditOperation.create(op_key=op_key, action=str(action), create_at=now)
+                for user_id, field, num in changes:
+                    if not num:
+                        continue
+                    column = getattr(cls, field)
+                    query = cls.update(**{field: column + num}).where(cls.user_id == user_id)
+                    if num < 0 and field in ('gold', 'gem'):
+                        query = query.where(column >= -num)
+                    if not query.execute():
+                        raise _InsufficientCredit()
+
+                    if field == 'gold':
+                        logs.setdefault(UserGoldLog, []).append(
+                            dict(user_id=user_id, gold=num, action=action, create_at=now))
+                    elif field == 'gem':
+                        logs.setdefault(UserGemLog, []).append(
+                            dict(user_id=user_id, gem=num, action=action, create_at=now))
+                    elif field == 'current_money':
+                        # 行已被本事务锁定, 读取修改后的值
+                        after = cls.select(cls.current_money).where(cls.user_id == user_id).scalar()
+                        logs.setdefault(UserMoneyLog, []).append(
+                            dict(user_id=user_id, money=abs(num), before=after - num, after=after,
+                                 action=action, create_at=now))
+                for model, rows in logs.iteritems():
+                    model.insert_many(rows).execute()
+        except _InsufficientCredit:
+            return False, False
+        except pw.IntegrityError, e:
+            # 重复的操作op_key唯一索引冲突, 其他完整性错误继续抛出
+            if op_key and cls._is_duplicate(e):
+                return True, False
+            raise
+        return True, True
+
+    @classmethod
+    def change_credits(cls, changes, action, op_key=None):
+        """在一个事务内原子修改一个或多个用户的余额, 并批量写入交易记录
+        changes: [(user_id, field, num), ...], field为gold|gem|current_money|get_money|cost_money,
+                 num为负数时扣减, 游米或游票任何一项余额不足时全部不修改
+        op_key: 操作的幂等键, 相同的操作只执行一次
+        返回: 是否成功, 重复的操作返回True
+        """
+        return cls._apply_changes(changes, action, op_key)[0]
+
+    def _change(self, field, num, action, op_key=None):
+        ret, applied = self._apply_changes([(self.user_id, field, num)], action, op_key)
+        # 重复的操作没有修改余额
+        if applied:
+            setattr(self, field, (getattr(self, field) or 0) + num)
+        return ret
+
+    def add_gem(self, num, action, op_key=None):
+        return self._change('gem', num, action, op_key) if num > 0 else False
+
+    def reduce_gem(self, num, action, op_key=None):
+        return self._change('gem', -num, action, op_key) if num > 0 else False
+
+    def add_gold(self, num, action, op_key=None):
+        return self._change('gold', num, action, op_key) if num > 0 else False
+
+    def reduce_gold(self, num, action, op_key=None):
+        return self._change('gold', -num, action, op_key) if num > 0 else False
+
+    def pay(self, credit_type, num, action, op_key=None):
+        """按价格类型扣除游票或游米, 余额不足时返回False
+        """
+        if credit_type == const.SALE_GEM:
+            return self.reduce_gem(num, action, op_key)
+        elif credit_type == const.SALE_GOLD:
+            return self.reduce_gold(num, action, op_key)
+        return True
+
+    def refund(self, credit_type, num, action):
+        """退回pay扣除的游票或游米
+        """
+        if credit_type == const.SALE_GEM:
+            return self.add_gem(num, action)
+        elif credit_type == const.SALE_GOLD:
+            return self.add_gold(num, action)
+        return True
+
+    def reduce_money(self, num, action='gift', op_key=None):
+        return self._change('current_money', -abs(num), action, op_key) if num > 0 else False
+
+    def add_get_money(self, num, action='gift', op_key=None):
+        num = abs(int(num))
+        ret, applied = self._apply_changes([(self.user_id, 'current_money', num),
+                                            (self.user_id, 'get_money', num)], action, op_key)
+        if applied:
+            self.current_money += num
+            self.get_money += num
+        return ret
+
+    def add_cost_money(self, num, op_key=None):
+        return self._change('cost_money', abs(int(num)), 'gift', op_key)
+
+    @classmethod
+    def reconcile(cls, user_ids):
+        """核对余额与交易记录, 返回不一致的[(user_id, field, 余额, 交易记录), ...]
+        游米和游票余额应等于交易记录之和, 礼物价值应等于最后一条交易记录的交易后价值
+        """
+        user_ids = list(user_ids)
+        gold = dict(UserGoldLog.select(UserGoldLog.user_id, pw.fn.SUM(UserGoldLog.gold)).where(
+            UserGoldLog.user_id << user_ids).group_by(UserGoldLog.user_id).tuples())
+        gem = dict(UserGemLog.select(UserGemLog.user_id, pw.fn.SUM(UserGemLog.gem)).where(
+            UserGemLog.user_id << user_ids).group_by(UserGemLog.user_id).tuples())
+        last_ids = UserMoneyLog.select(pw.fn.MAX(UserMoneyLog.id)).where(
+            UserMoneyLog.user_id << user_ids).group_by(UserMoneyLog.user_id)
+        money = dict(UserMoneyLog.select(UserMoneyLog.user_id, UserMoneyLog.after).where(
+            UserMoneyLog.id << last_ids).tuples())
+
+        ret = list()
+        for uc in cls.select().where(cls.user_id << user_ids):
+            for field, logged in (('gold', gold), ('gem', gem), ('current_money', money)):
+                value = int(logged.get(uc.user_id) or 0)
+                if getattr(uc, field) != value:
+                    ret.append((uc.user_id, field, getattr(uc, field), value))
+        return ret
+
+
+class _InsufficientCredit(Exception):
+    pass
+
+
+class CreditOperation(BaseModel):
+    """已执行的余额操作, 用于防止重复执行
+    """
+    op_key = pw.CharField(max_length=128, unique=True, verbose_name='操作ID')
+    action = pw.CharField(max_length=64, verbose_name='交易描述')
+
+    class Meta:
+        db_table = 'credit_operation'
+
 
 class UserGemLog(BaseModel):
     user_id = pw.CharField(max_length=64, verbose_name='用户ID')
@@ -20,6 +20,8 @@ class DaTangVideo(Document):
 
     CACHED_OBJS = CacheDict(max_len=100, max_age_seconds=5)
 
+    COUNTER_FIELDS = ('vv',)
+
     GAME_HOTVIDEO_IDS = "dtvideos:hotgame:%(date)s:%(gid)s"  # 游戏人气视频队列
     USER_GAME_VIDEO_IDS = "dtvideos:user:%(uid)s:game:%(gid)s"  # 用户为某个游戏创建的视频队列
 
@@ -6,7 +6,7 @@ from urlparse import urljoin
 from wanx.models import Document
 from wanx.base.xredis import Redis
 from wanx.base.xmongo import DB
-from wanx.base import util, const
+from wanx.base import util, const, xsearch
 from wanx.base.cachedict import CacheDict
 from wanx import app
 from wanx.models.store import UserGiftCodeOrder
@@ -26,6 +26,8 @@ class Game(Document):
 
     POPULAR_USER_IDS = 'game:popuser:%(date)s:%(gid)s'  # 某个游戏的达人列表
 
+    SEARCH_INDEX = xsearch.SearchIndex('game', pinyin=True)  # 游戏名称搜索索引
+
     def format(self, exclude_fields=[]):
         from wanx.models.home import Share
         share = Share.get_by_game()
@@ -98,22 +100,46 @@ class Game(Document):
         doc.status = const.ONLINE
         return cls(doc)
 
+    def create_model(self):
+        _id = super(Game, self).create_model()
+        if _id:
+            self.SEARCH_INDEX.add(_id, self.name, self.create_at or 0)
+        return _id
+
+    def update_model(self, data={}):
+        obj = super(Game, self).update_model(data)
+        fields = data.get('$set', {}) if data else {}
+        if obj and 'name' in fields:
+            self.SEARCH_INDEX.add(obj._id, obj.name, obj.create_at or 0)
+        elif obj and 'status' in fields:
+            self.SEARCH_INDEX.touch()
+        return obj
+
+    def delete_model(self):
+        ret = super(Game, self).delete_model()
+        if ret:
+            self.SEARCH_INDEX.remove(self._id)
+        return ret
+
     @classmethod
     def search(cls, keyword, ua_filter=None):
+        cond = {'status': {'$nin': [const.OFFLINE, const.UNDER_TEST]}}
         if ua_filter:
             key = 'package_id_map.%s' % ua_filter
-            ids = cls.collection.find(
-                {'name': {'$regex': keyword, '$options': 'i'},
-                 'status': {'$nin': [const.OFFLINE, const.UNDER_TEST]},
-                 '$or': [{key: {'$exists': True}}, {'status': const.ONLINE}]},
-                {'_id': 1}
-            ).sort("create_at", pymongo.DESCENDING).limit(100)
-        else:
-            ids = cls.collection.find(
-                {'name': {'$regex': keyword, '$options': 'i'},
-                 'status': {'$nin': [const.OFFLINE, const.UNDER_TEST]}},
-                {'_id': 1}
-            ).sort("create_at", pymongo.DESCENDING).limit(100)
+            cond['$or'] = [{key: {'$exists': True}}, {'status': const.ONLINE}]
+
+        if cls.SEARCH_INDEX.ready():
+            # 索引按名称召回, 状态等条件通过_id查询过滤
+            gids = [ObjectId(gid) for gid in cls.SEARCH_INDEX.search(keyword, 500)]
+            cond['_id'] = {'$in': gids}
+            valid = set(g['_id'] for g in cls.collection.find(cond, {'_id': 1}))
+            return [gid for gid in gids if gid in valid][:100]
+
+        cond['name'] = {'$regex': keyword, '$options': 'i'}
+        ids = cls.collection.find(
+            cond,
+            {'_id': 1}
+        ).sort("create_at", pymongo.DESCENDING).limit(100)
         ids = [_id['_id'] for _id in ids]
         return list(ids) if ids else list()
 
@@ -6,7 +6,7 @@ from redis import exceptions
 from wanx.models import BaseModel
 from wanx.base.xredis import Redis
 from wanx.base.xmysql import MYDB
-from wanx.base import error, util, const
+from wanx.base import error, util, const, xcursor
 from wanx.models.credit import UserCredit, TRADE_ACTION
 from wanx.models.product import Product, UserProduct
 from wanx.models.user import User
@@ -14,6 +14,7 @@ from wanx.base.xmongo import DB
 from wanx.models import Document
 
 import cPickle as cjson
+import hashlib
 import peewee as pw
 from datetime import datetime,timedelta
 import time
@@ -22,7 +23,6 @@ import time
 ONSALE_GIFT_KEY = 'gift:onsale'
 ALL_GIFT_KEY = 'gift:all'
 VIDEO_GIFT_KEY = 'gift:video:%s'
-TOP_SENDER_KEY = 'gift:top_senders:%s'
 USER_TOTAL_GOLD = 'user:total:gold:%(uid)s'
 
 CREDIT_TYPE = (
@@ -140,7 +140,7 @@ class Gift(BaseModel):
         if num < 1:
             return error.InvalidArguments
 
-        uc = from_user_uc = UserCredit.get_or_create_user_credit(from_user)
+        uc = UserCredit.get_or_create_user_credit(from_user)
         product = Product.get_product(self.product_id)
         if self.credit_type == const.SALE_GOLD:
             total_gold = self.credit_value * num
@@ -148,7 +148,9 @@ class Gift(BaseModel):
                 return error.GiftError('你的游米不足，做任务可获取游米')
 
             with MYDB.atomic():
-                uc.reduce_gold(total_gold, const.GIFT)
+                # 余额在扣除时再次检查, 并发送礼时不会扣成负数
+                if not uc.reduce_gold(total_gold, const.GIFT):
+                    return error.GiftError('你的游米不足，做任务可获取游米')
                 product.add_product2user(to_user, num, const.GIFT)
                 UserGiftLog.create(
                     user_id=to_user,
@@ -167,7 +169,8 @@ class Gift(BaseModel):
                 return error.GiftError('你的游票不足')
 
             with MYDB.atomic():
-                uc.reduce_gem(total_gem, const.GIFT)
+                if not uc.reduce_gem(total_gem, const.GIFT):
+                    return error.GiftError('你的游票不足')
                 product.add_product2user(to_user, num, const.GIFT)
                 UserGiftLog.create(
                     user_id=to_user,
@@ -221,14 +224,24 @@ class Gift(BaseModel):
                         send_success=0,
                         transaction_id=kwargs.get("transactionId"))
                 else:
-                    total_money = self.gold_price * num
-                    from_user_uc.add_cost_money(total_money)
-                    to_user_uc = UserCredit.get_or_create_user_credit(to_user)
-                    to_user_uc.add_get_money(total_money)
-                    # 状态为1
-                    log = UserGiftLog.get_by_transaction_id(kwargs.get("transactionId"))
+                    # 锁定支付记录, 并发的重复回调在此等待
+                    log = UserGiftLog.get_by_transaction_id(kwargs.get("transactionId"),
+                                                            for_update=True)
                     if not log:
                         return error.GiftError('未发现支付记录')
+                    # 支付回调可能重复, 已送出的礼物不再处理
+                    if log.send_success:
+                        return True
+                    total_money = self.gold_price * num
+                    UserCredit.get_or_create_user_credit(to_user)
+                    _, applied = UserCredit._apply_changes(
+                        [(from_user, 'cost_money', total_money),
+                         (to_user, 'current_money', total_money),
+                         (to_user, 'get_money', total_money)],
+                        'gift', op_key='gift:%s' % (kwargs.get("transactionId")))
+                    if not applied:
+                        return True
+                    # 状态为1
                     log.send_success = 1
                     log.save()
                     # redis 更新
@@ -302,6 +315,75 @@ class UserGiftLog(BaseModel):
             logs = []
         return logs
 
+    @classmethod
+    def user_log_items(cls, user_id, mode, pagesize, cursor=None):
+        """按(最后赠送时间, 分组)倒序分页获取按天汇总的礼物记录
+        mode: 1:送礼记录，2：收礼记录
+        返回: [(log, timestamp), ...]
+        """
+        if mode == 1:
+            owner, peer, status = cls.from_user, cls.user_id, [-1, 0, 1]
+        elif mode == 2:
+            owner, peer, status = cls.user_id, cls.from_user, [-1, 1]
+        else:
+            return []
+
+        last_at = pw.fn.max(cls.create_at)
+        group_key = pw.fn.CONCAT(peer, '|', pw.fn.LPAD(cls.product_id, 10, '0'), '|',
+                                 cls.send_success)
+        query = cls.select(
+            last_at.alias('create_at'),
+            cls.product_id,
+            peer,
+            cls.credit_type,
+            cls.credit_value,
+            cls.send_success,
+            group_key.alias('group_key'),
+            pw.fn.Sum(cls.num).alias('daily_sum')
+        ).where(
+            owner == user_id,
+            cls.send_success << status
+        )
+
+        score, oid = xcursor.decode(cursor)
+        if score is not None:
+            last_dt = util.timestamp2datetime(score)
+            # 按天分组, 只需要扫描游标当天及之前的记录
+            day_end = last_dt.replace(hour=0, minute=0, second=0, microsecond=0) + \
+                timedelta(days=1)
+            query = query.where(cls.create_at < day_end).having(
+                (last_at < last_dt) | ((last_at == last_dt) & (group_key < oid))
+            )
+
+        logs = query.group_by(
+            cls.create_at.year,
+            cls.create_at.month,
+            cls.create_at.day,
+            peer,
+            cls.product_id,
+            cls.send_success
+        ).order_by(
+            last_at.desc(),
+            group_key.desc()
+        ).limit(pagesize)
+        return [(log, util.datetime2timestamp(log.create_at)) for log in logs]
+
+    @classmethod
+    def video_gift_items(cls, video_id, pagesize, cursor=None):
+        """按时间倒序分页获取录播视频收到的礼物
+        返回: [(gift_id, gift_log, timestamp), ...]
+        """
+        key = VIDEO_GIFT_KEY % (video_id)
+        items = xcursor.zset_page(key, pagesize, cursor, lambda: cls._load_video_gifts(video_id),
+                                  key=cls.gift_member_id)
+        return [(cls.gift_member_id(gf), cjson.loads(gf), score) for gf, score in items]
+
+    @staticmethod
+    def gift_member_id(member):
+        """视频礼物缓存成员在游标中的id
+        """
+        return 'g%s' % (hashlib.md5(member).hexdigest())
+
     @classmethod
     def user_today_gift_id_times(cls, user_id, gift_id,num):
         #该档位送了几次
@@ -316,8 +398,11 @@ class UserGiftLog(BaseModel):
         return times
 
     @classmethod
-    def get_by_transaction_id(cls, transaction_id):
-        logs = list(cls.select().where(cls.transaction_id == transaction_id))
+    def get_by_transaction_id(cls, transaction_id, for_update=False):
+        query = cls.select().where(cls.transaction_id == transaction_id)
+        if for_update:
+            query = query.for_update()
+        logs = list(query)
         if len(logs)>=1:
             return logs[0]
         else:
@@ -368,35 +453,6 @@ class UserGiftLog(BaseModel):
 
         return [cjson.loads(gf) for gf in gifts]
 
-    @classmethod
-    @util.cached_zset(lambda cls, user_id: TOP_SENDER_KEY % (user_id))
-    def _load_top_sender_ids(cls, user_id):
-        total_gold = pw.fn.Sum(UserGiftLog.gold_price)
-        senders = cls.select(
-            UserGiftLog.from_user,
-            total_gold.alias('gold')
-        ).where(UserGiftLog.user_id == user_id).group_by(UserGiftLog.from_user)
-        ret = list()
-        for sender in senders:
-            ret.extend([sender.gold, sender.from_user])
-
-        return tuple(ret)
-
-    @classmethod
-    def get_top_sender_ids(cls, user_id, page=None, pagesize=None):
-        key = TOP_SENDER_KEY % (user_id)
-        if not Redis.exists(key):
-            cls._load_top_sender_ids(user_id)
-
-        start = (page - 1) * pagesize if page else 0
-        stop = (start + pagesize - 1) if pagesize else -1
-        try:
-            uids = Redis.zrevrange(key, start, stop, withscores=True)
-        except exceptions.ResponseError:
-            uids = []
-
-        return list(uids)
-
     @classmethod
     def get_user_total_gold(cls, uid, begin_at, end_at):
         key = USER_TOTAL_GOLD % ({'uid': uid})
@@ -427,12 +483,7 @@ class UserGiftLog(BaseModel):
                 except exceptions.ResponseError:
                     Redis.delete(key)
 
-            key = TOP_SENDER_KEY % (inst.user_id)
-            try:
-                if Redis.exists(key) and query.get("send_success"):
-                    Redis.zincrby(key, inst.gold_price, inst.from_user)
-            except exceptions.ResponseError:
-                Redis.delete(key)
+            GiftLeaderboard.record(inst)
 
             if inst.gift_from == const.FROM_LIVE:
                 key = USER_TOTAL_GOLD % ({'uid': inst.user_id})
@@ -452,12 +503,7 @@ class UserGiftLog(BaseModel):
                 except exceptions.ResponseError:
                     Redis.delete(key)
 
-            key = TOP_SENDER_KEY % (inst.user_id)
-            try:
-                if Redis.exists(key) and inst.send_success:
-                    Redis.zincrby(key, inst.gold_price, inst.from_user)
-            except exceptions.ResponseError:
-                Redis.delete(key)
+            GiftLeaderboard.record(inst)
 
             if inst.gift_from == const.FROM_LIVE:
                 key = USER_TOTAL_GOLD % ({'uid': inst.user_id})
@@ -476,6 +522,189 @@ class UserGiftLog(BaseModel):
         return data
 
 
+class GiftLeaderboard(object):
+    """送礼实时排行: 主播(anchor)和直播间(live)的送礼用户排行, 分为总榜、日榜和周榜
+    每笔礼物赠送成功后增量更新; 总榜在首次读取时从数据库加载, 日榜和周榜从当天(周)开始累计,
+    由reconcile_gift_board.py定期与数据库核对
+    """
+    BOARD = 'gift:board:%(scope)s:%(target)s:%(period)s'  # 送礼用户排行(zset), 分数为游米价值
+
+    ANCHOR = 'anchor'  # 主播收礼排行, target为主播ID
+    LIVE = 'live'  # 直播间收礼排行, target为直播ID
+
+    # 按各排行的ttl累加礼物: 大于0为过期时间; 小于0只更新已加载的排行,
+    # 空数据占位时重新创建并以其绝对值为过期时间
+    INCR_SCRIPT = Redis.register_script("""
+        for i, key in ipairs(KEYS) do
+            local ttl = tonumber(ARGV[i + 2])
+            local rtype = redis.call('TYPE', key)['ok']
+            if rtype == 'string' then
+                redis.call('DEL', key)
+            end
+            if rtype ~= 'none' or ttl >= 0 then
+                redis.call('ZINCRBY', key, ARGV[2], ARGV[1])
+                if ttl > 0 then
+                    redis.call('EXPIRE', key, ttl)
+                elseif rtype == 'string' then
+                    redis.call('EXPIRE', key, -ttl)
+                end
+            end
+        end
+        return 1
+    """)
+
+    @staticmethod
+    def period_name(period, dt=None):
+        """all|day|week转换为排行周期名称
+        """
+        dt = dt or datetime.now()
+        if period == 'day':
+            return 'd' + dt.strftime('%Y%m%d')
+        elif period == 'week':
+            return 'w%04d%02d' % dt.isocalendar()[:2]
+        return 'all'
+
+    @classmethod
+    def board_key(cls, scope, target, period='all', dt=None):
+        return cls.BOARD % ({'scope': scope, 'target': target,
+                             'period': cls.period_name(period, dt)})
+
+    @classmethod
+    def _boards(cls, log):
+        """礼物记录对应的[(排行key, ttl), ...]
+        """
+        dt = log.create_at or datetime.now()
+        targets = [(cls.ANCHOR, log.user_id)]
+        if log.gift_from == const.FROM_LIVE:
+            targets.append((cls.LIVE, log.from_id))
+        ret = list()
+        for scope, target in targets:
+            # 主播总榜按需加载, 直播间总榜从开播开始累计, 保留时间与周榜相同
+            ret.append((cls.board_key(scope, target, 'all'),
+                        -const.GIFT_BOARD['anchor_all_ttl'] if scope == cls.ANCHOR
+                        else const.GIFT_BOARD['week_ttl']))
+            ret.append((cls.board_key(scope, target, 'day', dt), const.GIFT_BOARD['day_ttl']))
+            ret.append((cls.board_key(scope, target, 'week', dt), const.GIFT_BOARD['week_ttl']))
+        return ret
+
+    @classmethod
+    def record(cls, log):
+        """累加赠送成功的礼物
+        """
+        if not log or log.send_success != 1 or not log.gold_price:
+            return
+        boards = cls._boards(log)
+        cls.INCR_SCRIPT(keys=[key for key, _ in boards],
+                        args=[log.from_user, log.gold_price] + [ttl for _, ttl in boards])
+
+    @classmethod
+    def _query(cls, scope, target=None, begin=None, end=None):
+        """从数据库统计排行: {target: {from_user: gold}}
+        """
+        target_field = UserGiftLog.user_id if scope == cls.ANCHOR else UserGiftLog.from_id
+        total_gold = pw.fn.Sum(UserGiftLog.gold_price)
+        conds = [UserGiftLog.send_success == 1]
+        if scope == cls.LIVE:
+            conds.append(UserGiftLog.gift_from == const.FROM_LIVE)
+        if target:
+            conds.append(target_field == target)
+        if begin:
+            conds.append(UserGiftLog.create_at >= begin)
+        if end:
+            conds.append(UserGiftLog.create_at < end)
+        rows = UserGiftLog.select(
+            target_field.alias('target'), UserGiftLog.from_user, total_gold.alias('gold')
+        ).where(*conds).group_by(target_field, UserGiftLog.from_user).naive()
+        ret = dict()
+        for row in rows:
+            ret.setdefault(row.target, {})[row.from_user] = int(row.gold or 0)
+        return ret
+
+    @classmethod
+    @util.cached_zset(lambda cls, target: cls.board_key(cls.ANCHOR, target, 'all'),
+                      timeout=const.GIFT_BOARD['anchor_all_ttl'], snowslide=True)
+    def _load_anchor_board(cls, target):
+        ret = list()
+        for uid, gold in cls._query(cls.ANCHOR, target).get(target, {}).iteritems():
+            ret.extend([gold, uid])
+        return tuple(ret)
+
+    @classmethod
+    def top(cls, scope, target, period='all', start=0, stop=-1):
+        """排行[(uid, gold), ...]
+        """
+        key = cls.board_key(scope, target, period)
+        if scope == cls.ANCHOR and period == 'all' and not Redis.exists(key):
+            cls._load_anchor_board(target)
+        try:
+            uids = Redis.zrevrange(key, start, stop, withscores=True)
+        except exceptions.ResponseError:
+            uids = []
+        return list(uids)
+
+    @classmethod
+    def rank(cls, scope, target, uid, period='all'):
+        """用户在排行中的(名次, 游米价值), 不在排行中名次为None
+        """
+        key = cls.board_key(scope, target, period)
+        if scope == cls.ANCHOR and period == 'all' and not Redis.exists(key):
+            cls._load_anchor_board(target)
+        pipe = Redis.pipeline(transaction=False)
+        pipe.zrevrank(key, uid)
+        pipe.zscore(key, uid)
+        rank, score = pipe.execute(raise_on_error=False)
+        if not isinstance(rank, (int, long)):
+            return None, 0
+        return rank + 1, score or 0
+
+    @classmethod
+    def reconcile(cls, scope, period='all', dt=None):
+        """按数据库重新统计排行, 与Redis中不一致的排行整体替换
+        all: 只核对已加载的主播总榜和存在的直播间总榜
+        返回: (核对的排行数, 修正的排行数)
+        """
+        dt = dt or datetime.now()
+        begin = end = None
+        ttl = 0
+        if period == 'day':
+            begin = datetime(dt.year, dt.month, dt.day)
+            end = begin + timedelta(days=1)
+            ttl = const.GIFT_BOARD['day_ttl']
+        elif period == 'week':
+            begin = datetime(dt.year, dt.month, dt.day) - timedelta(days=dt.weekday())
+            end = begin + timedelta(days=7)
+            ttl = const.GIFT_BOARD['week_ttl']
+        elif scope == cls.ANCHOR:
+            ttl = const.GIFT_BOARD['anchor_all_ttl']
+        else:
+            ttl = const.GIFT_BOARD['week_ttl']
+
+        checked = fixed = 0
+        for target, scores in cls._query(scope, None, begin, end).iteritems():
+            key = cls.board_key(scope, target, period, dt)
+            if period == 'all' and not Redis.exists(key):
+                continue
+            checked += 1
+            try:
+                current = dict((uid, int(score)) for uid, score in
+                               Redis.zrange(key, 0, -1, withscores=True))
+            except exceptions.ResponseError:
+                current = {}
+            if current == scores:
+                continue
+            fixed += 1
+            pipe = Redis.pipeline()
+            pipe.delete(key)
+            args = list()
+            for uid, gold in scores.iteritems():
+                args.extend([gold, uid])
+            pipe.zadd(key, *args)
+            if ttl:
+                pipe.expire(key, ttl)
+            pipe.execute()
+        return checked, fixed
+
+
 class PayForGift(BaseModel):
     order_id = pw.PrimaryKeyField(verbose_name='订单号')
     user_id = pw.CharField(max_length=64, verbose_name='用户ID')
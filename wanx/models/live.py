@@ -1,4 +1,5 @@
 # -*- coding: utf8 -*-
+import bisect
 import time, datetime
 from urlparse import urljoin
 
@@ -6,6 +7,7 @@ from bson.objectid import ObjectId
 from redis import exceptions
 
 from wanx import app
+from wanx.base.cachedict import CacheDict
 from wanx.base.util import cached_object
 from wanx.models import Document
 from wanx.models.gift import UserGiftLog
@@ -27,38 +29,112 @@ class Event(Document):
     collection = LIVE_DB.event
     USER_LIVE_DAILY_HISTORY = 'event:history:%(today)s:%(uid)s'
     USER_HISTORY_LIVE = 'event:history:%(uid)s'
+    USER_LIVE_DURATION = 'event:duration:%(uid)s'  # 主播每天的直播时长(hash), d:日期为时长, t:日期为开播时间
+    HISTORY_CHECKPOINT = 'event:duration:checkpoint'  # 已汇总到的日期
+    AGGREGATED_LIVES = 'event:duration:done:%(day)s'  # 当天结束的已汇总直播id(set)
+
+    # 直播未汇总过时累加到主播每天的直播时长, 开播时间取当天最晚的一次
+    AGGREGATE_SCRIPT = Redis.register_script("""
+        local added = redis.call('SADD', KEYS[1], ARGV[1])
+        redis.call('EXPIRE', KEYS[1], ARGV[2])
+        if added == 0 then
+            return 0
+        end
+        for i = 3, #ARGV, 3 do
+            redis.call('HINCRBY', KEYS[2], 'd:' .. ARGV[i], ARGV[i + 1])
+            local start = tonumber(redis.call('HGET', KEYS[2], 't:' .. ARGV[i]) or 0)
+            if tonumber(ARGV[i + 2]) > start then
+                redis.call('HSET', KEYS[2], 't:' .. ARGV[i], ARGV[i + 2])
+            end
+        end
+        return 1
+    """)
+
+    @staticmethod
+    def _history_start():
+        """直播历史的起始日期(去年同月1日)
+        """
+        today = datetime.date.today()
+        return today.replace(year=today.year - 1, day=1)
+
+    @staticmethod
+    def _split_days(create_at, finish_at):
+        """按天切分直播时间段: [(日期, 当天开始时间, 时长), ...]
+        """
+        ret = list()
+        start, finish = int(create_at), int(finish_at)
+        while True:
+            day = datetime.date.fromtimestamp(start)
+            next_day = int(time.mktime((day + datetime.timedelta(days=1)).timetuple()))
+            ret.append((day.strftime('%y%m%d'), start, max(min(finish, next_day) - start, 0)))
+            if finish <= next_day:
+                return ret
+            start = next_day
+
+    @classmethod
+    def aggregate_day(cls, day):
+        """把day当天结束的直播累加到主播每天的直播时长, 返回新汇总的直播数
+        按直播id判断是否已经汇总, 判断和累加在同一个脚本中执行, 重复或并发执行不会重复累加
+        """
+        tag = day.strftime('%y%m%d')
+        begin = time.mktime(day.timetuple())
+        end = time.mktime((day + datetime.timedelta(days=1)).timetuple())
+        rows = cls.collection.find(
+            {'finish_at': {'$gte': begin, '$lt': end}},
+            {'user_id': 1, 'create_at': 1, 'finish_at': 1}
+        )
+
+        expired = cls._history_start().strftime('%y%m%d')
+        done_key = cls.AGGREGATED_LIVES % ({'day': tag})
+        pipe = Redis.pipeline(transaction=False)
+        for row in rows:
+            args = [str(row['_id']), const.LIVE_HISTORY['done_expire']]
+            for d, ts, duration in cls._split_days(row['create_at'], row['finish_at']):
+                if d >= expired:
+                    args.extend([d, duration, ts])
+            key = cls.USER_LIVE_DURATION % ({'uid': str(row['user_id'])})
+            cls.AGGREGATE_SCRIPT(keys=[done_key, key], args=args, client=pipe)
+        count = sum(pipe.execute())
+
+        if (Redis.get(cls.HISTORY_CHECKPOINT) or '') < tag:
+            Redis.set(cls.HISTORY_CHECKPOINT, tag)
+        return count
+
+    @classmethod
+    def aggregate_history(cls):
+        """从检查点之前rescan_days天(首次为历史起始日期)汇总到昨天, 返回[(日期, 新汇总的直播数), ...]
+        重新扫描检查点之前的几天, 补上结束时间延迟写入的直播
+        """
+        today = datetime.date.today()
+        checkpoint = Redis.get(cls.HISTORY_CHECKPOINT)
+        if checkpoint:
+            day = datetime.datetime.strptime(checkpoint, '%y%m%d').date()
+            day -= datetime.timedelta(days=const.LIVE_HISTORY['rescan_days'] - 1)
+            day = max(day, cls._history_start())
+        else:
+            day = cls._history_start()
+        ret = list()
+        while day < today:
+            ret.append((day, cls.aggregate_day(day)))
+            day += datetime.timedelta(days=1)
+        return ret
 
     @classmethod
     @util.cached_object(lambda cls, uid, key: key)
     def _load_user_live_history(cls, uid, key):
-        today = datetime.date.today()
-        last_year = today.replace(year=today.year - 1, day=1)
-        today = time.mktime(today.timetuple())
-        last_year = time.mktime(last_year.timetuple())
-        ret = cls.collection.find(
-            {
-                'user_id': uid,
-                'create_at': {'$lt': today},
-                'finish_at': {'$gt': last_year}
-            },
-            {'create_at': 1, 'finish_at': 1}
-        ).sort("create_at", pymongo.DESCENDING)
+        duration_key = cls.USER_LIVE_DURATION % ({'uid': uid})
+        data = Redis.hgetall(duration_key)
+        start = cls._history_start().strftime('%y%m%d')
+        # 清理超出时间范围的记录
+        expired = [f for f in data if f[2:] < start]
+        if expired:
+            Redis.hdel(duration_key, *expired)
 
         logs = {}
-        for row in ret:
-            cday = time.strftime('%y%m%d', time.localtime(row['create_at']))
-            fday = time.strftime('%y%m%d', time.localtime(row['finish_at']))
-
-            # 结束时间与开始时间在同一天
-            if cday not in logs:
-                logs[cday] = [0, row['create_at']]
-            if fday == cday:
-                logs[cday][0] += max(int(row['finish_at']) - int(row['create_at']), 0)
-                continue
-            # 结束时间与开始时间不在同一天
-            ts = int(time.mktime(time.strptime(fday, '%y%m%d')))  # 分割时间点
-            logs[cday][0] += ts - int(row['create_at'])
-            logs[fday] = [int(row['finish_at']) - ts, row['finish_at']]
+        for field, value in data.iteritems():
+            day = field[2:]
+            if field.startswith('d:') and day >= start:
+                logs[day] = [int(value), float(data.get('t:' + day, 0))]
         history, mlist, pday = [], [], '000000'
         for cday, val in sorted(logs.items(), key=lambda x: x[0], reverse=True):
             # 发生月份变更
@@ -237,10 +313,12 @@ class WatchLiveTask(Document):
     LIVE_USER_TASK = 'live:task:%(date)s:%(uid)s'
     LIVE_TASKS = 'live:tasks'
 
-    def format(self, uid):
+    def format(self, uid, left_chance=None):
         tid = str(self._id)
         datestr = time.strftime('%y%m%d', time.localtime())
-        if uid:
+        if uid and left_chance is not None:
+            left_chance = int(left_chance)
+        elif uid:
             key = self.LIVE_USER_TASK % {'uid': uid, 'date': datestr}
             left_chance = int(Redis.hget(key, tid))
         else:
@@ -297,7 +375,7 @@ class WatchLiveTask(Document):
         try:
             tids = Redis.hgetall(key)
         except exceptions.ResponseError:
-            tids = []
+            tids = {}
         return tids
 
     @classmethod
@@ -504,6 +582,183 @@ class LiveRedPacket(Document):
             return not _is_in_group
 
 
+class RedPacketSchedule(object):
+    """直播红包弹幕调度索引
+    定时红包(mode=0)按开始时间排序, 开播时长红包(mode=1)按游戏分组,
+    每次调度只检查时间窗口内的定时红包和直播间所在游戏的开播时长红包
+    """
+
+    def __init__(self, packets):
+        self.loaded_at = time.time()
+        self.ids = set(str(rp._id) for rp in packets)
+        self.timed = list()  # [(begin_at, rp), ...]
+        self.by_game = dict()  # {game_id: [rp, ...]}, 不限游戏的红包key为None
+        for rp in packets:
+            rp.authors = set(rp.live_authors.split('\r\n')) if rp.live_authors else set()
+            rp.games = rp.live_games.split('\r\n') if rp.live_games else []
+            rp.keywords = rp.keyword.split(u',') if rp.keyword else []
+            if rp.mode == 0:
+                self.timed.append((rp.begin_at or 0, rp))
+            elif rp.mode == 1:
+                for gid in rp.games or [None]:
+                    self.by_game.setdefault(gid, []).append(rp)
+        self.timed.sort(key=lambda x: x[0])
+
+    @classmethod
+    def load(cls):
+        packets = LiveRedPacket.get_list(LiveRedPacket.all_ids(), check_online=False)
+        return cls([rp for rp in packets if rp.status is None or rp.status == const.ONLINE])
+
+    @staticmethod
+    def _match(rp, live, ts):
+        if rp.expire_at and rp.expire_at < ts:
+            return False
+        if rp.authors and live['user_id'] not in rp.authors:
+            return False
+        if rp.keywords and not any(kw in live['name'] for kw in rp.keywords):
+            return False
+        return True
+
+    def match(self, snapshot, since, until):
+        """时间窗口(since, until]内需要发送弹幕的(红包, 直播间)
+        返回: ([(rp, live), ...], 检查的组合数)
+        """
+        ret = list()
+        checked = 0
+        # 定时红包: 开始时间在窗口内时发送到所有符合条件的直播间
+        start = bisect.bisect_right(self.timed, (since, ))
+        for begin_at, rp in self.timed[start:]:
+            if begin_at > until:
+                break
+            if begin_at <= since:
+                continue
+            if rp.games:
+                lives = [l for gid in rp.games for l in snapshot.by_game.get(gid, [])]
+            else:
+                lives = snapshot.lives
+            for live in lives:
+                checked += 1
+                if self._match(rp, live, until):
+                    ret.append((rp, live))
+
+        # 开播时长红包: 主播开播(或红包开始)后delay分钟落在窗口内时发送
+        for live in snapshot.lives:
+            for rp in self.by_game.get(live['game_id'], []) + self.by_game.get(None, []):
+                checked += 1
+                if rp.begin_at and rp.begin_at > until:
+                    continue
+                count_at = max(live['create_at'], rp.begin_at or 0) + (rp.delay or 0) * 60
+                if since < count_at <= until and self._match(rp, live, until):
+                    ret.append((rp, live))
+        return ret, checked
+
+
+class LivePlayRules(object):
+    """观看直播的任务和观看时长红包投放规则
+    规则编译后在进程内缓存10秒, 并按(平台, 版本, 渠道, 省份)缓存符合条件的候选列表,
+    请求时只需检查用户组、直播间条件和用户的任务次数
+    """
+    CACHED_RULES = CacheDict(max_len=1, max_age_seconds=10)
+
+    def __init__(self):
+        self.segments = dict()
+        self.tasks = WatchLiveTask.get_list(WatchLiveTask.get_live_tids())
+        self.packets = list()
+        for rp in LiveRedPacket.get_list(LiveRedPacket.all_ids()):
+            # 只保留观看时长红包
+            if rp.mode != 2:
+                continue
+            rp.authors = set(rp.live_authors.split('\r\n')) if rp.live_authors else set()
+            rp.games = set(rp.live_games.split('\r\n')) if rp.live_games else set()
+            rp.keywords = rp.keyword.split(u',') if rp.keyword else []
+            self.packets.append(rp)
+        # 需要登录的规则对应的用户组类型, 用户组不存在时为None
+        self.groups = dict()
+        for rule in self.tasks + self.packets:
+            if rule.login == 'login' and rule.group and str(rule.group) not in self.groups:
+                group = Group.get_one(str(rule.group))
+                self.groups[str(rule.group)] = group and group.gtype
+
+    @classmethod
+    def current(cls):
+        rules = cls.CACHED_RULES.get('rules')
+        if rules is None:
+            rules = cls()
+            cls.CACHED_RULES['rules'] = rules
+        return rules
+
+    @staticmethod
+    def _match_client(rule, os, version_code, channels, province):
+        if rule.os and rule.os not in ['all', os]:
+            return False
+        if (rule.version_code_mix and rule.version_code_mix > version_code) or \
+                (rule.version_code_max and rule.version_code_max < version_code):
+            return False
+        if channels and rule.channels and channels not in rule.channels:
+            return False
+        if rule.province and (not province or province not in rule.province):
+            return False
+        return True
+
+    def segment(self, os, version_code, channels, province):
+        """客户端条件符合的(任务列表, 红包列表)
+        """
+        key = (os, version_code, channels, province)
+        if key not in self.segments:
+            self.segments[key] = (
+                [t for t in self.tasks if self._match_client(t, *key)],
+                [rp for rp in self.packets if self._match_client(rp, *key)])
+        return self.segments[key]
+
+    def _check_groups(self, rules, uid):
+        """一次批量检查用户所在的用户组, 返回用户组检查通过的规则
+        """
+        gids = [str(r.group) for r in rules if r.login == 'login' and r.group and uid]
+        members = UserGroup.user_in_groups(gids, uid) if gids else {}
+        ret = list()
+        for rule in rules:
+            if rule.login == 'login':
+                if not uid:
+                    continue
+                gid = str(rule.group) if rule.group else None
+                gtype = self.groups.get(gid)
+                if gtype is not None:
+                    in_group = members.get(gid, False)
+                    if in_group != (gtype == const.WHITELIST_GROUP):
+                        continue
+            ret.append(rule)
+        return ret
+
+    def match(self, live, uid, user_tids, joined_ids, os, version_code, channels, province):
+        """返回第一个符合条件的(任务, 观看时长红包)
+        user_tids: 登录用户当天的任务剩余次数{tid: chance}
+        joined_ids: 用户已参与的红包活动id
+        """
+        ts = time.time()
+        tasks, packets = self.segment(os, version_code, channels, province)
+        if uid:
+            tasks = [t for t in tasks if str(t._id) in user_tids]
+        tasks = [t for t in tasks if t.online]
+
+        candidates = list()
+        for rp in packets:
+            if str(rp._id) in joined_ids:
+                continue
+            if (rp.begin_at and rp.begin_at > ts) or (rp.expire_at and rp.expire_at < ts):
+                continue
+            if rp.authors and live['user_id'] not in rp.authors:
+                continue
+            if rp.games and live['game_id'] not in rp.games:
+                continue
+            if rp.keywords and not any(kw in live['name'] for kw in rp.keywords):
+                continue
+            candidates.append(rp)
+
+        tasks = self._check_groups(tasks, uid)
+        candidates = self._check_groups(candidates, uid)
+        return (tasks[0] if tasks else None), (candidates[0] if candidates else None)
+
+
 class UserRedPacket(Document):
     collection = DB.user_red_packet
     USER_REDPACKET_IDS = 'live:redpacket:user:%(uid)s'
@@ -0,0 +1,114 @@
+# -*- coding: utf8 -*-
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from wanx.base.spam import Spam
+from wanx.base.xmongo import DB
+from wanx.base.xredis import Redis
+from wanx.models import Document
+from wanx.models.comment import Comment, Reply
+from wanx.models.user import User
+from wanx.models.video import Video
+
+import time
+
+
+# 扫描来源: (模型, 检查的字段及对应的敏感词类型, 作者字段)
+SCAN_SOURCES = {
+    'comment': (Comment, [('content', 'comment')], 'author'),
+    'reply': (Reply, [('content', 'comment')], 'owner'),
+    'video': (Video, [('title', 'video')], 'author'),
+    'user': (User, [('nickname', 'user'), ('signature', 'signature'),
+                    ('announcement', 'announcement')], '_id'),
+}
+
+
+class SpamReview(Document):
+    """敏感词复查队列
+    关键词更新后批量扫描已有内容, 命中的内容写入队列等待人工审核
+    """
+    collection = DB.spam_reviews
+
+    SCAN_CHECKPOINT = 'spam:scan:checkpoint'  # 各来源已扫描到的_id(hash)
+
+    PENDING = 0  # 待审核
+    PASSED = 1  # 审核通过
+    REJECTED = 2  # 已处理
+
+    @classmethod
+    def _check(cls, model, doc, fields):
+        """检查文档, 返回命中的[(字段, 敏感词列表), ...]
+        """
+        if model(doc).offline:
+            return []
+        hits = list()
+        for field, ktype in fields:
+            words = Spam.query(doc.get(field), ktype)
+            if words:
+                hits.append((field, sorted(set(w.decode('utf8') for _, w in words))))
+        return hits
+
+    @classmethod
+    def _clear_stale(cls, source, begin, end, hit_ids):
+        """删除(begin, end]范围内不再命中的待审核记录, 包括内容已修改、下线或删除的
+        """
+        target = {'$nin': hit_ids}
+        if begin:
+            target['$gt'] = ObjectId(begin)
+        if end:
+            target['$lte'] = end
+        ret = cls.collection.delete_many({'source': source, 'status': cls.PENDING,
+                                          'target': target})
+        return ret.deleted_count
+
+    @classmethod
+    def scan(cls, source, batch=500, rate=1000, reset=False):
+        """按_id顺序分批扫描来源中的文档, 从上次中断的位置继续
+        batch: 每批读取的文档数
+        rate: 每秒最多扫描的文档数
+        返回: (扫描文档数, 命中文档数)
+        """
+        model, fields, author_field = SCAN_SOURCES[source]
+        if reset:
+            Redis.hdel(cls.SCAN_CHECKPOINT, source)
+
+        projection = dict((f, 1) for f, _ in fields)
+        projection.update({'status': 1, author_field: 1})
+        scanned = hit = 0
+        while True:
+            begin = time.time()
+            last_id = Redis.hget(cls.SCAN_CHECKPOINT, source)
+            cond = {'_id': {'$gt': ObjectId(last_id)}} if last_id else {}
+            docs = list(model.collection.find(cond, projection).sort('_id', 1).limit(batch))
+            if not docs:
+                # 最后扫描位置之后的文档已删除
+                cls._clear_stale(source, last_id, None, [])
+                break
+
+            ops = list()
+            hit_ids = list()
+            for doc in docs:
+                hits = cls._check(model, doc, fields)
+                if not hits:
+                    continue
+                hit_ids.append(doc['_id'])
+                ops.append(UpdateOne(
+                    {'source': source, 'target': doc['_id']},
+                    {'$set': {'author': doc.get(author_field),
+                              'hits': dict(hits),
+                              'update_at': time.time()},
+                     '$setOnInsert': {'status': cls.PENDING, 'create_at': time.time()}},
+                    upsert=True
+                ))
+            if ops:
+                cls.collection.bulk_write(ops, ordered=False)
+            cls._clear_stale(source, last_id, docs[-1]['_id'], hit_ids)
+
+            scanned += len(docs)
+            hit += len(ops)
+            Redis.hset(cls.SCAN_CHECKPOINT, source, str(docs[-1]['_id']))
+
+            # 限速, 避免影响线上mongo
+            cost = time.time() - begin
+            if cost < float(len(docs)) / rate:
+                time.sleep(float(len(docs)) / rate - cost)
+        return scanned, hit
@@ -1,14 +1,16 @@
 # -*- coding: utf8 -*-
 from bson.objectid import ObjectId
+from redis import exceptions
+from pymongo import UpdateOne
 from wanx import app
 from wanx.base.spam import Spam
 from wanx.base.xmongo import DB
-from wanx.base.xredis import MRedis
+from wanx.base.xredis import Redis, MRedis
 from wanx.models import Document
 from wanx.models.video import Video
 from wanx.models.comment import Comment, Reply
 from wanx.models.user import User
-from wanx.base import const
+from wanx.base import const, util, xcursor
 from wanx.models.user import UserGroup, Group
 
 import time
@@ -56,73 +58,56 @@ class Message(Document):
             'obj': obj,
             'action': self.action,
             'operator': operator and operator.format(),
+            'count': self.count or 1,
             'create_at': self.create_at
         }
         return data
 
     @classmethod
-    def send_video_msg(cls, operator_id, obj_id, action='like'):
-        video = Video.get_one(obj_id)
-        # 如果视频没有作者，则不创建视频评论消息。
-        if not video or not video.author:
+    def _send(cls, owner_id, ctype, obj_id, action, operator_id):
+        """发送消息, 同一用户对同一对象的同类消息在时间窗口内合并为一条
+        """
+        count = MessageDigest.add(owner_id, ctype, obj_id, action, operator_id)
+        if count != 1:
             return
-        owner_id = str(video.author)
         obj = cls.init()
         obj.owner = ObjectId(owner_id)
-        obj.ctype = 'video'
+        obj.ctype = ctype
         obj.obj_id = ObjectId(obj_id)
         obj.action = action
         obj.operator = ObjectId(operator_id)
+        obj.count = 1
+        obj.update_at = obj.create_at
         msg_id = obj.create_model()
+        MessageDigest.bind(owner_id, ctype, obj_id, action, msg_id)
+        Inbox.add(owner_id, msg_id, obj.update_at)
         # 发送消息到队列
         channel = User.USER_ASYNC_MSG % ({'uid': owner_id})
         msg = dict(obj_type='Message', obj_id=str(msg_id), count=1)
         MRedis.publish(channel, json.dumps(msg))
 
+    @classmethod
+    def send_video_msg(cls, operator_id, obj_id, action='like'):
+        video = Video.get_one(obj_id)
+        # 如果视频没有作者，则不创建视频评论消息。
+        if not video or not video.author:
+            return
+        cls._send(str(video.author), 'video', obj_id, action, operator_id)
+
     @classmethod
     def send_comment_msg(cls, operator_id, obj_id, action='like'):
         owner_id = str(Comment.get_one(obj_id).author)
-        obj = cls.init()
-        obj.owner = ObjectId(owner_id)
-        obj.ctype = 'comment'
-        obj.obj_id = ObjectId(obj_id)
-        obj.action = action
-        obj.operator = ObjectId(operator_id)
-        msg_id = obj.create_model()
-        # 发送消息到队列
-        channel = User.USER_ASYNC_MSG % ({'uid': owner_id})
-        msg = dict(obj_type='Message', obj_id=str(msg_id), count=1)
-        MRedis.publish(channel, json.dumps(msg))
+        cls._send(owner_id, 'comment', obj_id, action, operator_id)
 
     @classmethod
     def send_reply_msg(cls, operator_id, obj_id, action='reply'):
         owner_id = str(Reply.get_one(obj_id).owner)
-        obj = cls.init()
-        obj.owner = ObjectId(owner_id)
-        obj.ctype = 'reply'
-        obj.obj_id = ObjectId(obj_id)
-        obj.action = action
-        obj.operator = ObjectId(operator_id)
-        msg_id = obj.create_model()
-        # 发送消息到队列
-        channel = User.USER_ASYNC_MSG % ({'uid': owner_id})
-        msg = dict(obj_type='Message', obj_id=str(msg_id), count=1)
-        MRedis.publish(channel, json.dumps(msg))
+        cls._send(owner_id, 'reply', obj_id, action, operator_id)
 
     @classmethod
     def send_gift_msg(cls, operator_id, obj_id, action='gift'):
         owner_id = str(Video.get_one(obj_id).author)
-        obj = cls.init()
-        obj.owner = ObjectId(owner_id)
-        obj.ctype = 'video'
-        obj.obj_id = ObjectId(obj_id)
-        obj.action = action
-        obj.operator = ObjectId(operator_id)
-        msg_id = obj.create_model()
-        # 发送消息到队列
-        channel = User.USER_ASYNC_MSG % ({'uid': owner_id})
-        msg = dict(obj_type='Message', obj_id=str(msg_id), count=1)
-        MRedis.publish(channel, json.dumps(msg))
+        cls._send(owner_id, 'video', obj_id, action, operator_id)
 
     @classmethod
     def user_new_messages(cls, uid):
@@ -132,19 +117,229 @@ class Message(Document):
             }
         ).sort("update_at", pymongo.DESCENDING))
         msgs = [cls(msg) for msg in msgs]
+        MessageDigest.merge_pending(msgs)
         return msgs
 
+    @classmethod
+    def get_messages(cls, ids):
+        """按ids顺序从数据库读取消息(消息计数会被合并更新, 不使用对象缓存)
+        """
+        docs = cls.collection.find({'_id': {'$in': [ObjectId(_id) for _id in ids]}})
+        docs = dict((str(d['_id']), cls(d)) for d in docs)
+        msgs = [docs[_id] for _id in ids if _id in docs]
+        return MessageDigest.merge_pending(msgs)
+
     @classmethod
     def delete_user_messages(cls, uid, ts):
-        ret = cls.collection.delete_many(
-            {
-                'owner': ObjectId(uid),
-                'create_at': {'$lte': ts}
-            }
-        )
+        """删除最后更新时间不晚于ts的消息, 之后有新合并的消息保留
+        """
+        cond = {'owner': ObjectId(uid),
+                '$or': [{'update_at': {'$lte': ts}},
+                        {'update_at': {'$exists': False}, 'create_at': {'$lte': ts}}]}
+        msgs = list(cls.collection.find(cond, {'ctype': 1, 'obj_id': 1, 'action': 1}))
+        if not msgs:
+            return 0
+        ret = cls.collection.delete_many({'_id': {'$in': [m['_id'] for m in msgs]}})
+        Inbox.remove(uid, [str(m['_id']) for m in msgs])
+        # 删除合并窗口, 之后的同类消息重新创建
+        MessageDigest.remove([MessageDigest.key(uid, m.get('ctype'), str(m.get('obj_id')),
+                                                m.get('action')) for m in msgs])
         return ret.deleted_count
 
 
+class MessageDigest(object):
+    """评论&点赞消息合并
+    时间窗口内第一条消息写入数据库并通知用户, 之后的同类消息只在Redis中计数并记录最后的操作用户,
+    由定时任务(runtimedtasks.py)批量写回数据库, 用户读取消息时合并未写回的计数
+    """
+    DIGEST = 'msg:digest:%(owner)s:%(ctype)s:%(obj_id)s:%(action)s'  # 窗口内的合并消息(hash)
+    PENDING = 'msg:digest:pending'  # 有未写回计数的合并消息(zset)
+
+    # 计数加1, 窗口内的第一条消息设置过期时间, 之后的消息加入待写回集合
+    ADD_SCRIPT = MRedis.register_script("""
+        local count = redis.call('HINCRBY', KEYS[1], 'count', 1)
+        redis.call('HSET', KEYS[1], 'operator', ARGV[1])
+        if count == 1 then
+            redis.call('EXPIRE', KEYS[1], ARGV[2])
+        elseif not redis.call('ZSCORE', KEYS[2], KEYS[1]) then
+            redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+        end
+        return count
+    """)
+
+    # 记录已写回的计数, 期间没有新消息时移出待写回集合
+    DONE_SCRIPT = MRedis.register_script("""
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            redis.call('ZREM', KEYS[2], KEYS[1])
+            return 0
+        end
+        redis.call('HSET', KEYS[1], 'flushed', ARGV[1])
+        local count = tonumber(redis.call('HGET', KEYS[1], 'count') or 0)
+        if count <= tonumber(ARGV[1]) then
+            redis.call('ZREM', KEYS[2], KEYS[1])
+        end
+        return count
+    """)
+
+    @classmethod
+    def key(cls, owner_id, ctype, obj_id, action):
+        return cls.DIGEST % ({'owner': owner_id, 'ctype': ctype, 'obj_id': obj_id,
+                              'action': action})
+
+    @classmethod
+    def add(cls, owner_id, ctype, obj_id, action, operator_id):
+        """返回本条消息在窗口内的序号, 为1时需要创建消息
+        """
+        key = cls.key(owner_id, ctype, obj_id, action)
+        return cls.ADD_SCRIPT(keys=[key, cls.PENDING],
+                              args=[str(operator_id), const.MSG_DIGEST['window'], time.time()])
+
+    @classmethod
+    def bind(cls, owner_id, ctype, obj_id, action, msg_id):
+        MRedis.hset(cls.key(owner_id, ctype, obj_id, action), 'msg_id', str(msg_id))
+
+    @classmethod
+    def remove(cls, keys):
+        pipe = MRedis.pipeline(transaction=False)
+        pipe.delete(*keys)
+        pipe.zrem(cls.PENDING, *keys)
+        pipe.execute()
+
+    @classmethod
+    def flush(cls, num=1000):
+        """把待写回的计数和最后的操作用户写回数据库, 返回写回的消息数
+        """
+        keys = MRedis.zrange(cls.PENDING, 0, num - 1)
+        if not keys:
+            return 0
+        pipe = MRedis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        ops = list()
+        done = list()
+        for key, digest in zip(keys, pipe.execute()):
+            if not digest:
+                # 窗口已过期
+                MRedis.zrem(cls.PENDING, key)
+                continue
+            if not digest.get('msg_id'):
+                # 消息还未创建
+                continue
+            count = int(digest['count'])
+            ops.append(UpdateOne({'_id': ObjectId(digest['msg_id'])},
+                                 {'$set': {'count': count,
+                                           'operator': ObjectId(digest['operator']),
+                                           'update_at': time.time()}}))
+            done.append((key, count, digest['msg_id']))
+        if ops:
+            Message.collection.bulk_write(ops, ordered=False)
+        now = time.time()
+        for key, count, msg_id in done:
+            cls.DONE_SCRIPT(keys=[key, cls.PENDING], args=[count])
+            # 有新合并的消息移到收件箱最前
+            Inbox.add(key.split(':')[2], msg_id, now)
+        return len(ops)
+
+    @classmethod
+    def merge_pending(cls, msgs):
+        """合并窗口内还未写回数据库的计数
+        """
+        recent = [m for m in msgs if m.create_at > time.time() - const.MSG_DIGEST['window']]
+        if not recent:
+            return msgs
+        pipe = MRedis.pipeline(transaction=False)
+        for m in recent:
+            pipe.hmget(cls.key(str(m.owner), m.ctype, str(m.obj_id), m.action),
+                       'msg_id', 'count', 'operator')
+        for m, (msg_id, count, operator) in zip(recent, pipe.execute()):
+            if msg_id == str(m._id) and int(count) > (m.count or 1):
+                m.count = int(count)
+                m.operator = ObjectId(operator)
+        return msgs
+
+
+class Inbox(object):
+    """用户收件箱索引
+    点赞&评论消息按最后更新时间存入有序集合, 用于游标分页和未读数;
+    私信和个人系统消息的未读数在发送和阅读时增减
+    """
+    USER_INBOX = 'msg:inbox:%(uid)s'  # 点赞&评论消息id(zset), 分数为最后更新时间
+    USER_UNREAD = 'msg:unread:%(uid)s'  # 未读数(hash)
+
+    LETTER = 'letter'  # 私信
+    SYS = 'sys'  # 个人系统消息
+
+    @classmethod
+    @util.cached_zset(lambda cls, uid: cls.USER_INBOX % ({'uid': uid}), snowslide=True)
+    def _load_inbox(cls, uid):
+        msgs = Message.collection.find({'owner': ObjectId(uid)},
+                                       {'_id': 1, 'create_at': 1, 'update_at': 1})
+        ret = list()
+        for msg in msgs:
+            ret.extend([msg.get('update_at') or msg['create_at'], str(msg['_id'])])
+        return tuple(ret)
+
+    @classmethod
+    def add(cls, uid, msg_id, ts):
+        key = cls.USER_INBOX % ({'uid': uid})
+        try:
+            if Redis.exists(key):
+                Redis.zadd(key, ts, str(msg_id))
+        except exceptions.ResponseError:
+            Redis.delete(key)
+
+    @classmethod
+    def remove(cls, uid, msg_ids):
+        key = cls.USER_INBOX % ({'uid': uid})
+        try:
+            Redis.zrem(key, *msg_ids)
+        except exceptions.ResponseError:
+            Redis.delete(key)
+
+    @classmethod
+    def items(cls, uid, pagesize, cursor=None):
+        """按最后更新时间倒序分页: [(msg_id, ts), ...]
+        """
+        key = cls.USER_INBOX % ({'uid': uid})
+        return xcursor.zset_page(key, pagesize, cursor, load=lambda: cls._load_inbox(uid))
+
+    @classmethod
+    def message_count(cls, uid):
+        key = cls.USER_INBOX % ({'uid': uid})
+        if not Redis.exists(key):
+            cls._load_inbox(uid)
+        try:
+            return Redis.zcard(key)
+        except exceptions.ResponseError:
+            return 0
+
+    @classmethod
+    def incr(cls, uid, field, num):
+        key = cls.USER_UNREAD % ({'uid': uid})
+        # 私信未读数首次读取时从数据库统计, 之前不需要累加
+        if field == cls.LETTER and not Redis.hexists(key, field):
+            return
+        if Redis.hincrby(key, field, num) < 0:
+            Redis.hset(key, field, 0)
+
+    @classmethod
+    def reset(cls, uid, field):
+        Redis.hset(cls.USER_UNREAD % ({'uid': uid}), field, 0)
+
+    @classmethod
+    def unread(cls, uid):
+        """未读数: {'msgs': 点赞&评论消息数, 'letters': 私信数, 'sys_msgs': 个人系统消息数}
+        """
+        key = cls.USER_UNREAD % ({'uid': uid})
+        counts = Redis.hgetall(key)
+        if cls.LETTER not in counts:
+            counts[cls.LETTER] = Letter.collection.count({'owner': ObjectId(uid)})
+            Redis.hset(key, cls.LETTER, counts[cls.LETTER])
+        return {'msgs': cls.message_count(uid),
+                'letters': int(counts[cls.LETTER]),
+                'sys_msgs': int(counts.get(cls.SYS, 0))}
+
+
 class SysMessage(Document):
     """系统消息
     title: 标题
@@ -155,6 +350,8 @@ class SysMessage(Document):
     """
     collection = DB.sys_messages
 
+    FEED_VERSION = 'sysmsg:feed:version'  # 全站系统消息版本号, 修改后各进程重新加载
+
     def format(self):
         data = {
             'msg_id': str(self._id),
@@ -167,16 +364,18 @@ class SysMessage(Document):
         return data
 
     @classmethod
-    def sys_new_messages(cls, ts, cts):
+    def sys_new_messages(cls, ts, cts, active_only=True):
         """
         获取系统未读消息
         :param ts: 用户上次未读消息时间，用于过滤生效时间早于ts的消息
         :param cts: 当前时间，用于判断消息是否在有效期
+        :param active_only: 只返回已生效的消息, 为False时包含未到生效时间的消息
         :return:
         """
+        begin_at = {'$gte': ts or 0, '$lte': cts} if active_only else {'$gte': ts or 0}
         msgs = list(cls.collection.find(
             {
-                'begin_at': {'$gte': ts or 0, '$lte': cts},
+                'begin_at': begin_at,
                 'expire_at': {'$gte': cts},
                 'owner': {'$exists': False}
             }
@@ -184,6 +383,47 @@ class SysMessage(Document):
         msgs = [cls(msg) for msg in msgs]
         return msgs
 
+    def create_model(self):
+        _id = super(SysMessage, self).create_model()
+        if _id and not self.owner:
+            self.touch()
+        elif _id:
+            Inbox.incr(str(self.owner), Inbox.SYS, 1)
+        return _id
+
+    def update_model(self, data={}):
+        obj = super(SysMessage, self).update_model(data)
+        if not self.owner:
+            self.touch()
+        return obj
+
+    def delete_model(self):
+        ret = super(SysMessage, self).delete_model()
+        if not self.owner:
+            self.touch()
+        return ret
+
+    @classmethod
+    def touch(cls):
+        MRedis.incr(cls.FEED_VERSION)
+
+    @classmethod
+    def feed_messages(cls, ts, cts, os, version_code, channels, province, uid=None):
+        """从进程内的系统消息快照中获取符合条件(平台、渠道、版本、省份、用户组、有效期)的新消息
+        :param ts: 用户上次未读消息时间，用于过滤生效时间早于ts的消息
+        :param cts: 当前时间，用于判断消息是否在有效期
+        """
+        ret = list()
+        for msg in SysMessageFeed.current().segment(os, version_code, channels, province):
+            if msg.begin_at > cts or msg.begin_at < (ts or 0):
+                continue
+            if msg.expire_at < cts:
+                continue
+            if msg.login == 'login' and (not uid or not cls.user_in_group(str(msg.group), uid)):
+                continue
+            ret.append(msg)
+        return ret
+
     @classmethod
     def sys_user_messages(cls, ts, uid):
         msgs = list(cls.collection.find(
@@ -208,6 +448,54 @@ class SysMessage(Document):
             return not _is_in_group
 
 
+class SysMessageFeed(object):
+    """全站系统消息快照
+    快照包含所有未过期的系统消息(按生效时间倒序), 并按(平台, 版本, 渠道, 省份)缓存符合条件的消息;
+    每隔CHECK_INTERVAL秒检查一次版本号, 版本号变化或超过MAX_AGE秒时重新加载
+    """
+    CHECK_INTERVAL = 2
+    MAX_AGE = 300
+
+    _snapshot = None
+    _checked_at = 0
+
+    def __init__(self, version):
+        self.version = version
+        self.loaded_at = time.time()
+        self.messages = SysMessage.sys_new_messages(0, self.loaded_at, active_only=False)
+        self.segments = dict()
+
+    @classmethod
+    def current(cls):
+        now = time.time()
+        snapshot = cls._snapshot
+        if snapshot and now - cls._checked_at < cls.CHECK_INTERVAL:
+            return snapshot
+        cls._checked_at = now
+        version = MRedis.get(SysMessage.FEED_VERSION)
+        if not snapshot or snapshot.version != version or now - snapshot.loaded_at > cls.MAX_AGE:
+            snapshot = cls._snapshot = cls(version)
+        return snapshot
+
+    def segment(self, os, version_code, channels, province):
+        key = (os, version_code, channels, province)
+        if key not in self.segments:
+            msgs = list()
+            for msg in self.messages:
+                if msg.os and msg.os not in ['all', os]:
+                    continue
+                if (msg.version_code_mix and msg.version_code_mix > version_code) or \
+                        (msg.version_code_max and msg.version_code_max < version_code):
+                    continue
+                if channels and msg.channels and channels not in msg.channels:
+                    continue
+                if msg.province and (not province or province not in msg.province):
+                    continue
+                msgs.append(msg)
+            self.segments[key] = msgs
+        return self.segments[key]
+
+
 class Letter(Document):
     """私信
     owner: 私信所有者
@@ -235,6 +523,7 @@ class Letter(Document):
             channel = User.USER_ASYNC_MSG % ({'uid': str(self.owner)})
             letter = dict(obj_type='Letter', obj_id=str(_id), count=1)
             MRedis.publish(channel, json.dumps(letter))
+            Inbox.incr(str(self.owner), Inbox.LETTER, 1)
 
         return _id
 
@@ -273,6 +562,8 @@ class Letter(Document):
                 'create_at': {'$lte': ts}
             }
         )
+        if ret.deleted_count:
+            Inbox.incr(uid, Inbox.LETTER, -ret.deleted_count)
         return ret.deleted_count
 
 
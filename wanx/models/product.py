@@ -114,11 +114,11 @@ class Product(BaseModel):
             return const.ORDER_FINISHED
         elif self.product_type == GEM:  # 游票
             uc = UserCredit.get_or_create_user_credit(user_id)
-            uc.add_gem(num, action)
+            uc.add_gem(num, action, extra.get('op_key'))
             return const.ORDER_FINISHED
         elif self.product_type == GOLD:  # 游米
             uc = UserCredit.get_or_create_user_credit(user_id)
-            uc.add_gold(num, action)
+            uc.add_gold(num, action, extra.get('op_key'))
             return const.ORDER_FINISHED
         elif self.product_type == GIFT:  # 礼物
             up = UserProduct.get_or_create_user_product(user_id, self.product_id,
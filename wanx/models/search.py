@@ -0,0 +1,155 @@
+# -*- coding: utf8 -*-
+from wanx.base import const
+from wanx.base.cachedict import CacheDict
+from wanx.base.xpinyin import Pinyin
+from wanx.base.xredis import Redis
+from wanx.models.activity import ActivityVideo
+from wanx.models.game import Game
+from wanx.models.user import User
+from wanx.models.video import Video
+
+import cPickle as cjson
+import datetime
+import hashlib
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return str(value)
+
+
+def normalize(keyword):
+    """统一关键字: 去除首尾空白、合并连续空白并转为小写
+    """
+    keyword = keyword or u''
+    if not isinstance(keyword, unicode):
+        keyword = keyword.decode('utf8', 'ignore')
+    return u' '.join(keyword.split()).lower()
+
+
+class SearchCache(object):
+    """搜索结果缓存
+    只缓存搜索到的id列表, 缓存key包含搜索索引的版本号, 文档增删改或索引重建后旧缓存自动失效;
+    版本号每秒最多递增一次, 同一秒内后续修改的文档最迟在缓存过期(const.SEARCH['cache_expire'])后搜索到
+    """
+    RESULT_IDS = 'search:cache:%(stype)s:%(digest)s'
+
+    @classmethod
+    def _searcher(cls, stype, args):
+        """搜索类型对应的(搜索函数, 依赖的索引)
+        """
+        if stype == 'user':
+            return User.search, [User.SEARCH_INDEX]
+        elif stype == 'live_number':
+            return User.search_live_number, [User.LIVE_SEARCH_INDEX]
+        elif stype == 'game':
+            return Game.search, [Game.SEARCH_INDEX]
+        elif stype == 'video':
+            return Video.search, [Video.SEARCH_INDEX]
+        elif stype == 'activity_video':
+            return ActivityVideo.search, [ActivityVideo.search_index(args[0])]
+        raise ValueError(stype)
+
+    @classmethod
+    def _key(cls, stype, keyword, args, indexes):
+        versions = Redis.mget([index.version_key for index in indexes])
+        raw = '|'.join([_utf8(keyword)] + [_utf8(a) for a in args] +
+                       [v or '0' for v in versions])
+        return cls.RESULT_IDS % ({'stype': stype, 'digest': hashlib.md5(raw).hexdigest()})
+
+    @classmethod
+    def search_ids(cls, stype, keyword, *args, **kwargs):
+        """获取搜索结果id列表
+        stype: user|live_number|game|video|activity_video
+        args: 搜索函数的其他参数(如game的ua_filter, activity_video的activity_id)
+        refresh: 忽略已有缓存重新搜索
+        """
+        keyword = normalize(keyword)
+        search, indexes = cls._searcher(stype, args)
+        key = cls._key(stype, keyword, args, indexes)
+        if not kwargs.get('refresh'):
+            ids = Redis.get(key)
+            if ids:
+                return cjson.loads(ids)
+        ids = list(search(keyword, *args))
+        Redis.setex(key, const.SEARCH['cache_expire'], cjson.dumps(ids, 2))
+        return ids
+
+
+class HotKeyword(object):
+    """搜索热词
+    """
+    HOT_KEYWORDS = 'search:hot:%(date)s'  # 每天各关键字的搜索次数
+
+    CACHED_HOTS = CacheDict(max_len=1, max_age_seconds=10)
+
+    @classmethod
+    def _daily_key(cls, days=0):
+        date = datetime.date.today() - datetime.timedelta(days=days)
+        return cls.HOT_KEYWORDS % ({'date': date.strftime('%Y%m%d')})
+
+    @classmethod
+    def record(cls, keyword):
+        keyword = normalize(keyword)
+        if not keyword or len(keyword) > const.SEARCH['max_keyword_len']:
+            return
+        key = cls._daily_key()
+        pipe = Redis.pipeline(transaction=False)
+        pipe.zincrby(key, keyword.encode('utf8'), 1)
+        pipe.expire(key, 2 * 24 * 60 * 60)
+        pipe.execute()
+
+    @classmethod
+    def top_keywords(cls, num=None):
+        """今天和昨天搜索次数最多的关键字
+        返回: [(keyword, count), ...]
+        """
+        num = num or const.SEARCH['hot_num']
+        counts = dict()
+        for days in [0, 1]:
+            for kw, count in Redis.zrevrange(cls._daily_key(days), 0, num - 1, withscores=True):
+                counts[kw] = counts.get(kw, 0) + count
+        hots = sorted(counts.iteritems(), key=lambda x: x[1], reverse=True)[:num]
+        return [(kw.decode('utf8'), int(count)) for kw, count in hots]
+
+    @classmethod
+    def _hot_keywords(cls):
+        """本地缓存的热词及其拼音: [(keyword, pinyin, initials), ...]
+        """
+        hots = cls.CACHED_HOTS.get('hots')
+        if hots is not None:
+            return hots
+        pinyin = Pinyin.shared()
+        hots = [(kw, pinyin.get_pinyin(kw, u'').lower(), pinyin.get_initials(kw, u'').lower())
+                for kw, _ in cls.top_keywords()]
+        cls.CACHED_HOTS['hots'] = hots
+        return hots
+
+    @classmethod
+    def suggest(cls, prefix, num=10):
+        """按热度返回以prefix开头(支持拼音和首字母)的热词
+        """
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        ret = list()
+        for kw, py, initials in cls._hot_keywords():
+            if kw.startswith(prefix) or py.startswith(prefix) or initials.startswith(prefix):
+                ret.append(kw)
+                if len(ret) >= num:
+                    break
+        return ret
+
+    @classmethod
+    def prefetch(cls, num=None):
+        """预先搜索热词, 刷新搜索结果缓存
+        """
+        num = num or const.SEARCH['prefetch_num']
+        keywords = [kw for kw, _ in cls.top_keywords(num)]
+        for kw in keywords:
+            SearchCache.search_ids('user', kw, refresh=True)
+            SearchCache.search_ids('live_number', kw, refresh=True)
+            SearchCache.search_ids('game', kw, None, refresh=True)
+            SearchCache.search_ids('video', kw, refresh=True)
+        return len(keywords)
@@ -67,6 +67,7 @@ class ShowChannel(Document):
     栏目频道
     """
     collection = DB.show_channels
+    COUNTER_FIELDS = ('play_count',)
     SHOW_CHANNEL_IDS = 'show:channel:%(sid)s'
 
     def format(self):
@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+from wanx.base import const
+from wanx.base.xredis import Redis
+
+import datetime
+import time
+
+
+class UniqueStats(object):
+    """去重访问统计
+    按天记录到HyperLogLog, 每个key最多占用12KB, 误差约0.81%;
+    按周&月统计时合并多天的记录, 已结束的时间段合并结果缓存到Redis
+    """
+    DAILY_KEY = 'stats:uv:%(target)s:%(day)s'  # 每天的去重统计(HyperLogLog)
+    MERGED_KEY = 'stats:uv:%(target)s:%(begin)s-%(end)s'  # 多天合并的去重统计(HyperLogLog)
+
+    VISIT = 'visit'  # 每日活跃设备
+    VIDEO = 'video:%s'  # 视频观看用户
+    LIVE = 'live:%s'  # 直播间观看用户
+    ACTIVITY = 'activity:%s'  # 活动访问用户
+
+    @classmethod
+    def day(cls, ts=None):
+        return datetime.date.fromtimestamp(ts or time.time()).strftime('%Y%m%d')
+
+    @classmethod
+    def days(cls, begin, end):
+        """begin, end: datetime.date, 包含结束日期
+        """
+        return [(begin + datetime.timedelta(days=i)).strftime('%Y%m%d')
+                for i in xrange((end - begin).days + 1)]
+
+    @classmethod
+    def record(cls, target, member, ts=None):
+        if not member:
+            return
+        key = cls.DAILY_KEY % ({'target': target, 'day': cls.day(ts)})
+        pipe = Redis.pipeline(transaction=False)
+        pipe.pfadd(key, str(member))
+        pipe.expire(key, const.UNIQUE_STATS['ttl'])
+        pipe.execute()
+
+    @classmethod
+    def daily(cls, target, begin, end):
+        """每天的去重数: [(day, count), ...]
+        """
+        days = cls.days(begin, end)
+        pipe = Redis.pipeline(transaction=False)
+        for day in days:
+            pipe.pfcount(cls.DAILY_KEY % ({'target': target, 'day': day}))
+        return zip(days, pipe.execute())
+
+    @classmethod
+    def count(cls, target, begin, end):
+        """时间段内的去重数, 包含结束日期
+        """
+        days = cls.days(begin, end)
+        keys = [cls.DAILY_KEY % ({'target': target, 'day': day}) for day in days]
+        if len(keys) == 1 or days[-1] >= cls.day():
+            # 包含今天时数据还在变化, 每次合并计算
+            return Redis.pfcount(*keys)
+
+        merged = cls.MERGED_KEY % ({'target': target, 'begin': days[0], 'end': days[-1]})
+        if not Redis.exists(merged):
+            pipe = Redis.pipeline(transaction=False)
+            pipe.pfmerge(merged, *keys)
+            pipe.expire(merged, const.UNIQUE_STATS['ttl'])
+            pipe.execute()
+        return Redis.pfcount(merged)
+
+    @classmethod
+    def week(cls, target, date):
+        """date所在自然周(周一开始)的去重数
+        """
+        begin = date - datetime.timedelta(days=date.weekday())
+        return cls.count(target, begin, begin + datetime.timedelta(days=6))
+
+    @classmethod
+    def month(cls, target, date):
+        """date所在自然月的去重数
+        """
+        begin = date.replace(day=1)
+        end = (begin + datetime.timedelta(days=32)).replace(day=1) - datetime.timedelta(days=1)
+        return cls.count(target, begin, end)
@@ -3,9 +3,10 @@ from urlparse import urljoin
 from playhouse.shortcuts import model_to_dict, dict_to_model
 from wanx import app
 from wanx.base import util, const
+from wanx.base.cachedict import CacheDict
 from wanx.base.xmysql import MYDB
 from wanx.base.xredis import Redis, MRedis
-from wanx.models import BaseModel
+from wanx.models import BaseModel, counters_done
 from wanx.models.game import Game, GameActivity
 from wanx.models.credit import UserCredit
 from wanx.models.product import Product
@@ -19,6 +20,8 @@ import json
 
 TASK_KEY = 'task:all'
 USER_TASK_KEY = 'task:user:%s'
+USER_TASK_PROGRESS_KEY = 'task:progress:%s'  # 用户任务未写回数据库的进度(hash)
+TASK_PROGRESS_DIRTY_KEY = 'task:progress:dirty'  # 有未写回进度的用户(set)
 
 NOVICE_TASK = 1
 DAILY_TASK = 2
@@ -82,6 +85,9 @@ TASK_PLATFORMS = (
     (IOS_ONLY, u'IOS'),
 )
 
+CACHED_ACTION_TASKS = CacheDict(max_len=1, max_age_seconds=10)
+
+
 class Task(BaseModel):
     task_id = pw.PrimaryKeyField(verbose_name='任务ID')
     title = pw.CharField(max_length=64, verbose_name='任务标题')
@@ -126,6 +132,18 @@ class Task(BaseModel):
         tasks = filter(lambda x: x.task_id == task_id, cls.get_all_tasks())
         return tasks[0] if tasks else None
 
+    @classmethod
+    def action_tasks(cls, action):
+        """按任务条件索引的任务列表, 在进程内缓存
+        """
+        actions = CACHED_ACTION_TASKS.get('actions')
+        if actions is None:
+            actions = dict()
+            for task in cls.get_all_tasks():
+                actions.setdefault(task.action, []).append(task)
+            CACHED_ACTION_TASKS['actions'] = actions
+        return actions.get(action, [])
+
     @classmethod
     def get_novice_tasks(cls):
         tasks = filter(lambda x: x.task_type == NOVICE_TASK, cls.get_all_tasks())
@@ -191,6 +209,11 @@ class UserTask(BaseModel):
             utasks = cjson.loads(utasks)
 
         utasks = [dict_to_model(UserTask, utask) for utask in utasks]
+        # 合并未写回数据库的进度
+        progress = Redis.hgetall(USER_TASK_PROGRESS_KEY % (user_id))
+        for utask in utasks:
+            if utask.task_status == UNFINISHED and str(utask.task_id) in progress:
+                utask.finish_num += int(progress[str(utask.task_id)])
         return utasks
 
     @classmethod
@@ -225,93 +248,65 @@ class UserTask(BaseModel):
         cls.delete_removed_tasks(user_id)
 
         uc = UserCredit.get_or_create_user_credit(user_id)
-        # 刷新每日任务
+        # 刷新每日任务(凌晨由refresh_daily_tasks.py批量刷新, 这里处理未刷新到的用户)
         if uc.task_at.date() < datetime.date.today():
             UserTask.refresh_daily_tasks(user_id)
-        # 如果没有活动任务创建活动任务
-        # if not UserTask.get_activity_tasks(user_id):
-        # 检查并更新活动任务
-        UserTask.init_tasks(user_id, ACTIVITY_TASK)
-        # 检查并更新新手任务
-        UserTask.init_tasks(user_id, NOVICE_TASK)
-        # 检查并更新游戏任务
-        UserTask.init_tasks(user_id, GAME_TASK)
+        # 检查并补充活动任务、新手任务和游戏任务, 缓存中已有全部任务时不再查询数据库
+        task_types = (ACTIVITY_TASK, NOVICE_TASK, GAME_TASK)
+        exists = set(utask.task_id for utask in cls.get_user_tasks(user_id))
+        if any(task.task_type in task_types and task.task_id not in exists
+               for task in Task.get_all_tasks()):
+            UserTask.init_tasks(user_id, task_types)
 
     @classmethod
-    def init_tasks(cls, user_id, task_type=None):
-        _tasks = []
-        if task_type == ACTIVITY_TASK:
-            for task in Task.get_activity_tasks():
-                # 去重
-                exists = cls.select().where(cls.user_id == user_id, cls.task_id ==task.task_id).count()
-                if exists:
-                    continue
-                tmp = dict(user_id=user_id, task_id=task.task_id,
-                           task_type=task.task_type, action=task.action)
-                _tasks.append(tmp)
-            if _tasks:
-                UserTask.insert_many(_tasks).execute()
-            key = USER_TASK_KEY % (user_id)
-            Redis.delete(key)
-            return
-
-        if task_type == NOVICE_TASK:
-            for task in Task.get_novice_tasks():
-                # 去重
-                exists = cls.select().where(cls.user_id == user_id, cls.task_id ==task.task_id).count()
-                if exists:
-                    continue
-                tmp = dict(user_id=user_id, task_id=task.task_id,
-                           task_type=task.task_type, action=task.action)
-                _tasks.append(tmp)
-            if _tasks:
-                UserTask.insert_many(_tasks).execute()
-            key = USER_TASK_KEY % (user_id)
-            Redis.delete(key)
-            return
-
-        if task_type == GAME_TASK:
-            for task in Task.get_game_tasks():
-                # 去重
-                exists = cls.select().where(cls.user_id == user_id, cls.task_id ==task.task_id).count()
-                if exists:
-                    continue
-                tmp = dict(user_id=user_id, task_id=task.task_id,
-                           task_type=task.task_type, action=task.action)
-                _tasks.append(tmp)
-            if _tasks:
-                UserTask.insert_many(_tasks).execute()
-            key = USER_TASK_KEY % (user_id)
-            Redis.delete(key)
-            return
-
-        for task in Task.get_all_tasks():
+    def _task_rows(cls, user_id, tasks, signin=False):
+        rows = []
+        for task in tasks:
             tmp = dict(user_id=user_id, task_id=task.task_id,
                        task_type=task.task_type, action=task.action)
             # 每日签到任务自动完成
-            if task.action == DAILY_SIGNIN:
+            if signin and task.action == DAILY_SIGNIN:
                 tmp['task_status'] = FINISHED
                 tmp['finish_num'] = 1
-            _tasks.append(tmp)
+            rows.append(tmp)
+        return rows
 
-        if _tasks:
-            UserTask.insert_many(_tasks).execute()
+    @classmethod
+    def init_tasks(cls, user_id, task_type=None):
+        """补充用户缺少的任务, 一次查询已有任务后批量插入
+        task_type: 任务类型或任务类型列表, 为None时初始化新用户的全部任务
+        """
+        if task_type is None:
+            _tasks = cls._task_rows(user_id, Task.get_all_tasks(), signin=True)
+            if _tasks:
+                UserTask.insert_many(_tasks).execute()
+            return
+
+        task_types = task_type if isinstance(task_type, (list, tuple)) else (task_type, )
+        # 去重
+        exists = set(utask.task_id for utask in
+                     cls.select(cls.task_id).where(cls.user_id == user_id))
+        tasks = [task for task in Task.get_all_tasks()
+                 if task.task_type in task_types and task.task_id not in exists]
+        if tasks:
+            UserTask.insert_many(cls._task_rows(user_id, tasks)).execute()
+        key = USER_TASK_KEY % (user_id)
+        Redis.delete(key)
 
     @classmethod
     def refresh_daily_tasks(cls, user_id):
-        _tasks = []
-        for task in Task.get_daily_tasks():
-            tmp = dict(user_id=user_id, task_id=task.task_id,
-                       task_type=task.task_type, action=task.action)
-            # 每日签到任务自动完成
-            if task.action == DAILY_SIGNIN:
-                tmp['task_status'] = FINISHED
-                tmp['finish_num'] = 1
-            _tasks.append(tmp)
+        _tasks = cls._task_rows(user_id, Task.get_daily_tasks(), signin=True)
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
 
         with MYDB.atomic():
+            # 与bulk_refresh_daily_tasks相同, 先锁定user_credit再修改user_task, 今天已刷新过时跳过
+            locked = UserCredit.select(UserCredit.user_id).where(
+                UserCredit.user_id == user_id, UserCredit.task_at < today).for_update()
+            if not list(locked):
+                return
             # 删除旧的每日任务
-            cls.delete().where(UserTask.user_id == user_id, UserTask.task_type == 2).execute()
+            cls.delete().where(UserTask.user_id == user_id,
+                               UserTask.task_type == DAILY_TASK).execute()
             # 增加新的每日任务
             if _tasks:
                 UserTask.insert_many(_tasks).execute()
@@ -320,59 +315,142 @@ class UserTask(BaseModel):
                 task_at=datetime.datetime.now()
             ).where(UserCredit.user_id == user_id).execute()
 
-        key = USER_TASK_KEY % (user_id)
-        Redis.delete(key)
+        cls._clear_daily_progress([user_id])
+
+    @classmethod
+    def _clear_daily_progress(cls, user_ids):
+        # 旧的每日任务进度作废
+        task_ids = [task.task_id for task in Task.get_daily_tasks()]
+        pipe = Redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            if task_ids:
+                pipe.hdel(USER_TASK_PROGRESS_KEY % (user_id), *task_ids)
+            pipe.delete(USER_TASK_KEY % (user_id))
+        pipe.execute()
+
+    @classmethod
+    def bulk_refresh_daily_tasks(cls, user_ids):
+        """批量刷新用户的每日任务, 返回刷新的用户数
+        在一个事务中按用户集合删除旧任务, 再用INSERT ... SELECT生成新任务, 已在今天刷新过的用户跳过
+        """
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        with MYDB.atomic():
+            # 锁定未刷新的用户, 避免与用户请求中的刷新重复
+            user_ids = [uc.user_id for uc in UserCredit.select(UserCredit.user_id).where(
+                UserCredit.user_id << list(user_ids), UserCredit.task_at < today
+            ).order_by(UserCredit.user_id).for_update()]
+            if not user_ids:
+                return 0
+
+            cls.delete().where(cls.user_id << user_ids, cls.task_type == DAILY_TASK).execute()
+            query = UserCredit.select(
+                UserCredit.user_id, Task.task_id, Task.task_type, Task.action,
+                pw.fn.IF(Task.action == DAILY_SIGNIN, 1, 0),
+                pw.fn.IF(Task.action == DAILY_SIGNIN, FINISHED, UNFINISHED)
+            ).join(Task, on=(Task.task_type == DAILY_TASK)).where(UserCredit.user_id << user_ids)
+            cls.insert_from([cls.user_id, cls.task_id, cls.task_type, cls.action,
+                             cls.finish_num, cls.task_status], query).execute()
+            UserCredit.update(
+                task_at=datetime.datetime.now()
+            ).where(UserCredit.user_id << user_ids).execute()
+
+        cls._clear_daily_progress(user_ids)
+        return len(user_ids)
+
+    @classmethod
+    def _match_task(cls, task, game_id, activity_id):
+        if task.task_type == GAME_TASK and task.game_id != game_id:
+            return False
+
+        # 如果任务类型为活动任务且任务的活动ID已配置，则需要检查game_id是否在活动的game_id下
+        if task.task_type == ACTIVITY_TASK and task.activity_id:
+            # 如果活动ID不一致，则不计任务
+            if activity_id != str(task.activity_id):
+                return False
+            gids = GameActivity.game_activity_ids(task.activity_id)
+            # 如果游戏ID不在活动范围内，则不完成任务
+            if gids and game_id not in gids:
+                return False
+        return True
 
     @classmethod
     def check_user_tasks(cls, user_id, action, action_num=1, game_id=None, activity_id=None):
-        user_tasks = filter(lambda x: x.action == action and x.task_status == UNFINISHED,
+        """用户行为只分发给以该行为为条件的任务, 进度先记录在Redis中,
+        任务完成时立即写入数据库, 未完成的进度由定时任务(runtimedtasks.py)批量写回
+        """
+        user_id = str(user_id)
+        tasks = dict((task.task_id, task) for task in Task.action_tasks(action)
+                     if cls._match_task(task, game_id, activity_id))
+        if not tasks:
+            return
+
+        user_tasks = filter(lambda x: x.task_id in tasks and x.task_status == UNFINISHED,
                             cls.get_user_tasks(user_id))
+        if not user_tasks:
+            return
 
+        key = USER_TASK_PROGRESS_KEY % (user_id)
+        pipe = Redis.pipeline(transaction=False)
         for utask in user_tasks:
-            task = Task.get(Task.task_id == utask.task_id)
-            # 如果基本任务已被删除，则删除用户任务
-            if not task:
-                utask.delete_instance()
-                continue
-
-            if task.task_type == GAME_TASK and task.game_id != game_id:
+            pipe.hincrby(key, utask.task_id, action_num)
+        pipe.sadd(TASK_PROGRESS_DIRTY_KEY, user_id)
+        pending = pipe.execute()[:-1]
+
+        for utask, num in zip(user_tasks, pending):
+            task = tasks[utask.task_id]
+            # get_user_tasks已合并本次之前的进度
+            if utask.finish_num + action_num < task.num:
                 continue
-
-            # 如果任务类型为活动任务且任务的活动ID已配置，则需要检查game_id是否在活动的game_id下
-            if task.task_type == ACTIVITY_TASK and task.activity_id:
-                # 如果活动ID不一致，则不计任务
-                if activity_id != str(task.activity_id):
-                    continue
-                gids = GameActivity.game_activity_ids(task.activity_id)
-                # 如果游戏ID不在活动范围内，则不完成任务
-                if gids and game_id not in gids:
-                    continue
-
-            utask.finish_num += action_num
-            # 任务完成
-            if utask.finish_num >= task.num:
-                utask.task_status = FINISHED
+            # 任务完成, 写入数据库
+            done = cls.update(
+                finish_num=cls.finish_num + num, task_status=FINISHED
+            ).where(cls.user_id == user_id, cls.task_id == utask.task_id,
+                    cls.task_status == UNFINISHED).execute()
+            counters_done(key, USER_TASK_KEY % (user_id), TASK_PROGRESS_DIRTY_KEY, user_id,
+                          {utask.task_id: num})
+            if done:
                 # 发送任务完成消息到队列
-                channel = User.USER_ASYNC_MSG % ({'uid': str(user_id)})
+                channel = User.USER_ASYNC_MSG % ({'uid': user_id})
                 msg = dict(obj_type='Task', obj_id=utask.task_id, count=1)
                 MRedis.publish(channel, json.dumps(msg))
 
-            utask.save()
-        # 删除用户任务缓存
-        if len(user_tasks) > 0:
-            key = USER_TASK_KEY % (user_id)
-            Redis.delete(key)
+    @classmethod
+    def flush_progress(cls, num=500):
+        """把未完成任务的进度批量写回数据库, 返回写回的用户数
+        """
+        user_ids = Redis.srandmember(TASK_PROGRESS_DIRTY_KEY, num)
+        if not user_ids:
+            return 0
+        pipe = Redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.hgetall(USER_TASK_PROGRESS_KEY % (user_id))
+        progress = zip(user_ids, pipe.execute())
+
+        with MYDB.atomic():
+            for user_id, tasks in progress:
+                for task_id, n in tasks.iteritems():
+                    if int(n) <= 0:
+                        continue
+                    cls.update(
+                        finish_num=cls.finish_num + int(n)
+                    ).where(cls.user_id == user_id, cls.task_id == int(task_id),
+                            cls.task_status == UNFINISHED).execute()
+
+        pipe = Redis.pipeline(transaction=False)
+        for user_id, tasks in progress:
+            counters_done(USER_TASK_PROGRESS_KEY % (user_id), USER_TASK_KEY % (user_id),
+                          TASK_PROGRESS_DIRTY_KEY, user_id, tasks, client=pipe)
+        pipe.execute()
+        return len(user_ids)
 
     @classmethod
     def delete_removed_tasks(cls, user_id):
         # 删除任务已被移除的用户任务
-        need_to_delete = False
-        for utask in cls.get_user_tasks(user_id):
-            if Task.get_task(utask.task_id) is None:
-                utask.delete_instance()
-                need_to_delete = True
-
-        if need_to_delete:
+        task_ids = set(task.task_id for task in Task.get_all_tasks())
+        removed = [utask.task_id for utask in cls.get_user_tasks(user_id)
+                   if utask.task_id not in task_ids]
+        if removed:
+            cls.delete().where(cls.user_id == user_id, cls.task_id << removed).execute()
             key = USER_TASK_KEY % (user_id)
             Redis.delete(key)
 
@@ -409,7 +487,11 @@ class UserTask(BaseModel):
         with MYDB.atomic():
             self.task_status = RECEIVED
             self.save()
-            if product.add_product2user(self.user_id, task.product_num, const.TASK):
+            # 同一任务每天只发放一次奖励, 防止并发领取重复发放
+            op_key = 'task:%s:%s:%s' % (self.user_id, self.task_id,
+                                        datetime.date.today().strftime('%Y%m%d'))
+            if product.add_product2user(self.user_id, task.product_num, const.TASK,
+                                        {'op_key': op_key}):
                 rewards.append(dict(name=product.product_name, num=task.product_num))
 
         Redis.delete(key)
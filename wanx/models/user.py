@@ -18,11 +18,12 @@ from flask import request
 from redis import exceptions
 
 from wanx import app
-from wanx.base import util, const, error
+from wanx.base import util, const, error, xcursor, xsearch
 from wanx.base.cachedict import CacheDict
 from wanx.base.log import print_log
 from wanx.base.spam import Spam
 from wanx.base.util import cached_object
+from wanx.base.xpinyin import Pinyin
 from wanx.base.xmongo import DB
 from wanx.base.xredis import Redis, MRedis
 from wanx.models import Document
@@ -41,6 +42,9 @@ class User(Document):
     USER_ASYNC_MSG = 'async_msg:user:%(uid)s'  # 用户消息提醒队列
     LIVE_NUMBER = 'live:number'
 
+    SEARCH_INDEX = xsearch.SearchIndex('user', pinyin=True)  # 昵称搜索索引
+    LIVE_SEARCH_INDEX = xsearch.SearchIndex('user_live')  # 直播间房号搜索索引
+
     def format(self, exclude_fields=[], include_fields=[]):
         uid = str(self._id)
         binding = dict(
@@ -152,9 +156,45 @@ class User(Document):
         while self.invalid_nickname(self.nickname):
             self.nickname = self.random_nickname()
 
+        self.nickpy, self.nick_initials = self.nickname_pinyin(self.nickname)
         _id = super(User, self).create_model()
+        if _id:
+            self.update_search_index()
         return _id
 
+    def update_model(self, data={}):
+        fields = data.get('$set', {}) if data else {}
+        if 'nickname' in fields:
+            fields['nickpy'], fields['nick_initials'] = self.nickname_pinyin(fields['nickname'])
+        obj = super(User, self).update_model(data)
+        if obj and ('nickname' in fields or 'live' in fields):
+            obj.update_search_index()
+        return obj
+
+    def delete_model(self):
+        ret = super(User, self).delete_model()
+        if ret:
+            self.SEARCH_INDEX.remove(self._id)
+            self.LIVE_SEARCH_INDEX.remove(self._id)
+        return ret
+
+    @staticmethod
+    def nickname_pinyin(nickname):
+        """昵称的全拼和首字母(小写), 随昵称一起保存用于排序
+        """
+        nickname = nickname or u''
+        if not isinstance(nickname, unicode):
+            nickname = nickname.decode('utf8', 'ignore')
+        pinyin = Pinyin.shared()
+        return pinyin.get_pinyin(nickname, u'').lower(), \
+            pinyin.get_initials(nickname, u'').lower()
+
+    def update_search_index(self):
+        create_at = self.create_at or 0
+        self.SEARCH_INDEX.add(self._id, self.nickname, create_at)
+        if self.live and 'str' in self.live:
+            self.LIVE_SEARCH_INDEX.add(self._id, self.live['str'], create_at)
+
     @classmethod
     def init(cls):
         doc = super(User, cls).init()
@@ -206,6 +246,9 @@ class User(Document):
 
     @classmethod
     def search(cls, keyword):
+        if cls.SEARCH_INDEX.ready():
+            return [ObjectId(uid) for uid in cls.SEARCH_INDEX.search(keyword)]
+
         ids = cls.collection.find(
             {
                 'nickname': {'$regex': keyword, '$options': 'i'}
@@ -217,6 +260,9 @@ class User(Document):
 
     @classmethod
     def search_live_number(cls, keyword):
+        if cls.LIVE_SEARCH_INDEX.ready():
+            return [ObjectId(uid) for uid in cls.LIVE_SEARCH_INDEX.search(keyword)]
+
         ids = cls.collection.find(
             {
                 'live.str': {'$regex': keyword, '$options': 'i'}
@@ -653,7 +699,11 @@ class FriendShip(Document):
 
             # 更新用户粉丝数量
             user = User.get_one(str(self.target), check_online=False)
-            user.update_model({'$inc': {'follower_count': 1}})
+            user = user.update_model({'$inc': {'follower_count': 1}})
+
+            from wanx.models.video import FollowingTimeline
+            FollowingTimeline.update_celebrity(str(self.target), user.follower_count)
+            FollowingTimeline.invalidate(str(self.source))
 
             key = self.FOLLOWER_IDS % ({'uid': str(self.target)})
             try:
@@ -687,7 +737,11 @@ class FriendShip(Document):
 
             # 更新用户粉丝数量
             user = User.get_one(str(self.target), check_online=False)
-            user.update_model({'$inc': {'follower_count': -1}})
+            user = user.update_model({'$inc': {'follower_count': -1}})
+
+            from wanx.models.video import FollowingTimeline
+            FollowingTimeline.update_celebrity(str(self.target), user.follower_count)
+            FollowingTimeline.invalidate(str(self.source))
 
             key = self.FOLLOWER_IDS % ({'uid': str(self.target)})
             try:
@@ -749,6 +803,11 @@ class FriendShip(Document):
             ids = []
         return list(ids)
 
+    @classmethod
+    def follower_items(cls, uid, pagesize, cursor=None):
+        key = cls.FOLLOWER_IDS % ({'uid': uid})
+        return xcursor.zset_page(key, pagesize, cursor, lambda: cls._load_follower_ids(uid))
+
     @classmethod
     def follower_count(cls, uid):
         key = cls.FOLLOWER_IDS % ({'uid': uid})
@@ -1036,41 +1095,92 @@ class UserGroup(Document):
     """
     collection = DB.user_group
 
-    GROUP_UIDS = 'users:group:%(gid)s'
+    GROUP_UIDS = 'users:group:set:%(gid)s'  # 用户组成员集合
+
+    BULK_SIZE = 1000  # 批量导入时每批写入数量
+
+    @classmethod
+    def _add_member(cls, gid, uid):
+        key = cls.GROUP_UIDS % ({'gid': str(gid)})
+        try:
+            if Redis.exists(key):
+                Redis.sadd(key, str(uid))
+        except exceptions.ResponseError:
+            Redis.delete(key)
+
+    @classmethod
+    def _remove_member(cls, gid, uid):
+        key = cls.GROUP_UIDS % ({'gid': str(gid)})
+        try:
+            Redis.srem(key, str(uid))
+        except exceptions.ResponseError:
+            Redis.delete(key)
+
+    @classmethod
+    def _release_member(cls, gid, uid):
+        # 同一用户可能被重复加入同一分组, 仍有记录时保留成员
+        if not cls.collection.find_one({'group': ObjectId(str(gid)), 'user': ObjectId(str(uid))},
+                                       {'_id': 1}):
+            cls._remove_member(gid, uid)
 
     def create_model(self):
         _id = super(UserGroup, self).create_model()
         if _id:
-            key = self.GROUP_UIDS % ({'gid': str(self.group)})
-            Redis.delete(key)
+            self._add_member(self.group, self.user)
 
         return _id
 
     def update_model(self, data={}):
         ret = super(UserGroup, self).update_model(data)
         if ret:
-            key = self.GROUP_UIDS % ({'gid': str(self.group)})
-            Redis.delete(key)
+            # 从原分组中移除, 再加入新分组
+            self._release_member(self.group, self.user)
+            self._add_member(ret.group, ret.user)
 
         return ret
 
     def delete_model(self):
         ret = super(UserGroup, self).delete_model()
         if ret:
-            key = self.GROUP_UIDS % ({'gid': str(self.group)})
-            Redis.delete(key)
+            self._release_member(self.group, self.user)
 
         return ret
 
     @classmethod
-    @util.cached_list(lambda cls, gid: cls.GROUP_UIDS % ({'gid': gid}))
+    def bulk_create(cls, gid, users):
+        """批量加入用户组
+        users: [(uid, phone), ...]
+        """
+        total = 0
+        for i in xrange(0, len(users), cls.BULK_SIZE):
+            docs = list()
+            for uid, phone in users[i:i + cls.BULK_SIZE]:
+                doc = cls.init()
+                doc.group = ObjectId(str(gid))
+                doc.user = ObjectId(str(uid))
+                doc.phone = phone
+                docs.append(doc)
+            if not docs:
+                continue
+            cls.collection.insert_many(docs)
+            key = cls.GROUP_UIDS % ({'gid': str(gid)})
+            try:
+                if Redis.exists(key):
+                    Redis.sadd(key, *[str(d.user) for d in docs])
+            except exceptions.ResponseError:
+                Redis.delete(key)
+            total += len(docs)
+        return total
+
+    @classmethod
+    @util.cached_set(lambda cls, gid: cls.GROUP_UIDS % ({'gid': gid}), snowslide=True)
     def _load_group_uids(cls, gid):
-        users = list(cls.collection.find(
+        users = cls.collection.find(
             {'group': ObjectId(gid)},
-            {'user': 1, 'create_at': 1}
-        ))
-        uids = [str(u['user']) for u in users]
-        return uids
+            {'user': 1}
+        )
+        uids = set(str(u['user']) for u in users)
+        return tuple(uids)
 
     @classmethod
     def group_user_ids(cls, gid):
@@ -1078,7 +1188,7 @@ class UserGroup(Document):
         if not Redis.exists(key):
             cls._load_group_uids(gid)
         try:
-            uids = Redis.lrange(key, 0, -1)
+            uids = Redis.smembers(key)
         except exceptions.ResponseError:
             uids = []
 
@@ -1086,8 +1196,36 @@ class UserGroup(Document):
 
     @classmethod
     def user_in_group(cls, gid, uid):
-        uids = cls.group_user_ids(gid)
-        return str(uid) in uids
+        key = cls.GROUP_UIDS % ({'gid': gid})
+        if not Redis.exists(key):
+            cls._load_group_uids(gid)
+        try:
+            return Redis.sismember(key, str(uid))
+        except exceptions.ResponseError:
+            return False
+
+    @classmethod
+    def user_in_groups(cls, gids, uid):
+        """批量检查用户是否在多个用户组中
+        返回: {gid: True|False}
+        """
+        gids = list(set(str(gid) for gid in gids if gid))
+        if not gids:
+            return dict()
+        keys = [cls.GROUP_UIDS % ({'gid': gid}) for gid in gids]
+        pipe = Redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.exists(key)
+        for gid, exists in zip(gids, pipe.execute()):
+            if not exists:
+                cls._load_group_uids(gid)
+
+        pipe = Redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.sismember(key, str(uid))
+        # 空数据占位的key为string类型, sismember会返回ResponseError
+        rets = pipe.execute(raise_on_error=False)
+        return dict((gid, ret is True) for gid, ret in zip(gids, rets))
 
 
 class LiveAccount(Document):
@@ -7,11 +7,13 @@ from wanx.models import Document
 from wanx.models.comment import Comment, Reply
 from wanx.base.xredis import Redis
 from wanx.base.xmongo import DB
-from wanx.base import util, const
+from wanx.base import util, const, xcursor, xsearch
 from wanx.base.cachedict import CacheDict
 from wanx.base.log import print_log
 from wanx import app
 
+import heapq
+import math
 import pymongo
 import time
 import json
@@ -26,10 +28,12 @@ class Video(Document):
 
     CACHED_OBJS = CacheDict(max_len=100, max_age_seconds=5)
 
+    COUNTER_FIELDS = ('vv', 'like')
+
     GAME_VIDEO_IDS = "videos:game:%(gid)s"  # 游戏所有视频队列(<30除外)
-    GAME_HOTVIDEO_IDS = "videos:hotgame:%(date)s:%(gid)s"  # 游戏人气视频队列
-    GAME_NOLIVE_VIDEO_IDS = "videos:nolivegame:%(date)s:%(gid)s"  # 非直播回放人气视频队列
-    GAME_USERLIVE_VIDEO_IDS = "videos:userlivegame:%(date)s:%(uid)s:%(gid)s"  # 用户直播回放人气视频队列
+    GAME_HOTVIDEO_IDS = "videos:hot:game:%(gid)s"  # 游戏人气视频排行
+    GAME_NOLIVE_VIDEO_IDS = "videos:hot:nolive:%(gid)s"  # 非直播回放人气视频排行
+    GAME_USERLIVE_VIDEO_IDS = "videos:hot:userlive:%(uid)s:%(gid)s"  # 用户直播回放人气视频排行
     USER_VIDEO_IDS = "videos:user:%(uid)s"  # 用户创建视频队列
     USER_LIVE_VIDEO_IDS = "videos:live:user:%(uid)s"  # 用户直播转录播视频队列
     USER_GAME_VIDEO_IDS = "videos:user:%(uid)s:game:%(gid)s"  # 用户为某个游戏创建的视频队列
@@ -38,6 +42,8 @@ class Video(Document):
     GAME_ELITE_VIDEO_IDS = "videos:elite:game:%(gid)s"  # 某个游戏的精选视频队列
     SHOW_CHANNEL_VIDEO_IDS = "videos:show:channel:%(cid)s"  # 某个栏目频道视频列表
 
+    SEARCH_INDEX = xsearch.SearchIndex('video')  # 视频标题搜索索引(<30除外)
+
     def format(self, exclude_fields=[]):
         from wanx.models.user import User
         from wanx.models.game import Game
@@ -192,6 +198,12 @@ class Video(Document):
                 except exceptions.ResponseError:
                     Redis.delete(key)
 
+                # 推送到粉丝的关注视频时间线
+                FollowingTimeline.push(self.author, _id, self.create_at)
+
+            if self.duration >= const.DURATION:
+                self.SEARCH_INDEX.add(_id, self.title, self.create_at)
+
         return _id
 
     def update_model(self, data={}):
@@ -205,6 +217,9 @@ class Video(Document):
             data['$set']['update_at'] = time.time()
         obj = super(Video, self).update_model(data)
         if obj:
+            if 'title' in data.get('$set', {}) and obj.duration >= const.DURATION and obj.online:
+                self.SEARCH_INDEX.add(obj._id, obj.title, obj.create_at)
+
             # 精选视频-->非精选视频
             if to_status != from_status and from_status == const.ELITE:
                 key = self.ELITE_VIDEO_IDS
@@ -253,6 +268,9 @@ class Video(Document):
                 except:
                     print_log('gearman', 'do background error')
 
+                HotVideoRank.remove(self)
+                self.SEARCH_INDEX.remove(self._id)
+
                 # 视频下线删除已参赛作品
                 from wanx.models.activity import ActivityVideo
                 activity_videos = ActivityVideo.get_activity_video(vid=str(self._id))
@@ -281,6 +299,9 @@ class Video(Document):
                 except:
                     print_log('gearman', 'do background error')
 
+                if obj.duration >= const.DURATION:
+                    self.SEARCH_INDEX.add(obj._id, obj.title, obj.create_at)
+
                 key = self.GAME_VIDEO_IDS % ({'gid': str(self.game)})
                 try:
                     if Redis.exists(key) and self.duration >= const.DURATION:
@@ -316,6 +337,8 @@ class Video(Document):
                         Redis.zadd(key, self.create_at, str(self._id))
                 except exceptions.ResponseError:
                     Redis.delete(key)
+
+                FollowingTimeline.push(self.author, self._id, self.create_at)
         return obj
 
     def delete_model(self):
@@ -384,6 +407,9 @@ class Video(Document):
             except exceptions.ResponseError:
                 Redis.delete(key)
 
+            HotVideoRank.remove(self)
+            self.SEARCH_INDEX.remove(self._id)
+
             # 删除已参赛作品
             from wanx.models.activity import ActivityVideo
             activity_videos = ActivityVideo.get_activity_video(vid=str(self._id))
@@ -413,6 +439,9 @@ class Video(Document):
 
     @classmethod
     def search(cls, keyword):
+        if cls.SEARCH_INDEX.ready():
+            return [ObjectId(vid) for vid in cls.SEARCH_INDEX.search(keyword)]
+
         ids = cls.collection.find(
             {
                 'duration': {'$gte': const.DURATION},
@@ -456,6 +485,11 @@ class Video(Document):
             ids = []
         return list(ids)
 
+    @classmethod
+    def game_video_items(cls, gid, pagesize, cursor=None):
+        key = cls.GAME_VIDEO_IDS % ({'gid': gid})
+        return xcursor.zset_page(key, pagesize, cursor, lambda: cls._load_game_video_ids(gid))
+
     @classmethod
     def game_video_count(cls, gid):
         key = cls.GAME_VIDEO_IDS % ({'gid': gid})
@@ -468,142 +502,86 @@ class Video(Document):
         return count
 
     @classmethod
-    @util.cached_list(
-        lambda cls, gid: cls.GAME_NOLIVE_VIDEO_IDS % ({'date': time.strftime("%Y%m%d"),
-                                                       'gid': gid}),
-        timeout=86400, snowslide=True)
-    def _load_game_nolive_video_ids(cls, gid):
-        videos = list(cls.collection.find(
-            {
-                'game': ObjectId(gid),
-                'duration': {'$gte': const.DURATION},
-                'create_at': {'$gte': int(time.time()) - const.POPULAR_VIDEO.get("time_range")},
-                '$or': [{'status': {'$exists': False}},
-                        {'status': {'$in': [const.ONLINE, const.ELITE]}}],
-            },
-            {'_id': 1, 'vv': 1}
-        ).sort("vv", pymongo.DESCENDING).limit(const.POPULAR_VIDEO.get("max_video_num")))
-
-        if len(videos) < const.POPULAR_VIDEO.get("max_video_num", 30):
-            videos = list(cls.collection.find(
-                {
-                    'game': ObjectId(gid),
-                    'duration': {'$gte': const.DURATION},
-                    'create_at': {'$gte': int(time.time()) - 30 * 24 * 60 * 60},
-                    '$or': [{'status': {'$exists': False}},
-                            {'status': {'$in': [const.ONLINE, const.ELITE]}}]
-                },
-                {'_id': 1, 'vv': 1}
-            ).sort("vv", pymongo.DESCENDING).limit(const.POPULAR_VIDEO.get("max_video_num")))
-
-        vids = [v['_id'] for v in videos]
-        return vids
+    def _load_hot_video_ids(cls, cond):
+        """优先取最近time_range内的视频, 不足max_video_num个时扩大到30天
+        """
+        cond.update({'duration': {'$gte': const.DURATION}})
+        fields = {'_id': 1, 'vv': 1, 'like': 1, 'comment_count': 1, 'gift_num': 1, 'create_at': 1}
+        videos = []
+        for time_range in [const.POPULAR_VIDEO.get("time_range"), 30 * 24 * 60 * 60]:
+            cond['create_at'] = {'$gte': int(time.time()) - time_range}
+            videos = list(cls.collection.find(cond, fields).sort(
+                "vv", pymongo.DESCENDING).limit(const.HOT_VIDEO.get("max_len")))
+            if len(videos) >= const.POPULAR_VIDEO.get("max_video_num", 30):
+                break
+        ret = list()
+        for v in videos:
+            ret.extend([HotVideoRank.initial_score(v), str(v['_id'])])
+        return tuple(ret)
 
     @classmethod
-    def game_nolive_video_ids(cls, gid, page, pagesize, maxs=None):
-        key = cls.GAME_NOLIVE_VIDEO_IDS % ({'date': time.strftime("%Y%m%d"), 'gid': gid})
-        if not Redis.exists(key):
-            cls._load_game_nolive_video_ids(gid)
+    def _hot_video_ids(cls, key, page, pagesize):
         try:
             start = (page - 1) * pagesize if page else 0
             stop = (start + pagesize - 1) if pagesize else -1
-            ids = Redis.lrange(key, start, stop)
+            ids = Redis.zrevrange(key, start, stop)
         except exceptions.ResponseError:
             ids = []
         return list(ids)
 
     @classmethod
-    @util.cached_list(
-        lambda cls, uid, gid: cls.GAME_USERLIVE_VIDEO_IDS % (
-                {'date': time.strftime("%Y%m%d"), 'uid': uid, 'gid': gid}),
-        timeout=86400, snowslide=True)
-    def _load_game_userlive_video_ids(cls, uid, gid):
-        videos = list(cls.collection.find(
-            {
-                'game': ObjectId(gid),
-                'duration': {'$gte': const.DURATION},
-                'author': ObjectId(uid),
-                'event_id': {'$ne': ''},
-                'create_at': {'$gte': int(time.time()) - const.POPULAR_VIDEO.get("time_range")},
-                '$or': [{'status': {'$exists': False}},
-                        {'status': {'$in': [const.ONLINE, const.ELITE]}}]
-            },
-            {'_id': 1, 'vv': 1}
-        ).sort("vv", pymongo.DESCENDING).limit(const.POPULAR_VIDEO.get("max_video_num")))
+    @util.cached_zset(lambda cls, gid: cls.GAME_NOLIVE_VIDEO_IDS % ({'gid': gid}),
+                      timeout=const.HOT_VIDEO.get("expire"), snowslide=True)
+    def _load_game_nolive_video_ids(cls, gid):
+        return cls._load_hot_video_ids({
+            'game': ObjectId(gid),
+            '$or': [{'status': {'$exists': False}},
+                    {'status': {'$in': [const.ONLINE, const.ELITE]}}],
+        })
 
-        if len(videos) < const.POPULAR_VIDEO.get("max_video_num", 30):
-            videos = list(cls.collection.find(
-                {
-                    'game': ObjectId(gid),
-                    'duration': {'$gte': const.DURATION},
-                    'author': ObjectId(uid),
-                    'event_id': {'$ne': ''},
-                    'create_at': {'$gte': int(time.time()) - 30 * 24 * 60 * 60},
-                    '$or': [{'status': {'$exists': False}},
-                            {'status': {'$in': [const.ONLINE, const.ELITE]}}]
-                },
-                {'_id': 1, 'vv': 1}
-            ).sort("vv", pymongo.DESCENDING).limit(const.POPULAR_VIDEO.get("max_video_num")))
+    @classmethod
+    def game_nolive_video_ids(cls, gid, page, pagesize, maxs=None):
+        key = cls.GAME_NOLIVE_VIDEO_IDS % ({'gid': gid})
+        if not Redis.exists(key):
+            cls._load_game_nolive_video_ids(gid)
+        return cls._hot_video_ids(key, page, pagesize)
 
-        vids = [v['_id'] for v in videos]
-        return vids
+    @classmethod
+    @util.cached_zset(
+        lambda cls, uid, gid: cls.GAME_USERLIVE_VIDEO_IDS % ({'uid': uid, 'gid': gid}),
+        timeout=const.HOT_VIDEO.get("expire"), snowslide=True)
+    def _load_game_userlive_video_ids(cls, uid, gid):
+        return cls._load_hot_video_ids({
+            'game': ObjectId(gid),
+            'author': ObjectId(uid),
+            'event_id': {'$ne': ''},
+            '$or': [{'status': {'$exists': False}},
+                    {'status': {'$in': [const.ONLINE, const.ELITE]}}],
+        })
 
     @classmethod
     def game_userlive_video_ids(cls, uid, gid, page, pagesize, maxs=None):
-        key = cls.GAME_USERLIVE_VIDEO_IDS % ({'date': time.strftime("%Y%m%d"), 'uid': uid, 'gid': gid})
+        key = cls.GAME_USERLIVE_VIDEO_IDS % ({'uid': uid, 'gid': gid})
         if not Redis.exists(key):
             cls._load_game_userlive_video_ids(uid, gid)
-        try:
-            start = (page - 1) * pagesize if page else 0
-            stop = (start + pagesize - 1) if pagesize else -1
-            ids = Redis.lrange(key, start, stop)
-        except exceptions.ResponseError:
-            ids = []
-        return list(ids)
+        return cls._hot_video_ids(key, page, pagesize)
 
     @classmethod
-    @util.cached_list(lambda cls, gid: cls.GAME_HOTVIDEO_IDS % ({'date': time.strftime("%Y%m%d"),
-                                                                 'gid': gid}),
-                      timeout=86400, snowslide=True)
+    @util.cached_zset(lambda cls, gid: cls.GAME_HOTVIDEO_IDS % ({'gid': gid}),
+                      timeout=const.HOT_VIDEO.get("expire"), snowslide=True)
     def _load_game_hotvideo_ids(cls, gid):
-        videos = list(cls.collection.find(
-            {
-                'game': ObjectId(gid),
-                'duration': {'$gte': const.DURATION},
-                'create_at': {'$gte': int(time.time()) - const.POPULAR_VIDEO.get("time_range")},
-                '$or': [{'status': {'$exists': False}},
-                        {'status': {'$in': [const.ONLINE, const.ELITE]}}]
-            },
-            {'_id': 1, 'vv': 1}
-        ).sort("vv", pymongo.DESCENDING).limit(const.POPULAR_VIDEO.get("max_video_num")))
-
-        if len(videos) < const.POPULAR_VIDEO.get("max_video_num", 30):
-            videos = list(cls.collection.find(
-                {
-                    'game': ObjectId(gid),
-                    'duration': {'$gte': const.DURATION},
-                    'create_at': {'$gte': int(time.time()) - 30 * 24 * 60 * 60},
-                    '$or': [{'status': {'$exists': False}},
-                            {'status': {'$in': [const.ONLINE, const.ELITE]}}]
-                },
-                {'_id': 1, 'vv': 1}
-            ).sort("vv", pymongo.DESCENDING).limit(const.POPULAR_VIDEO.get("max_video_num")))
-
-        vids = [v['_id'] for v in videos]
-        return vids
+        return cls._load_hot_video_ids({
+            'game': ObjectId(gid),
+            '$or': [{'status': {'$exists': False}},
+                    {'status': {'$in': [const.ONLINE, const.ELITE]}}],
+        })
 
     @classmethod
     def game_hotvideo_ids(cls, gid, page, pagesize, maxs=None):
-        key = cls.GAME_HOTVIDEO_IDS % ({'date': time.strftime("%Y%m%d"), 'gid': gid})
+        key = cls.GAME_HOTVIDEO_IDS % ({'gid': gid})
         if not Redis.exists(key):
             cls._load_game_hotvideo_ids(gid)
-        try:
-            start = (page - 1) * pagesize if page else 0
-            stop = (start + pagesize - 1) if pagesize else -1
-            ids = Redis.lrange(key, start, stop)
-        except exceptions.ResponseError:
-            ids = []
-        return list(ids)
+        return cls._hot_video_ids(key, page, pagesize)
 
     @classmethod
     @util.cached_zset(lambda cls, uid: cls.USER_VIDEO_IDS % ({'uid': uid}))
@@ -637,6 +615,11 @@ class Video(Document):
             ids = []
         return list(ids)
 
+    @classmethod
+    def user_video_items(cls, uid, pagesize, cursor=None):
+        key = cls.USER_VIDEO_IDS % ({'uid': uid})
+        return xcursor.zset_page(key, pagesize, cursor, lambda: cls._load_user_video_ids(uid))
+
     @classmethod
     @util.cached_zset(lambda cls, uid: cls.USER_LIVE_VIDEO_IDS % ({'uid': uid}))
     def _load_user_live_video_ids(cls, uid):
@@ -752,6 +735,10 @@ class Video(Document):
             ids = []
         return list(ids)
 
+    @classmethod
+    def latest_video_items(cls, pagesize, cursor=None):
+        return xcursor.zset_page(cls.LATEST_VIDEO_IDS, pagesize, cursor, cls._load_latest_video_ids)
+
     @classmethod
     @util.cached_zset(lambda cls: cls.ELITE_VIDEO_IDS, snowslide=True)
     def _load_elite_video_ids(cls):
@@ -1067,14 +1054,14 @@ class UserLikeVideo(Document):
         _id = super(UserLikeVideo, self).create_model()
         if _id:
             video = Video.get_one(str(self.target))
-            video.update_model({'$inc': {'like': 1}})
+            Video.incr_counter(video._id, 'like', 1)
+            HotVideoRank.record(video, 'like')
         return _id
 
     def delete_model(self):
         ret = super(UserLikeVideo, self).delete_model()
         if ret:
-            video = Video.get_one(str(self.target))
-            video.update_model({'$inc': {'like': -1}})
+            Video.incr_counter(self.target, 'like', -1)
         return ret
 
     @classmethod
@@ -1695,3 +1682,295 @@ class EditorVideo(Document):
         except exceptions.ResponseError:
             _ids = []
         return list(_ids)
+
+
+class FollowingTimeline(object):
+    """用户关注视频时间线
+    普通用户发布视频时推送到粉丝的时间线(写扩散), 粉丝数超过TIMELINE_FANOUT_LIMIT的用户
+    不推送, 读取时与其视频队列(USER_VIDEO_IDS)合并(读扩散)
+    """
+    TIMELINE_IDS = 'timeline:user:%(uid)s'  # 用户关注视频时间线
+    CELEBRITY_IDS = 'timeline:celebrities'  # 不推送时间线的用户集合
+
+    @classmethod
+    @util.cached_set(lambda cls: cls.CELEBRITY_IDS, snowslide=True)
+    def _load_celebrity_ids(cls):
+        from wanx.models.user import User
+        users = User.collection.find(
+            {'follower_count': {'$gte': const.TIMELINE_FANOUT_LIMIT}},
+            {'_id': 1}
+        )
+        return tuple(str(u['_id']) for u in users)
+
+    @classmethod
+    def is_celebrity(cls, uid):
+        key = cls.CELEBRITY_IDS
+        if not Redis.exists(key):
+            cls._load_celebrity_ids()
+        try:
+            return Redis.sismember(key, str(uid))
+        except exceptions.ResponseError:
+            return False
+
+    @classmethod
+    def update_celebrity(cls, uid, follower_count):
+        """粉丝数变化时更新用户的推送方式
+        """
+        key = cls.CELEBRITY_IDS
+        demoted = False
+        try:
+            if follower_count >= const.TIMELINE_FANOUT_LIMIT:
+                if Redis.exists(key):
+                    Redis.sadd(key, str(uid))
+            else:
+                # 不推送用户集合未加载时按粉丝数刚降到阈值以下判断
+                demoted = Redis.srem(key, str(uid)) or \
+                    follower_count == const.TIMELINE_FANOUT_LIMIT - 1
+        except exceptions.ResponseError:
+            Redis.delete(key)
+        if demoted:
+            cls.fanout(uid)
+
+    @classmethod
+    def fanout(cls, author):
+        """不再是不推送用户时, 把期间未推送的最近视频推送到粉丝时间线
+        """
+        key = Video.USER_VIDEO_IDS % ({'uid': str(author)})
+        if not Redis.exists(key):
+            Video._load_user_video_ids(str(author))
+        try:
+            items = Redis.zrevrange(key, 0, const.TIMELINE_MAX_LEN - 1, withscores=True)
+        except exceptions.ResponseError:
+            items = []
+        return cls._push(author, items)
+
+    @classmethod
+    def pull_author_ids(cls, uid):
+        """用户关注的需要读取时合并的用户
+        """
+        from wanx.models.user import FriendShip
+        following_key = FriendShip.FOLLOWING_IDS % ({'uid': uid})
+        if not Redis.exists(following_key):
+            FriendShip._load_following_ids(uid)
+        if not Redis.exists(cls.CELEBRITY_IDS):
+            cls._load_celebrity_ids()
+        key = 'tmp:timeline:pull:%s' % (uid)
+        try:
+            count = Redis.zinterstore(key, [following_key, cls.CELEBRITY_IDS])
+            uids = Redis.zrange(key, 0, -1) if count else []
+        except exceptions.ResponseError:
+            uids = []
+        Redis.delete(key)
+        return list(uids)
+
+    @classmethod
+    @util.cached_zset(lambda cls, uid: cls.TIMELINE_IDS % ({'uid': uid}), snowslide=True)
+    def _load_timeline_ids(cls, uid):
+        """从mongo重建时间线
+        """
+        from wanx.models.user import FriendShip
+        celebrities = set(cls.pull_author_ids(uid))
+        uids = [ObjectId(_uid) for _uid in FriendShip.following_ids(uid) if _uid not in celebrities]
+        if not uids:
+            return tuple()
+        videos = Video.collection.find(
+            {
+                'author': {'$in': uids},
+                '$or': [{'status': {'$exists': False}},
+                        {'status': {'$in': [const.ONLINE, const.ELITE]}}]
+            },
+            {'_id': 1, 'create_at': 1}
+        ).sort("create_at", pymongo.DESCENDING).limit(const.TIMELINE_MAX_LEN)
+        ret = list()
+        for v in videos:
+            ret.extend([v['create_at'], str(v['_id'])])
+        return tuple(ret)
+
+    @classmethod
+    def push(cls, author, vid, create_at):
+        """视频发布时推送到粉丝时间线, 只更新已经存在的时间线
+        """
+        if cls.is_celebrity(author):
+            return 0
+        return cls._push(author, [(str(vid), create_at)])
+
+    @classmethod
+    def _push(cls, author, items):
+        """把视频[(vid, create_at), ...]写入粉丝已经存在的时间线, 返回更新的时间线数
+        """
+        from wanx.models.user import FriendShip
+        fids = FriendShip.follower_ids(str(author), None, None)
+        if not items or not fids:
+            return 0
+        args = list()
+        for vid, create_at in items:
+            args.extend([create_at, str(vid)])
+        keys = [cls.TIMELINE_IDS % ({'uid': fid}) for fid in fids]
+        pipe = Redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.type(key)
+        keys = [key for key, _type in zip(keys, pipe.execute()) if _type == 'zset']
+
+        pipe = Redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.zadd(key, *args)
+            pipe.zremrangebyrank(key, 0, -const.TIMELINE_MAX_LEN - 1)
+        pipe.execute()
+        return len(keys)
+
+    @classmethod
+    def invalidate(cls, uid):
+        """关注关系变化时删除时间线, 下次读取时重建
+        """
+        Redis.delete(cls.TIMELINE_IDS % ({'uid': str(uid)}))
+
+    @classmethod
+    def _range(cls, key, maxs, pagesize):
+        try:
+            ids = Redis.zrevrangebyscore(key, '(%.6f' % (maxs), '-inf', start=0, num=pagesize,
+                                         withscores=True)
+        except exceptions.ResponseError:
+            ids = []
+        return ids
+
+    @classmethod
+    def timeline_ids(cls, uid, pagesize, maxs=None):
+        """按时间倒序获取关注用户的视频
+        返回: [(vid, create_at), ...]
+        """
+        maxs = maxs or time.time()
+        key = cls.TIMELINE_IDS % ({'uid': uid})
+        if not Redis.exists(key):
+            cls._load_timeline_ids(uid)
+        ids = cls._range(key, maxs, pagesize)
+        pull_ids = cls.pull_author_ids(uid)
+        # 超出时间线长度的部分从mongo获取
+        if len(ids) < pagesize and Redis.type(key) == 'zset' and \
+                Redis.zcard(key) >= const.TIMELINE_MAX_LEN:
+            from wanx.models.user import FriendShip
+            celebrities = set(pull_ids)
+            uids = [ObjectId(_uid) for _uid in FriendShip.following_ids(uid)
+                    if _uid not in celebrities]
+            videos = Video.collection.find(
+                {
+                    'author': {'$in': uids},
+                    'create_at': {'$lt': ids[-1][1] if ids else maxs},
+                    '$or': [{'status': {'$exists': False}},
+                            {'status': {'$in': [const.ONLINE, const.ELITE]}}]
+                },
+                {'_id': 1, 'create_at': 1}
+            ).sort("create_at", pymongo.DESCENDING).limit(pagesize - len(ids))
+            ids.extend((str(v['_id']), v['create_at']) for v in videos)
+
+        sources = [ids]
+        for author in pull_ids:
+            _key = Video.USER_VIDEO_IDS % ({'uid': author})
+            if not Redis.exists(_key):
+                Video._load_user_video_ids(author)
+            sources.append(cls._range(_key, maxs, pagesize))
+
+        # 用户成为不推送用户前已推送的视频会同时出现在时间线和其视频队列中, 按视频id去重
+        merged = heapq.merge(*[[(-score, vid) for vid, score in src] for src in sources])
+        ret = list()
+        seen = set()
+        for score, vid in merged:
+            if vid in seen:
+                continue
+            seen.add(vid)
+            ret.append((vid, -score))
+            if len(ret) >= pagesize:
+                break
+        return ret
+
+
+class HotVideoRank(object):
+    """人气视频实时排行
+    排行分数为按半衰期衰减后热度的对数: log2(sum(weight * 2^((t - now) / half_life))) + now / half_life,
+    分数只增不减, 不同时间写入的分数可以直接比较, 由播放、赞、评论、送礼事件增量更新
+    """
+    # 只更新已加载的排行: 排行中的视频累加热度, 不在排行中的视频以本次热度加入, 保留前max_len个视频
+    INCR_SCRIPT = Redis.register_script("""
+        local added = 0
+        for _, key in ipairs(KEYS) do
+            if redis.call('TYPE', key)['ok'] == 'zset' then
+                local score = tonumber(ARGV[2])
+                local cur = redis.call('ZSCORE', key, ARGV[1])
+                if cur then
+                    cur = tonumber(cur)
+                    local hi, lo = math.max(cur, score), math.min(cur, score)
+                    score = hi + math.log(1 + math.pow(2, lo - hi)) / math.log(2)
+                end
+                redis.call('ZADD', key, score, ARGV[1])
+                redis.call('ZREMRANGEBYRANK', key, 0, -tonumber(ARGV[3]) - 1)
+                added = added + 1
+            end
+        end
+        return added
+    """)
+
+    @classmethod
+    def score(cls, value, ts):
+        return math.log(value, 2) + float(ts) / const.HOT_VIDEO.get('half_life')
+
+    @classmethod
+    def initial_score(cls, doc):
+        """根据视频已有的统计数据计算初始分数(视为在发布时发生)
+        """
+        weights = const.HOT_VIDEO.get('weights')
+        value = (doc.get('vv') or 0) * weights['play'] + (doc.get('like') or 0) * weights['like'] + \
+            (doc.get('comment_count') or 0) * weights['comment'] + \
+            (doc.get('gift_num') or 0) * weights['gift']
+        return cls.score(value + 1, doc.get('create_at') or time.time())
+
+    @classmethod
+    def rank_keys(cls, video):
+        # 与各排行从mongo加载时的条件一致
+        keys = [Video.GAME_HOTVIDEO_IDS % ({'gid': str(video.game)}),
+                Video.GAME_NOLIVE_VIDEO_IDS % ({'gid': str(video.game)})]
+        if video.event_id != '':
+            keys.append(Video.GAME_USERLIVE_VIDEO_IDS % ({'uid': str(video.author),
+                                                          'gid': str(video.game)}))
+        return keys
+
+    @classmethod
+    def record(cls, video, action, num=1):
+        """记录视频行为(play, like, comment, gift), 只更新已经存在的排行
+        """
+        if not video or video.offline or (video.duration or 0) < const.DURATION:
+            return 0
+        weight = const.HOT_VIDEO.get('weights', {}).get(action, 0) * num
+        if weight <= 0:
+            return 0
+        score = cls.score(weight, time.time())
+        try:
+            return cls.INCR_SCRIPT(keys=cls.rank_keys(video),
+                                   args=[str(video._id), repr(score),
+                                         const.HOT_VIDEO.get('max_len')])
+        except exceptions.RedisError as e:
+            print_log('hot_video', '[record] %s %s' % (str(video._id), str(e)))
+            return 0
+
+    @classmethod
+    def remove(cls, video):
+        for key in cls.rank_keys(video):
+            try:
+                Redis.zrem(key, str(video._id))
+            except exceptions.ResponseError:
+                Redis.delete(key)
+
+    @classmethod
+    def compact(cls):
+        """整理所有排行: 删除热度衰减到min_score以下的视频, 并截断到max_len
+        """
+        cutoff = cls.score(const.HOT_VIDEO.get('min_score'), time.time())
+        count = 0
+        for key in Redis.scan_iter(match='videos:hot:*', count=1000):
+            if Redis.type(key) != 'zset':
+                continue
+            pipe = Redis.pipeline(transaction=False)
+            pipe.zremrangebyscore(key, '-inf', '(%r' % (cutoff))
+            pipe.zremrangebyrank(key, 0, -const.HOT_VIDEO.get('max_len') - 1)
+            pipe.expire(key, const.HOT_VIDEO.get('expire'))
+            removed = pipe.execute()
+            count += removed[0] + removed[1]
+        return count
@@ -2,22 +2,47 @@
 """
 调用游玩直播接口相关
 """
+from multiprocessing.dummy import Pool
 from urlparse import urljoin
 
 from flask import request
 
+from wanx.base import const
 from wanx.base.log import print_log
-from wanx.base.xredis import Redis
+from wanx.base.xredis import Redis, MRedis
 from wanx.models.xconfig import Config
 from wanx.models.user import User
 from wanx.models.game import Game
 
 import requests
 import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+class LiveSnapshot(object):
+    """直播间列表快照, 按人气排序并建立event_id、user_id、game_id索引
+    快照创建后不再修改, 返回给调用者的都是直播间的拷贝
+    """
+
+    def __init__(self, lives, fetched_at):
+        self.lives = sorted(lives, key=lambda x: x['count'], reverse=True)
+        self.fetched_at = fetched_at
+        self.by_event = dict()
+        self.by_user = dict()
+        self.by_game = dict()
+        for live in self.lives:
+            self.by_event.setdefault(live['event_id'], live)
+            self.by_user.setdefault(live['user_id'], []).append(live)
+            self.by_game.setdefault(live['game_id'], []).append(live)
 
 
 class Xlive(object):
-    ALL_LIVES = 'lives:all'
+    ALL_LIVES = 'lives:snapshot'  # 直播间列表{'lives': list, 'ts': 获取时间}
+    REFRESH_LOCK = 'lives:refresh:lock'  # 集群内只允许一个进程请求直播接口
     GIFT_COUNTER = 'live:gift:counter:%(event_id)s:%(user_id)s:%(gift_id)s'
 
     @classmethod
@@ -54,110 +79,147 @@ class Xlive(object):
         live.pop('ut', None)
         return live
 
+    _snapshot = None
+    _refreshed_at = 0  # 最后一次刷新快照的时间, 刷新失败时也更新
+    _refresh_lock = threading.Lock()
+
     @classmethod
-    def get_all_lives(cls):
-        """所有直播间列表
+    def _fetch_lives(cls, api_url):
+        """请求直播接口获取直播间列表, 失败返回None
+        """
+        api_url = urljoin(api_url, '/events')
+        try:
+            resp = requests.get(api_url, timeout=2)
+        except requests.exceptions.Timeout:
+            print_log('xlive', '[get_all_lives]: connection timeout')
+            return None
+        except:
+            print_log('xlive', '[get_all_lives]: connection error')
+            return None
+
+        if resp.status_code != requests.codes.ok:
+            print_log('xlive', '[get_all_lives]: status_code not ok')
+            return None
+
+        return json.loads(resp.content)['data']['live']
+
+    @classmethod
+    def refresh_snapshot(cls, api_url):
+        """从redis加载直播间列表, 过期时由获得锁的进程请求直播接口更新
+        """
+        ttl = const.LIVE_SNAPSHOT['ttl']
+        data = Redis.get(cls.ALL_LIVES)
+        data = json.loads(data) if data else None
+        if not data or time.time() - data['ts'] >= ttl:
+            if Redis.set(cls.REFRESH_LOCK, 1, nx=True, ex=ttl):
+                lives = cls._fetch_lives(api_url)
+                if lives is not None:
+                    data = {'lives': lives, 'ts': time.time()}
+                    Redis.setex(cls.ALL_LIVES, const.LIVE_SNAPSHOT['max_stale'],
+                                json.dumps(data))
+        if data:
+            cls._snapshot = LiveSnapshot(data['lives'], data['ts'])
+        elif cls._snapshot is None:
+            cls._snapshot = LiveSnapshot([], 0)
+        # 获取失败时保留原快照, 也记录刷新时间, 避免短时间内重复请求
+        cls._refreshed_at = time.time()
+
+    @classmethod
+    def _background_refresh(cls, api_url):
+        try:
+            cls.refresh_snapshot(api_url)
+        except Exception, e:
+            print_log('xlive', '[refresh_snapshot]: %s' % (str(e)))
+        finally:
+            cls._refresh_lock.release()
+
+    @classmethod
+    def snapshot(cls):
+        """当前直播间列表快照
+        快照超过ttl后在后台线程刷新, 调用者继续使用旧快照; 没有快照或超过max_stale时同步刷新
         """
         # 后台配置是否开启直播服务, 默认开启
         api_url = Config.fetch('live_api_url', None, str)
         if not api_url:
-            return []
-
-        api_url = urljoin(api_url, '/events')
-        lives = Redis.get(cls.ALL_LIVES)
-        if not lives:
-            try:
-                resp = requests.get(api_url, timeout=2)
-            except requests.exceptions.Timeout:
-                print_log('xlive', '[get_all_lives]: connection timeout')
-                return []
-            except:
-                print_log('xlive', '[get_all_lives]: connection error')
-                return []
-
-            if resp.status_code != requests.codes.ok:
-                print_log('xlive', '[get_all_lives]: status_code not ok')
-                return []
-
-            lives = resp.content
-            lives = json.loads(lives)['data']['live']
-            Redis.setex(cls.ALL_LIVES, 5, json.dumps(lives))
-        else:
-            lives = json.loads(lives)
+            return None
+
+        snapshot = cls._snapshot
+        refreshed_at = cls._refreshed_at
+        age = time.time() - refreshed_at
+        if snapshot is None or age >= const.LIVE_SNAPSHOT['max_stale']:
+            with cls._refresh_lock:
+                # 等待锁期间其他线程已经刷新过时不再刷新
+                if cls._refreshed_at == refreshed_at:
+                    cls.refresh_snapshot(api_url)
+        elif age >= const.LIVE_SNAPSHOT['ttl'] and cls._refresh_lock.acquire(False):
+            threading.Thread(target=cls._background_refresh, args=(api_url,)).start()
+        return cls._snapshot
 
-        # 按照人气排序
-        lives.sort(key=lambda x: x['count'], reverse=True)
-        return lives
+    @classmethod
+    def get_all_lives(cls):
+        """所有直播间列表(按照人气排序)
+        """
+        snapshot = cls.snapshot()
+        return [dict(live) for live in snapshot.lives] if snapshot else []
 
     @classmethod
     def get_live(cls, live_id):
-        all_lives = cls.get_all_lives()
-        lives = filter(lambda x: x['event_id'] == live_id, all_lives)
-        return lives[0] if lives else None
+        snapshot = cls.snapshot()
+        live = snapshot and snapshot.by_event.get(live_id)
+        return dict(live) if live else None
 
     @classmethod
     def get_user_live(cls, user_id):
-        all_lives = cls.get_all_lives()
-        lives = filter(lambda x: x['user_id'] == user_id, all_lives)
-        return lives[0] if lives else None
+        snapshot = cls.snapshot()
+        lives = snapshot.by_user.get(user_id) if snapshot else None
+        return dict(lives[0]) if lives else None
 
     @classmethod
     def get_game_lives(cls, gid):
-        """游戏所有直播间列表
+        """游戏所有直播间列表(按照观看人数排序)
         """
-        all_lives = cls.get_all_lives()
-        game_lives = filter(lambda x: x['game_id'] == gid, all_lives)
-        # 按照观看人数排序
-        game_lives.sort(key=lambda x: x['count'], reverse=True)
-        return game_lives
+        snapshot = cls.snapshot()
+        return [dict(live) for live in snapshot.by_game.get(gid, [])] if snapshot else []
 
     @classmethod
     def get_user_lives(cls, uid):
         """单用户的直播间列表
         """
-        all_lives = cls.get_all_lives()
-        user_lives = filter(lambda x: x['user_id'] == uid, all_lives)
-        # 按照创建时间排序
-        user_lives.sort(key=lambda x: x['create_at'], reverse=True)
-        return user_lives
+        return cls.get_users_lives([uid])
 
     @classmethod
     def get_users_lives(cls, uids):
         """多个用户的直播间列表
         """
-        all_lives = cls.get_all_lives()
-        users_lives = filter(lambda x: x['user_id'] in uids, all_lives)
+        snapshot = cls.snapshot()
+        if not snapshot:
+            return []
+        users_lives = list()
+        for uid in set(uids):
+            users_lives.extend([dict(live) for live in snapshot.by_user.get(uid, [])])
         # 按照创建时间排序
         users_lives.sort(key=lambda x: x['create_at'], reverse=True)
         return users_lives
 
     @classmethod
     def send_live_msg(cls, data, mode='gift'):
-        """发送直播弹幕信息
+        """发送直播弹幕信息(写入发送队列, 由runlivemsg.py异步发送)
         """
         # 后台配置是否开启直播服务, 默认开启
         api_url = Config.fetch('live_api_url', None, str)
         if not api_url:
             return
 
-        uri = '/events/%s/notify' % (data['event_id'])
-        api_url = urljoin(api_url, uri)
-        msg = {'type': mode, 'data': data}
-        try:
-            requests.post(api_url, json=msg, timeout=2)
-        except requests.exceptions.Timeout:
-            print_log('xlive', '[send_live_msg]: connection timeout')
-        except:
-            print_log('xlive', '[send_live_msg]: connection error')
+        LiveMsgQueue.push(data, mode)
 
     @classmethod
     def get_match_live(cls, uid, name):
         """根据主播id和直播间name获取赛事直播
         """
-        all_lives = cls.get_all_lives()
-        print_log('xlive', '[get_match_live - all_lives]: {0}'.format(all_lives))
+        user_lives = cls.get_user_lives(uid)
+        print_log('xlive', '[get_match_live - user_lives]: {0}'.format(user_lives))
 
-        match_live = filter(lambda x: x['user_id'] == uid and x['name'] == name, all_lives)
+        match_live = filter(lambda x: x['name'] == name, user_lives)
         match_live.sort(key=lambda x: x['create_at'], reverse=True)
 
         print_log('xlive', '[get_match_live - match_live]: {0}'.format(match_live))
@@ -196,3 +258,211 @@ class Xlive(object):
         live = json.loads(live)['data']
 
         return live
+
+
+class LiveMsgQueue(object):
+    """直播间弹幕发送队列
+    接口只负责写入队列; 发送进程批量取出消息放入处理中列表, 按直播间分组后并发发送, 发送完成后再从处理中列表确认删除;
+    同一批次内同一直播间的消息按顺序发送, 跨批次(如失败重试的消息)不保证顺序;
+    失败的消息按指数退避重试, 超过重试次数写入死信队列;
+    发送进程通过Redis锁保证只有一个在运行, 其他进程等待锁过期后接管
+    """
+    LEADER_KEY = 'live:msg:leader'  # 当前的发送进程
+    MSG_QUEUE = 'live:msg:queue'  # 待发送消息(list)
+    PROCESSING_QUEUE = 'live:msg:processing'  # 已取出未确认的消息(list)
+    RETRY_QUEUE = 'live:msg:retry'  # 等待重试的消息(zset, 分数为下次发送时间)
+    DEAD_QUEUE = 'live:msg:dead'  # 重试失败的消息(list)
+
+    # 取出已到重试时间的消息和最早的num条消息, 移入处理中列表
+    POP_SCRIPT = MRedis.register_script("""
+        local ret = redis.call('ZRANGEBYSCORE', KEYS[2], 0, ARGV[2], 'LIMIT', 0, ARGV[1])
+        for _, msg in ipairs(ret) do
+            redis.call('ZREM', KEYS[2], msg)
+            redis.call('RPUSH', KEYS[3], msg)
+        end
+        for i = 1, tonumber(ARGV[1]) do
+            local msg = redis.call('RPOP', KEYS[1])
+            if not msg then
+                break
+            end
+            redis.call('RPUSH', KEYS[3], msg)
+            table.insert(ret, msg)
+        end
+        return ret
+    """)
+
+    # 处理中的消息放回队列尾部(最早发送)
+    RECOVER_SCRIPT = MRedis.register_script("""
+        local n = 0
+        local msg = redis.call('RPOP', KEYS[1])
+        while msg do
+            redis.call('RPUSH', KEYS[2], msg)
+            n = n + 1
+            msg = redis.call('RPOP', KEYS[1])
+        end
+        return n
+    """)
+
+    # 锁仍属于当前进程时续期
+    RENEW_SCRIPT = MRedis.register_script("""
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('EXPIRE', KEYS[1], ARGV[2])
+        end
+        return 0
+    """)
+
+    @classmethod
+    def lead(cls, instance, ttl):
+        """获取或续期发送进程锁, 返回当前进程是否为发送进程
+        """
+        if MRedis.set(cls.LEADER_KEY, instance, nx=True, ex=ttl):
+            return True
+        return bool(cls.RENEW_SCRIPT(keys=[cls.LEADER_KEY], args=[instance, ttl]))
+
+    @classmethod
+    def push(cls, data, mode='gift'):
+        # 每条消息带唯一id, 内容相同的消息在重试队列中不会合并
+        msg = {'id': uuid.uuid4().hex, 'type': mode, 'data': data, 'retries': 0}
+        MRedis.lpush(cls.MSG_QUEUE, json.dumps(msg))
+
+    @classmethod
+    def pop_batch(cls, num):
+        """取出已到重试时间的消息和最早的num条消息: [(raw, msg), ...]
+        消息发送完成后需要调用ack或fail从处理中列表删除
+        """
+        raws = cls.POP_SCRIPT(keys=[cls.MSG_QUEUE, cls.RETRY_QUEUE, cls.PROCESSING_QUEUE],
+                              args=[num, time.time()])
+        return [(raw, json.loads(raw)) for raw in raws]
+
+    @classmethod
+    def recover(cls):
+        """发送进程取得锁后把上次未确认的消息放回队列
+        """
+        return cls.RECOVER_SCRIPT(keys=[cls.PROCESSING_QUEUE, cls.MSG_QUEUE])
+
+    @classmethod
+    def ack(cls, raws):
+        pipe = MRedis.pipeline(transaction=False)
+        for raw in raws:
+            pipe.lrem(cls.PROCESSING_QUEUE, 1, raw)
+        pipe.execute()
+
+    @classmethod
+    def dead(cls, raw, msg):
+        pipe = MRedis.pipeline()
+        pipe.lpush(cls.DEAD_QUEUE, json.dumps(msg))
+        pipe.ltrim(cls.DEAD_QUEUE, 0, const.LIVE_MSG['dead_len'] - 1)
+        pipe.lrem(cls.PROCESSING_QUEUE, 1, raw)
+        pipe.execute()
+        print_log('xlive', '[send_live_msg]: dead message %s' % (json.dumps(msg)))
+
+    @classmethod
+    def fail(cls, raw, msg):
+        msg['retries'] += 1
+        if msg['retries'] > const.LIVE_MSG['max_retries']:
+            cls.dead(raw, msg)
+        else:
+            retry_at = time.time() + const.LIVE_MSG['backoff'] ** msg['retries']
+            pipe = MRedis.pipeline()
+            pipe.zadd(cls.RETRY_QUEUE, retry_at, json.dumps(msg))
+            pipe.lrem(cls.PROCESSING_QUEUE, 1, raw)
+            pipe.execute()
+
+    @classmethod
+    def deliver(cls, session, api_url, msg):
+        """发送单条消息, 成功返回True
+        """
+        uri = '/events/%s/notify' % (msg['data']['event_id'])
+        try:
+            resp = session.post(urljoin(api_url, uri),
+                                json={'type': msg['type'], 'data': msg['data']}, timeout=2)
+        except requests.exceptions.Timeout:
+            print_log('xlive', '[send_live_msg]: connection timeout')
+            return False
+        except:
+            print_log('xlive', '[send_live_msg]: connection error')
+            return False
+        return resp.status_code < 500
+
+    @classmethod
+    def work(cls, idle_sleep=0.2):
+        """发送进程主循环, 取得发送进程锁后才开始发送, 锁丢失时处理完当前批次后退出
+        """
+        workers = const.LIVE_MSG['workers']
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        pool = Pool(workers)
+
+        def send_room(items):
+            # 同一直播间内按顺序发送, 前一条失败时后面的消息一起重试以保持顺序
+            try:
+                for i, (raw, msg) in enumerate(items):
+                    if not cls.deliver(session, api_url, msg):
+                        for r, m in items[i:]:
+                            cls.fail(r, m)
+                        return
+                    cls.ack([raw])
+            except Exception, e:
+                # 未确认的消息留在处理中列表, 发送进程重启时放回队列
+                print_log('xlive', '[send_live_msg]: %s' % (str(e)))
+
+        instance = '%s:%s' % (socket.gethostname(), os.getpid())
+        ttl = const.LIVE_MSG['leader_ttl']
+        while True:
+            try:
+                if cls.lead(instance, ttl):
+                    break
+            except Exception, e:
+                print_log('xlive', '[send_live_msg]: %s' % (str(e)))
+            time.sleep(ttl / 3.0)
+
+        lost = threading.Event()
+
+        def keepalive():
+            while not lost.wait(ttl / 3.0):
+                try:
+                    if not cls.lead(instance, ttl):
+                        lost.set()
+                except Exception, e:
+                    print_log('xlive', '[send_live_msg]: %s' % (str(e)))
+
+        t = threading.Thread(target=keepalive)
+        t.daemon = True
+        t.start()
+
+        try:
+            cls.recover()
+        except Exception, e:
+            print_log('xlive', '[send_live_msg]: %s' % (str(e)))
+
+        while not lost.is_set():
+            # 未配置直播服务地址时不取出消息
+            api_url = Config.fetch('live_api_url', None, str)
+            if not api_url:
+                time.sleep(idle_sleep)
+                continue
+
+            try:
+                items = cls.pop_batch(const.LIVE_MSG['batch'])
+            except Exception, e:
+                print_log('xlive', '[send_live_msg]: %s' % (str(e)))
+                items = []
+            if not items:
+                time.sleep(idle_sleep)
+                continue
+
+            try:
+                rooms = dict()
+                for raw, msg in items:
+                    try:
+                        event_id = msg['data']['event_id']
+                    except (KeyError, TypeError):
+                        cls.dead(raw, msg)
+                        continue
+                    rooms.setdefault(event_id, []).append((raw, msg))
+                pool.map(send_room, rooms.values())
+            except Exception, e:
+                print_log('xlive', '[send_live_msg]: %s' % (str(e)))
+        print_log('xlive', '[send_live_msg]: leader lock lost %s' % (instance))
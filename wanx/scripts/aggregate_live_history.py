@@ -0,0 +1,29 @@
+# -*- coding: utf8 -*-
+"""汇总主播每天的直播时长, 处理上次汇总之后结束的直播, 并重新扫描之前几天补上结束时间延迟写入的直播
+使用方法：
+到项目根目录下执行(每天凌晨执行一次, 首次执行会汇总最近一年的数据)
+python-path wanx/scripts/aggregate_live_history.py -env=xxx
+"""
+from os.path import dirname, abspath
+
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from wanx.models.live import Event
+
+    for day, count in Event.aggregate_history():
+        print('%s: %s' % (day.strftime('%Y-%m-%d'), count))
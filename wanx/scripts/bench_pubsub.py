@@ -0,0 +1,107 @@
+# -*- coding: utf8 -*-
+"""订阅复用压力测试, 使用内存模拟的redis订阅, 不连接redis
+使用方法：
+到项目根目录下执行
+python-path wanx/scripts/bench_pubsub.py -env=xxx [-users=20000] [-msgs=100000] [-timeout=5]
+"""
+from os.path import dirname, abspath
+
+import argparse
+import random
+import sys
+import os
+import time
+
+
+class FakePubSub(object):
+    def __init__(self, broker):
+        from gevent.queue import Queue
+        self.broker = broker
+        self.queue = Queue()
+        self.channels = set()
+
+    def subscribe(self, *channels):
+        self.broker.commands += 1
+        self.channels.update(channels)
+
+    def unsubscribe(self, *channels):
+        self.broker.commands += 1
+        self.channels.difference_update(channels)
+
+    def listen(self):
+        while True:
+            yield self.queue.get()
+
+
+class FakeRedis(object):
+    """模拟redis发布订阅, 记录创建的订阅连接数和订阅命令数
+    """
+
+    def __init__(self):
+        self.connections = list()
+        self.commands = 0
+
+    def pubsub(self, **kwargs):
+        pubsub = FakePubSub(self)
+        self.connections.append(pubsub)
+        return pubsub
+
+    def publish(self, channel, data):
+        received = 0
+        for pubsub in self.connections:
+            if channel in pubsub.channels:
+                pubsub.queue.put({'type': 'message', 'channel': channel, 'data': data})
+                received += 1
+        return received
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    parser.add_argument('-users', action='store', dest='users', type=int, default=20000)
+    parser.add_argument('-msgs', action='store', dest='msgs', type=int, default=100000)
+    parser.add_argument('-timeout', action='store', dest='timeout', type=float, default=5)
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    import gevent
+    from wanx.base.xpubsub import PubSubMux
+
+    redis = FakeRedis()
+    mux = PubSubMux(redis)
+    latencies = list()
+
+    def client(uid):
+        # 模拟长连接: 收到消息或超时后立即重新等待
+        channel = 'user:async:msg:%s' % (uid)
+        deadline = time.time() + args.timeout
+        while time.time() < deadline:
+            data = mux.wait(channel, deadline - time.time())
+            if data:
+                latencies.append(time.time() - float(data))
+
+    clients = [gevent.spawn(client, i) for i in xrange(args.users)]
+    gevent.sleep(0.1)
+    begin = time.time()
+    for i in xrange(args.msgs):
+        redis.publish('user:async:msg:%s' % (random.randrange(args.users)), repr(time.time()))
+        if i % 1000 == 0:
+            gevent.sleep(0)
+    cost = time.time() - begin
+    gevent.joinall(clients)
+
+    latencies.sort()
+    print('等待连接: %s, redis订阅连接: %s, 订阅命令: %s' % (
+        args.users, len(redis.connections), redis.commands))
+    print('发布: %s条 %.3fs, 送达: %s, 丢弃: %s, 拒绝: %s' % (
+        args.msgs, cost, mux.stats['delivered'], mux.stats['dropped'], mux.stats['rejected']))
+    if latencies:
+        print('延迟 p50: %.2fms  p99: %.2fms  max: %.2fms' % (
+            latencies[len(latencies) / 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000))
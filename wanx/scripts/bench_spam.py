@@ -0,0 +1,74 @@
+# -*- coding: utf8 -*-
+"""敏感词过滤性能测试, 语料为最近的评论内容(或指定的文本文件, 每行一条)
+使用方法：
+到项目根目录下执行
+python-path wanx/scripts/bench_spam.py -env=xxx [-num=10000] [-file=corpus.txt] [-type=comment]
+"""
+from os.path import dirname, abspath
+
+import argparse
+import sys
+import os
+import time
+
+
+def load_corpus(num, fname=None):
+    if fname:
+        with open(fname, 'r') as f:
+            return [line.strip().decode('utf8', 'ignore') for line in f if line.strip()][:num]
+
+    import pymongo
+    from wanx.models.comment import Comment
+    comments = Comment.collection.find(
+        {}, {'content': 1}
+    ).sort('create_at', pymongo.DESCENDING).limit(num)
+    return [c['content'] for c in comments if c.get('content')]
+
+
+def naive_replace(content, ktype):
+    """修改前的实现: 每次调用重新构建自动机, 逐个命中词调用str.replace
+    """
+    from wanx.base.spam import Spam
+    index = Spam._build_index(Spam.keyword_file(ktype))
+    content = content.encode('utf8')
+    for r in index.query(content):
+        content = content.replace(r[1], '*' * len(r[1].decode('utf8')))
+    return content
+
+
+def bench(name, func, corpus):
+    begin = time.time()
+    for content in corpus:
+        func(content)
+    cost = time.time() - begin
+    print('%-16s total: %.3fs  per item: %.1fus' % (name, cost, cost / len(corpus) * 1000000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    parser.add_argument('-num', action='store', dest='num', type=int, default=10000)
+    parser.add_argument('-file', action='store', dest='fname', default=None)
+    parser.add_argument('-type', action='store', dest='ktype', default='comment')
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from wanx.base.spam import Spam
+
+    corpus = load_corpus(args.num, args.fname)
+    if not corpus:
+        print('语料为空')
+        sys.exit(1)
+    print('语料: %s条, 命中: %s条' % (
+        len(corpus), len([c for c in corpus if Spam.filter_words(c, args.ktype)])))
+
+    # 修改前的实现每条都要重建自动机, 只取少量语料
+    bench('naive_replace', lambda c: naive_replace(c, args.ktype), corpus[:100])
+    bench('filter_words', lambda c: Spam.filter_words(c, args.ktype), corpus)
+    bench('replace_words', lambda c: Spam.replace_words(c, args.ktype), corpus)
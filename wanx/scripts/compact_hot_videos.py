@@ -0,0 +1,28 @@
+# -*- coding: utf8 -*-
+"""整理人气视频排行, 删除热度已经衰减的视频
+使用方法：
+到项目根目录下执行(建议每小时执行一次)
+python-path wanx/scripts/compact_hot_videos.py -env=xxx
+"""
+from os.path import dirname, abspath
+
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from wanx.models.video import HotVideoRank
+    count = HotVideoRank.compact()
+    print('人气视频排行整理完成, 删除视频: %s' % (count))
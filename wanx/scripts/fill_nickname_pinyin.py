@@ -0,0 +1,41 @@
+# -*- coding: utf8 -*-
+"""为历史用户补全昵称拼音(nickpy)和首字母(nick_initials)
+使用方法：
+到项目根目录下执行(上线后执行一次)
+python-path wanx/scripts/fill_nickname_pinyin.py -env=xxx
+"""
+from os.path import dirname, abspath
+
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from pymongo import UpdateOne
+    from wanx.models.user import User
+
+    users = User.collection.find({'nickpy': {'$exists': False}}, {'_id': 1, 'nickname': 1})
+    count = 0
+    ops = list()
+    for u in users:
+        nickpy, initials = User.nickname_pinyin(u.get('nickname'))
+        ops.append(UpdateOne({'_id': u['_id']},
+                             {'$set': {'nickpy': nickpy, 'nick_initials': initials}}))
+        if len(ops) >= 1000:
+            count += User.collection.bulk_write(ops, ordered=False).modified_count
+            ops = list()
+    if ops:
+        count += User.collection.bulk_write(ops, ordered=False).modified_count
+    print('补全用户昵称拼音: %s' % (count))
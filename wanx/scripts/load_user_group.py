@@ -20,7 +20,8 @@ def load_user(gid, txt):
     total = 0
     not_exists = 0
     in_group = 0
-    success = 0
+    users = dict()
+    uids = set(UserGroup.group_user_ids(str(g._id)))
     with open(txt, 'r') as f:
         for line in f:
             total += 1
@@ -28,16 +29,12 @@ def load_user(gid, txt):
             user = User.get_by_phone(phone)
             if not user:
                 not_exists += 1
+            elif str(user._id) in uids or str(user._id) in users:
+                in_group += 1
             else:
-                if UserGroup.user_in_group(group, str(user._id)):
-                    in_group += 1
-                else:
-                    ug = UserGroup.init()
-                    ug.group = g._id
-                    ug.user = user._id
-                    ug.phone = user.phone
-                    ug.create_model()
-                    success += 1
+                users[str(user._id)] = user.phone
+
+    success = UserGroup.bulk_create(g._id, users.items())
 
     print('用户导入完成结果：\n\t总用户: %s \n\t成功添加用户: %s \n\t不存在用户: %s \n\t组已存在用户: %s '
           % (total, success, not_exists, in_group))
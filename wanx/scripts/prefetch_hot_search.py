@@ -0,0 +1,28 @@
+# -*- coding: utf8 -*-
+"""预先搜索热门关键字, 刷新搜索结果缓存
+使用方法：
+到项目根目录下执行(建议每分钟执行一次)
+python-path wanx/scripts/prefetch_hot_search.py -env=xxx
+"""
+from os.path import dirname, abspath
+
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from wanx.models.search import HotKeyword
+    count = HotKeyword.prefetch()
+    print('热门搜索预取完成, 关键字: %s' % (count))
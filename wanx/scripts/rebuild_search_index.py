@@ -0,0 +1,82 @@
+# -*- coding: utf8 -*-
+"""从mongo重建搜索索引
+使用方法：
+到项目根目录下执行(首次上线或索引数据异常时执行), 重建期间原索引可以正常搜索
+python-path wanx/scripts/rebuild_search_index.py -env=xxx [-type=user|game|video|activity_video]
+"""
+from os.path import dirname, abspath
+
+import argparse
+import sys
+import os
+
+
+def rebuild_users():
+    from wanx.models.user import User
+    users = User.collection.find({}, {'_id': 1, 'nickname': 1, 'live': 1, 'create_at': 1})
+    docs = list()
+    lives = list()
+    for u in users:
+        docs.append((u['_id'], u.get('nickname'), u.get('create_at') or 0))
+        if u.get('live') and 'str' in u['live']:
+            lives.append((u['_id'], u['live']['str'], u.get('create_at') or 0))
+    print('用户昵称索引: %s' % (User.SEARCH_INDEX.rebuild(docs)))
+    print('直播间房号索引: %s' % (User.LIVE_SEARCH_INDEX.rebuild(lives)))
+
+
+def rebuild_games():
+    from wanx.models.game import Game
+    games = Game.collection.find({}, {'_id': 1, 'name': 1, 'create_at': 1})
+    docs = [(g['_id'], g.get('name'), g.get('create_at') or 0) for g in games]
+    print('游戏名称索引: %s' % (Game.SEARCH_INDEX.rebuild(docs)))
+
+
+def rebuild_videos():
+    from wanx.base import const
+    from wanx.models.video import Video
+    videos = Video.collection.find(
+        {
+            'duration': {'$gte': const.DURATION},
+            '$or': [{'status': {'$exists': False}},
+                    {'status': {'$in': [const.ONLINE, const.ELITE]}}]
+        },
+        {'_id': 1, 'title': 1, 'create_at': 1}
+    )
+    docs = ((v['_id'], v.get('title'), v.get('create_at') or 0) for v in videos)
+    print('视频标题索引: %s' % (Video.SEARCH_INDEX.rebuild(docs)))
+
+
+def rebuild_activity_videos():
+    from wanx.models.activity import ActivityVideo
+    for aid in ActivityVideo.collection.distinct('activity_id'):
+        avideos = ActivityVideo.collection.find(
+            {'activity_id': aid},
+            {'_id': 1, 'title': 1, 'create_at': 1}
+        )
+        docs = [(v['_id'], v.get('title'), v.get('create_at') or 0) for v in avideos]
+        count = ActivityVideo.search_index(aid).rebuild(docs)
+        print('活动%s参赛视频索引: %s' % (aid, count))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    parser.add_argument('-type', action='store', dest='stype', default='all',
+                        help='all|user|game|video|activity_video')
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    if args.stype in ['all', 'user']:
+        rebuild_users()
+    if args.stype in ['all', 'game']:
+        rebuild_games()
+    if args.stype in ['all', 'video']:
+        rebuild_videos()
+    if args.stype in ['all', 'activity_video']:
+        rebuild_activity_videos()
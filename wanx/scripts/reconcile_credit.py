@@ -0,0 +1,41 @@
+# -*- coding: utf8 -*-
+"""核对用户余额与交易记录, 输出不一致的用户(只输出, 不修改数据)
+使用方法：
+到项目根目录下执行(建议每天凌晨执行)
+python-path wanx/scripts/reconcile_credit.py -env=xxx [-batch=500]
+"""
+from os.path import dirname, abspath
+
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    parser.add_argument('-batch', action='store', dest='batch', type=int, default=500)
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from wanx.models.credit import UserCredit
+
+    last_id = ''
+    total = mismatched = 0
+    while True:
+        user_ids = [uc.user_id for uc in UserCredit.select(UserCredit.user_id).where(
+            UserCredit.user_id > last_id).order_by(UserCredit.user_id).limit(args.batch)]
+        if not user_ids:
+            break
+        for user_id, field, value, logged in UserCredit.reconcile(user_ids):
+            print('%s %s: 余额=%s 交易记录=%s' % (user_id, field, value, logged))
+            mismatched += 1
+        total += len(user_ids)
+        last_id = user_ids[-1]
+    print('核对用户: %s, 不一致: %s' % (total, mismatched))
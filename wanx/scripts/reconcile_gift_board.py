@@ -0,0 +1,43 @@
+# -*- coding: utf8 -*-
+"""按数据库核对送礼排行, 修正不一致的排行
+使用方法：
+到项目根目录下执行(建议每天凌晨核对前一天的日榜和周榜)
+python-path wanx/scripts/reconcile_gift_board.py -env=xxx [-scope=anchor|live]
+    [-period=day|week|all] [-date=20170101]
+"""
+from os.path import dirname, abspath
+
+import argparse
+import datetime
+import sys
+import os
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    parser.add_argument('-scope', action='store', dest='scope', default=None,
+                        help='anchor|live, 默认全部')
+    parser.add_argument('-period', action='store', dest='period', default='day',
+                        help='day|week|all')
+    parser.add_argument('-date', action='store', dest='date', default=None,
+                        help='日榜和周榜的日期, 默认昨天')
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from wanx.models.gift import GiftLeaderboard
+
+    if args.date:
+        dt = datetime.datetime.strptime(args.date, '%Y%m%d')
+    else:
+        dt = datetime.datetime.now() - datetime.timedelta(days=1)
+    scopes = [args.scope] if args.scope else [GiftLeaderboard.ANCHOR, GiftLeaderboard.LIVE]
+    for scope in scopes:
+        checked, fixed = GiftLeaderboard.reconcile(scope, args.period, dt)
+        print('%s %s: 核对%s个排行, 修正%s个' % (scope, args.period, checked, fixed))
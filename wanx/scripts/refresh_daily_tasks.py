@@ -0,0 +1,57 @@
+# -*- coding: utf8 -*-
+"""凌晨批量刷新最近活跃用户的每日任务, 避免用户当天第一次请求时刷新
+使用方法：
+到项目根目录下执行(建议每天0点执行)
+python-path wanx/scripts/refresh_daily_tasks.py -env=xxx [-days=7] [-batch=500] [-retries=3]
+"""
+from os.path import dirname, abspath
+
+import argparse
+import datetime
+import sys
+import os
+import time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    parser.add_argument('-days', action='store', dest='days', type=int, default=7,
+                        help='刷新最近几天内刷新过任务的用户')
+    parser.add_argument('-batch', action='store', dest='batch', type=int, default=500)
+    parser.add_argument('-retries', action='store', dest='retries', type=int, default=3)
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from wanx.models.credit import UserCredit
+    from wanx.models.task import UserTask
+
+    import peewee as pw
+
+    today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+    since = today - datetime.timedelta(days=args.days)
+    begin = time.time()
+    last_id = ''
+    total = 0
+    while True:
+        user_ids = [uc.user_id for uc in UserCredit.select(UserCredit.user_id).where(
+            UserCredit.user_id > last_id, UserCredit.task_at >= since, UserCredit.task_at < today
+        ).order_by(UserCredit.user_id).limit(args.batch)]
+        if not user_ids:
+            break
+        # 与用户请求中的刷新发生锁等待超时或死锁时重试, 仍然失败的用户在请求时刷新
+        for i in xrange(args.retries + 1):
+            try:
+                total += UserTask.bulk_refresh_daily_tasks(user_ids)
+                break
+            except (pw.OperationalError, pw.InternalError), e:
+                print('刷新失败(%s-%s): %s' % (user_ids[0], user_ids[-1], str(e)))
+                time.sleep(1)
+        last_id = user_ids[-1]
+    print('刷新用户: %s, 耗时: %.1fs' % (total, time.time() - begin))
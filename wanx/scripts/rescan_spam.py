@@ -0,0 +1,41 @@
+# -*- coding: utf8 -*-
+"""关键词更新后复查已有的评论、回复、视频标题和用户昵称, 命中的内容写入spam_reviews等待审核
+扫描进度保存在redis中, 中断后再次执行会从上次的位置继续; 关键词更新后需要加-reset从头扫描
+使用方法：
+到项目根目录下执行
+python-path wanx/scripts/rescan_spam.py -env=xxx [-source=all|comment|reply|video|user]
+    [-batch=500] [-rate=1000] [-reset]
+"""
+from os.path import dirname, abspath
+
+import argparse
+import sys
+import os
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-env', action='store', dest='wxenv', required=True,
+                        help='Test|Stage|Production')
+    parser.add_argument('-source', action='store', dest='source', default='all',
+                        help='all|comment|reply|video|user')
+    parser.add_argument('-batch', action='store', dest='batch', type=int, default=500,
+                        help='每批读取的文档数')
+    parser.add_argument('-rate', action='store', dest='rate', type=int, default=1000,
+                        help='每秒最多扫描的文档数')
+    parser.add_argument('-reset', action='store_true', dest='reset', default=False,
+                        help='忽略已保存的进度, 从头扫描')
+    args = parser.parse_args(sys.argv[1:])
+    wxenv = args.wxenv
+    if wxenv not in ['Local', 'Test', 'Stage', 'Production', 'UnitTest']:
+        raise EnvironmentError('The environment variable (WXENV) is invalid ')
+
+    os.environ['WXENV'] = wxenv
+    sys.path.append(dirname(dirname(dirname(abspath(__file__)))))
+
+    from wanx.models.moderation import SpamReview, SCAN_SOURCES
+
+    sources = SCAN_SOURCES.keys() if args.source == 'all' else [args.source]
+    for source in sources:
+        scanned, hit = SpamReview.scan(source, args.batch, args.rate, args.reset)
+        print('%s: 扫描%s条, 命中%s条' % (source, scanned, hit))
@@ -89,7 +89,7 @@ class ApiTestCase(WanxTestCase):
         with open(data_file, 'r') as f:
             data = f.read()
             data = json.loads(data.strip('\n'))
-            Redis.setex(Xlive.ALL_LIVES, 60, json.dumps(data))
+            Redis.setex(Xlive.ALL_LIVES, 60, json.dumps({'lives': data, 'ts': time.time()}))
 
     def test_home(self):
         resp = self.app.get('/daily_visit?device=111111&ut=%s' % self.UT)
@@ -134,6 +134,10 @@ class ApiTestCase(WanxTestCase):
         self.assertEqual(resp.status_code, 200, 'get banner error')
         self.assertEqual(json.loads(resp.data)['status'], 0)
 
+        resp = self.app.get('/search/suggest?keyword=dm')
+        self.assertEqual(resp.status_code, 200, 'search suggest error')
+        self.assertIn(u'对面', json.loads(resp.data)['data']['keywords'])
+
         resp = self.app.get('/fixed_banners?os=android&version_code=1')
         self.assertEqual(resp.status_code, 200, 'get fixed banner error')
         rv = json.loads(resp.data)
@@ -917,6 +921,16 @@ class ApiTestCase(WanxTestCase):
         rv = json.loads(resp.data)
         self.assertEqual(rv['status'], 0)
 
+        resp = self.app.get('/messages/home?ut=%s&cursor=&nbr=2' % (self.UT))
+        rv = json.loads(resp.data)
+        self.assertEqual(rv['status'], 0)
+        self.assertIn('end_page', rv['data'])
+
+        resp = self.app.get('/messages/badge?ut=%s' % (self.UT))
+        rv = json.loads(resp.data)
+        self.assertEqual(rv['status'], 0)
+        self.assertIn('letters', rv['data'])
+
         data = dict(ut=self.UT, lrt=time.time())
         resp = self.app.post('/messages/delete', data=data)
         self.assertEqual(resp.status_code, 200, 'delete msg error')
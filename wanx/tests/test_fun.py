@@ -1,15 +1,33 @@
 # -*- coding: utf8 -*-
+from bson.objectid import ObjectId
 from redis import exceptions
-from wanx.base.xredis import Redis
+from wanx.base.xredis import Redis, MRedis
+from wanx.base import const, xcursor, xsearch
 from wanx.base.util import (cached_object, cached_hash,
                             cached_set, cached_list, cached_zset)
 from wanx.base.spam import Spam
+from wanx.base.xmongo import DB
 from wanx.base.xpinyin import Pinyin
 from wanx.models.xconfig import Config
+from wanx.models.credit import UserCredit
+from wanx.models.user import User, UserGroup
+from wanx.models.video import Video, HotVideoRank, FollowingTimeline
+from wanx.models.gift import GiftLeaderboard, UserGiftLog
+from wanx.models.live import Event, LiveRedPacket, RedPacketSchedule
+from wanx.models import Document, task as task_model
+from wanx.models.activity import ActivityVideo
+from wanx.models.moderation import SpamReview, SCAN_SOURCES
+from wanx.models.msg import Message, MessageDigest
+from wanx.models.stats import UniqueStats
+from wanx.models.task import Task, UserTask
+from wanx.platforms.xlive import LiveMsgQueue, LiveSnapshot
 from . import WanxTestCase
 
 import cPickle as cjson
+import datetime
 import json
+import pymongo
+import time
 
 
 class FunTestCase(WanxTestCase):
@@ -87,10 +105,493 @@ class FunTestCase(WanxTestCase):
         self.assertFalse(Spam.filter_words(u'不错'))
         self.assertTrue(Spam.filter_words(u'习近平'))
         self.assertEqual(Spam.replace_words(u'习近平是个好人'), '***是个好人')
+        self.assertEqual(Spam.replace_words(u'习近平,习近平'), '***,***')
+        self.assertIsInstance(Spam.replace_words(u'不错'), str)
+        self.assertEqual(Spam.replace_words(u'习近平', replace_str=u'*'), '***')
+        self.assertIs(Spam.create_index('comment'), Spam.create_index('comment'))
 
     def test_pinyin(self):
         py = Pinyin()
         self.assertTrue(py.get_pinyin(u'习近平', ''), 'xijinping')
+        self.assertIs(Pinyin.shared(), Pinyin.shared())
+        self.assertEqual(Pinyin.shared().get_initials(u'王者a', ''), 'WZa')
+        self.assertTupleEqual(User.nickname_pinyin('王者A'), (u'wangzhea', u'wza'))
+
+    def test_user_group(self):
+        gid, uid1, uid2 = '58ef4fc6a7a9a5d5d3b9b8a1', '56246d292d7fa20787d683b4', \
+            '55efe64feb43a14b0fcff4e6'
+        self.assertFalse(UserGroup.user_in_group(gid, uid1))
+        self.assertEqual(UserGroup.bulk_create(gid, [(uid1, '13800000000')]), 1)
+        self.assertTrue(UserGroup.user_in_group(gid, uid1))
+        self.assertDictEqual(UserGroup.user_in_groups([gid], uid2), {gid: False})
+        ug = UserGroup.init()
+        ug.group, ug.user, ug.phone = ObjectId(gid), ObjectId(uid2), '13800000001'
+        ug._id = ug.create_model()
+        self.assertDictEqual(UserGroup.user_in_groups([gid], uid2), {gid: True})
+        ug.delete_model()
+        self.assertFalse(UserGroup.user_in_group(gid, uid2))
+        self.assertListEqual(UserGroup.group_user_ids(gid), [uid1])
+        # 重复的记录修改分组后原分组仍保留成员
+        gid2 = '58ef4fc6a7a9a5d5d3b9b8a2'
+        dup = UserGroup.init()
+        dup.group, dup.user, dup.phone = ObjectId(gid), ObjectId(uid1), '13800000000'
+        dup._id = dup.create_model()
+        dup.update_model({'$set': {'group': ObjectId(gid2)}})
+        self.assertTrue(UserGroup.user_in_group(gid, uid1))
+        self.assertTrue(UserGroup.user_in_group(gid2, uid1))
+        UserGroup.collection.delete_one({'_id': dup._id})
+        Redis.delete(UserGroup.GROUP_UIDS % ({'gid': gid2}))
+
+    def test_hot_video_rank(self):
+        now = time.time()
+        half_life = const.HOT_VIDEO['half_life']
+        # 衰减一个半衰期后热度减半
+        self.assertAlmostEqual(HotVideoRank.score(10, now - half_life),
+                               HotVideoRank.score(5, now))
+        old = HotVideoRank.initial_score({'vv': 100, 'create_at': now - 10 * half_life})
+        new = HotVideoRank.initial_score({'vv': 10, 'create_at': now})
+        self.assertGreater(new, old)
+
+        video = Video({'_id': ObjectId(), 'game': ObjectId(), 'author': ObjectId(),
+                       'duration': const.DURATION, 'vv': 0, 'create_at': now})
+        key = Video.GAME_HOTVIDEO_IDS % ({'gid': str(video.game)})
+        self.assertEqual(HotVideoRank.record(video, 'play'), 0)
+        Redis.zadd(key, old, 'old')
+        self.assertEqual(HotVideoRank.record(video, 'play'), 1)
+        self.assertEqual(HotVideoRank.record(video, 'like'), 1)
+        self.assertAlmostEqual(Redis.zscore(key, str(video._id)), HotVideoRank.score(6, now), 3)
+        self.assertListEqual(Redis.zrevrange(key, 0, -1), [str(video._id), 'old'])
+        HotVideoRank.compact()
+        self.assertListEqual(Redis.zrevrange(key, 0, -1), [str(video._id)])
+
+    def test_cursor(self):
+        self.assertTupleEqual(xcursor.decode(xcursor.encode(1.5, 'abc')), (1.5, 'abc'))
+        self.assertTupleEqual(xcursor.decode('invalid'), (None, None))
+        key = 'test:cursor'
+        Redis.delete(key)
+        for i, member in enumerate(['a', 'b', 'c', 'd', 'e']):
+            Redis.zadd(key, i / 2, member)
+        fetch = lambda cursor, num: xcursor.zset_page(key, num, cursor)
+        ids, cursor, end_page = xcursor.paginate(fetch, list, 2)
+        self.assertListEqual(ids, ['e', 'd'])
+        self.assertFalse(end_page)
+        # 新增数据不影响后续分页
+        Redis.zadd(key, 1, 'f')
+        ids, cursor, end_page = xcursor.paginate(fetch, list, 2, cursor)
+        self.assertListEqual(ids, ['c', 'b'])
+        ids, cursor, end_page = xcursor.paginate(fetch, list, 2, cursor)
+        self.assertListEqual(ids, ['a'])
+        self.assertTrue(end_page)
+        Redis.delete(key)
+
+        # 游标id与成员不同时同分成员按游标id排序, 不会跳过或重复
+        for member in ['a', 'b', 'c', 'd', 'e']:
+            Redis.zadd(key, 1, member)
+
+        def reverse_id(member):
+            return chr(ord('z') - ord(member) + ord('a'))
+
+        def fetch_keyed(cursor, num):
+            return xcursor.zset_page(key, num, cursor, key=reverse_id)
+        ids, cursor, end_page = [], None, False
+        while not end_page:
+            page, cursor, end_page = xcursor.paginate(fetch_keyed, list, 2, cursor, key=reverse_id)
+            ids.extend(page)
+        self.assertListEqual(ids, ['a', 'b', 'c', 'd', 'e'])
+        Redis.delete(key)
+
+        # 排序字段为空的记录排在最后, 不会被跳过
+        coll = DB['test_cursor']
+        coll.drop()
+        oids = coll.insert_many([{'vv': 1}, {'vv': None}, {}, {'vv': 2}, {'vv': 1}]).inserted_ids
+
+        def fetch_mongo(cursor, num):
+            docs = coll.find(xcursor.mongo_cond('vv', cursor)).sort(
+                [('vv', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)]).limit(num)
+            return [(d['_id'], xcursor.mongo_score(d.get('vv'))) for d in docs]
+        ids, cursor, end_page = xcursor.paginate(fetch_mongo, list, 2)
+        while not end_page:
+            page, cursor, end_page = xcursor.paginate(fetch_mongo, list, 2, cursor)
+            ids.extend(page)
+        self.assertListEqual(ids, [oids[3], oids[4], oids[0], oids[2], oids[1]])
+        coll.drop()
+
+    def test_search_index(self):
+        index = xsearch.SearchIndex('test', pinyin=True)
+        for key in Redis.keys('search:test:*'):
+            Redis.delete(key)
+        # 增量写入不会标记索引已建立
+        index.add('x', u'王者荣耀', 0)
+        self.assertFalse(index.ready())
+        index.rebuild([('a', u'王者荣耀', 1), ('b', u'荣耀之路Live', 2)])
+        self.assertTrue(index.ready())
+        self.assertListEqual(index.search(u'荣耀'), ['b', 'a'])
+        self.assertListEqual(index.search(u'王者'), ['a'])
+        self.assertListEqual(index.search('wzry'), ['a'])
+        self.assertListEqual(index.search('rongyao'), ['b', 'a'])
+        self.assertListEqual(index.search('LI'), ['b'])
+        index.add('a', u'英雄联盟', 1)
+        index.remove('b')
+        self.assertListEqual(index.search(u'荣'), [])
+        self.assertListEqual(index.search(u'联盟'), ['a'])
+        # 重建后删除新索引中不存在的文档
+        index.rebuild([('c', u'王者荣耀', 3)])
+        self.assertListEqual(index.search(u'王者'), ['c'])
+        self.assertListEqual(index.search(u'联盟'), [])
+
+        # 重建期间的写入不会丢失
+        def docs():
+            yield ('c', u'王者荣耀', 3)
+            index.add('d', u'王者归来', 4)
+            index.remove('c')
+            yield ('e', u'英雄联盟', 5)
+        index.rebuild(docs())
+        self.assertListEqual(index.search(u'王者'), ['d'])
+        self.assertListEqual(index.search(u'联盟'), ['e'])
+        self.assertFalse(Redis.exists(index.pending_key))
+        # 词项变化时递增版本号, 失效搜索结果缓存
+        Redis.delete(index.touch_key)
+        version = Redis.get(index.version_key)
+        index.add('d', u'王者归来', 6)
+        self.assertEqual(Redis.get(index.version_key), version)
+        index.add('d', u'荣耀归来', 6)
+        self.assertNotEqual(Redis.get(index.version_key), version)
+        self.assertFalse(Redis.exists(index.DOC_KEY % ({'name': 'test', 'oid': 'a'})))
+        self.assertFalse(Redis.keys('search:rebuild:test:*'))
+        index.rebuild([])
+        self.assertFalse(index.ready())
+
+    def test_live_msg_queue(self):
+        keys = [LiveMsgQueue.MSG_QUEUE, LiveMsgQueue.RETRY_QUEUE, LiveMsgQueue.PROCESSING_QUEUE,
+                LiveMsgQueue.LEADER_KEY]
+        MRedis.delete(*keys)
+        # 只有一个发送进程
+        self.assertTrue(LiveMsgQueue.lead('a', 10))
+        self.assertFalse(LiveMsgQueue.lead('b', 10))
+        self.assertTrue(LiveMsgQueue.lead('a', 10))
+        for i in range(3):
+            LiveMsgQueue.push({'event_id': '1', 'id': i}, 'red_packet')
+        # 内容相同的消息也不会合并
+        LiveMsgQueue.push({'event_id': '1', 'id': 2}, 'red_packet')
+        items = LiveMsgQueue.pop_batch(2)
+        self.assertListEqual([m['data']['id'] for _, m in items], [0, 1])
+        self.assertEqual(MRedis.llen(LiveMsgQueue.PROCESSING_QUEUE), 2)
+        LiveMsgQueue.fail(*items[0])
+        LiveMsgQueue.ack([items[1][0]])
+        self.assertEqual(MRedis.llen(LiveMsgQueue.PROCESSING_QUEUE), 0)
+        # 重试时间未到
+        items = LiveMsgQueue.pop_batch(2)
+        self.assertListEqual([m['data']['id'] for _, m in items], [2, 2])
+        LiveMsgQueue.fail(*items[0])
+        LiveMsgQueue.fail(*items[1])
+        self.assertEqual(MRedis.zcard(LiveMsgQueue.RETRY_QUEUE), 3)
+        # 未确认的消息在重启时放回队列
+        LiveMsgQueue.push({'event_id': '1', 'id': 3}, 'red_packet')
+        LiveMsgQueue.pop_batch(1)
+        self.assertEqual(LiveMsgQueue.recover(), 1)
+        items = LiveMsgQueue.pop_batch(1)
+        self.assertListEqual([m['data']['id'] for _, m in items], [3])
+        MRedis.delete(*keys)
+
+    def test_red_packet_schedule(self):
+        ts = time.time()
+        lives = [{'event_id': 1, 'user_id': 'u1', 'game_id': 'g1', 'name': u'abc',
+                  'create_at': ts - 70, 'count': 1},
+                 {'event_id': 2, 'user_id': 'u2', 'game_id': 'g2', 'name': u'xyz',
+                  'create_at': ts - 200, 'count': 2}]
+        snapshot = LiveSnapshot(lives, ts)
+        timed = LiveRedPacket({'_id': 'a', 'mode': 0, 'begin_at': ts - 2, 'keyword': u'ab'})
+        delay = LiveRedPacket({'_id': 'b', 'mode': 1, 'begin_at': ts - 1000, 'delay': 1,
+                               'live_games': 'g1\r\ng2'})
+        index = RedPacketSchedule([timed, delay])
+        matched, _ = index.match(snapshot, ts - 5, ts)
+        self.assertListEqual(sorted((rp._id, live['event_id']) for rp, live in matched),
+                             [('a', 1)])
+        matched, _ = index.match(snapshot, ts - 15, ts - 5)
+        self.assertListEqual([(rp._id, live['event_id']) for rp, live in matched], [('b', 1)])
+
+    def test_gift_board(self):
+        live_id = 'test_live'
+        keys = [GiftLeaderboard.board_key(scope, target, p) for p in ['all', 'day', 'week']
+                for scope, target in [(GiftLeaderboard.LIVE, live_id),
+                                      (GiftLeaderboard.ANCHOR, 'anchor')]]
+        Redis.delete(*keys)
+        # 主播总榜空数据占位, 累加后保留过期时间
+        anchor_all = GiftLeaderboard.board_key(GiftLeaderboard.ANCHOR, 'anchor', 'all')
+        Redis.setex(anchor_all, 60, 'empty')
+        for from_user, gold in [('u1', 10), ('u2', 30), ('u1', 25)]:
+            log = UserGiftLog(user_id='anchor', from_user=from_user, gold_price=gold,
+                              gift_from=const.FROM_LIVE, from_id=live_id, send_success=1)
+            GiftLeaderboard.record(log)
+        for period in ['all', 'day', 'week']:
+            self.assertListEqual(GiftLeaderboard.top(GiftLeaderboard.LIVE, live_id, period),
+                                 [('u1', 35), ('u2', 30)])
+        self.assertTupleEqual(GiftLeaderboard.rank(GiftLeaderboard.LIVE, live_id, 'u2'), (2, 30))
+        self.assertTupleEqual(GiftLeaderboard.rank(GiftLeaderboard.LIVE, live_id, 'u3'), (None, 0))
+        self.assertEqual(Redis.zscore(anchor_all, 'u1'), 35)
+        self.assertGreater(Redis.ttl(anchor_all), 0)
+        Redis.delete(*keys)
+
+    def test_message_digest(self):
+        args = ('owner', 'video', 'obj', 'like')
+        key = MessageDigest.key(*args)
+        MRedis.delete(key)
+        MRedis.zrem(MessageDigest.PENDING, key)
+        counts = [MessageDigest.add(*(args + (op, ))) for op in ['a', 'b', 'c']]
+        self.assertListEqual(counts, [1, 2, 3])
+        self.assertEqual(MRedis.hget(key, 'operator'), 'c')
+        self.assertIsNotNone(MRedis.zscore(MessageDigest.PENDING, key))
+        MRedis.delete(key)
+        MRedis.zrem(MessageDigest.PENDING, key)
+
+    def test_message_delete(self):
+        owner = str(ObjectId())
+        args = (owner, 'video', str(ObjectId()), 'like')
+        Message._send(*(args + (str(ObjectId()), )))
+        self.assertEqual(Message.delete_user_messages(owner, time.time()), 1)
+        self.assertFalse(MRedis.exists(MessageDigest.key(*args)))
+        # 删除后窗口内的同类消息重新创建
+        Message._send(*(args + (str(ObjectId()), )))
+        self.assertEqual(Message.collection.count({'owner': ObjectId(owner)}), 1)
+        self.assertEqual(Message.delete_user_messages(owner, time.time()), 1)
+
+    def test_video_counter(self):
+        vid = Video.collection.insert_one({'vv': 10, 'like': 1, 'create_at': time.time()}).inserted_id
+        self.assertEqual(Video.get_one(str(vid)).vv, 10)
+        Video.incr_counter(vid, 'vv', 2)
+        Video.incr_counter(vid, 'like', 1)
+        Video.incr_counter(vid, 'like', -1)
+        # 读取时合并未写回的增量, 数据库不变
+        video = Video.get_one(str(vid))
+        self.assertEqual((video.vv, video.like), (12, 1))
+        self.assertEqual(Video.collection.find_one({'_id': vid})['vv'], 10)
+        Video.flush_counters()
+        self.assertEqual(Video.collection.find_one({'_id': vid})['vv'], 12)
+        self.assertFalse(Redis.sismember(Video.COUNTER_DIRTY % ({'name': 'video'}), str(vid)))
+        self.assertEqual(Video.get_one(str(vid)).vv, 12)
+
+        # 批量获取时合并增量; 部分写回失败时只扣除写回成功的增量
+        bad = Video.collection.insert_one({'vv': 'x', 'create_at': time.time()}).inserted_id
+        Video.incr_counter(vid, 'vv', 3)
+        Video.incr_counter(bad, 'vv', 1)
+        self.assertListEqual([v.vv for v in Video.get_list([str(vid), str(vid)])], [15, 15])
+        Video.flush_counters()
+        self.assertEqual(Video.collection.find_one({'_id': vid})['vv'], 15)
+        self.assertFalse(Redis.sismember(Video.COUNTER_DIRTY % ({'name': 'video'}), str(vid)))
+        self.assertTrue(Redis.sismember(Video.COUNTER_DIRTY % ({'name': 'video'}), str(bad)))
+        Video.flush_counters()
+        self.assertEqual(Video.collection.find_one({'_id': vid})['vv'], 15)
+
+        Video.collection.delete_many({'_id': {'$in': [vid, bad]}})
+        Redis.delete(Video.COUNTER_DELTA % ({'name': 'video', 'oid': str(bad)}))
+        Redis.srem(Video.COUNTER_DIRTY % ({'name': 'video'}), str(bad))
+        for oid in [vid, bad]:
+            Redis.delete(Video.OBJECT_KEY % ({'name': 'video', 'oid': str(oid)}))
+
+    def test_spam_review(self):
+        class ScanDoc(Document):
+            collection = DB['test_spam_scan']
+        ScanDoc.collection.drop()
+        SpamReview.collection.delete_many({'source': 'test'})
+        SCAN_SOURCES['test'] = (ScanDoc, [('content', 'comment')], 'author')
+        ids = ScanDoc.collection.insert_many([
+            {'content': u'不错'}, {'content': u'习近平'}, {'content': u'习近平,习近平'}
+        ]).inserted_ids
+        self.assertTupleEqual(SpamReview.scan('test', batch=2, rate=10000, reset=True), (3, 2))
+        # 从上次扫描的位置继续
+        new_id = ScanDoc.collection.insert_one({'content': u'习近平'}).inserted_id
+        self.assertTupleEqual(SpamReview.scan('test', rate=10000), (1, 1))
+        self.assertEqual(Redis.hget(SpamReview.SCAN_CHECKPOINT, 'test'), str(new_id))
+        # 内容已修改或删除的待审核记录被清除
+        ScanDoc.collection.update_one({'_id': ids[1]}, {'$set': {'content': u'不错'}})
+        ScanDoc.collection.delete_many({'_id': {'$in': [ids[2], new_id]}})
+        self.assertTupleEqual(SpamReview.scan('test', batch=2, rate=10000, reset=True), (2, 0))
+        self.assertEqual(SpamReview.collection.find({'source': 'test'}).count(), 0)
+        ScanDoc.collection.drop()
+        Redis.hdel(SpamReview.SCAN_CHECKPOINT, 'test')
+        SCAN_SOURCES.pop('test')
+
+    def test_live_history(self):
+        uid = 'test_live_history'
+        day = datetime.date.today() - datetime.timedelta(days=1)
+        tag = day.strftime('%y%m%d')
+        key = Event.USER_LIVE_DURATION % ({'uid': uid})
+        Redis.delete(key, Event.AGGREGATED_LIVES % ({'day': tag}))
+        begin = time.mktime(day.timetuple())
+        ids = [Event.collection.insert_one({'user_id': uid, 'create_at': begin + 100,
+                                            'finish_at': begin + 160}).inserted_id]
+        self.assertEqual(Event.aggregate_day(day), 1)
+        # 重复执行不会重复累加
+        self.assertEqual(Event.aggregate_day(day), 0)
+        self.assertEqual(Redis.hget(key, 'd:' + tag), '60')
+        # 结束时间延迟写入的直播在重新扫描时补上
+        ids.append(Event.collection.insert_one({'user_id': uid, 'create_at': begin + 50,
+                                                'finish_at': begin + 80}).inserted_id)
+        self.assertEqual(Event.aggregate_day(day), 1)
+        self.assertEqual(Redis.hget(key, 'd:' + tag), '90')
+        self.assertEqual(float(Redis.hget(key, 't:' + tag)), begin + 100)
+        Event.collection.delete_many({'_id': {'$in': ids}})
+        Redis.delete(key, Event.AGGREGATED_LIVES % ({'day': tag}))
+
+    def test_pubsub_mux(self):
+        import gevent
+        from wanx.base.xpubsub import PubSubMux
+        from wanx.scripts.bench_pubsub import FakeRedis
+        redis = FakeRedis()
+        mux = PubSubMux(redis, max_waiters=3, max_channel_waiters=2, queue_size=1)
+        waiters = [gevent.spawn(mux.wait, 'c1', 2) for _ in range(2)]
+        gevent.sleep(0.1)
+        # 同一频道的等待者只订阅一次
+        self.assertEqual(mux.count, 2)
+        self.assertEqual(len(redis.connections), 1)
+        self.assertSetEqual(redis.connections[0].channels, set([mux.control_channel, 'c1']))
+        # 超过单个频道的等待者上限
+        self.assertIsNone(mux.wait('c1', 1))
+        self.assertEqual(mux.stats['rejected'], 1)
+        # 超过进程内的等待者上限
+        other = gevent.spawn(mux.wait, 'c2', 0.5)
+        gevent.sleep(0.1)
+        self.assertIsNone(mux.wait('c3', 1))
+        self.assertEqual(mux.stats['rejected'], 2)
+
+        self.assertEqual(redis.publish('c1', 'hello'), 1)
+        gevent.joinall(waiters, timeout=1)
+        self.assertListEqual([g.value for g in waiters], ['hello', 'hello'])
+        self.assertEqual(mux.stats['delivered'], 2)
+        # 超时返回None, 最后一个等待者离开后取消订阅
+        other.join(timeout=1)
+        self.assertIsNone(other.value)
+        self.assertEqual(mux.count, 0)
+        self.assertDictEqual(mux.waiters, {})
+        self.assertSetEqual(redis.connections[0].channels, set([mux.control_channel]))
+
+    def test_following_timeline(self):
+        uid, author = 'test_timeline_u', 'test_timeline_a'
+        timeline = FollowingTimeline.TIMELINE_IDS % ({'uid': uid})
+        following = 'users:following:%s' % (uid)
+        followers = 'users:follower:%s' % (author)
+        videos = Video.USER_VIDEO_IDS % ({'uid': author})
+        Redis.delete(timeline, following, followers, videos, FollowingTimeline.CELEBRITY_IDS)
+        ts = time.time() - 100
+        Redis.zadd(following, ts, author)
+        # 成为不推送用户前已推送到时间线的视频
+        Redis.zadd(timeline, ts + 1, 'v1', ts + 2, 'v2')
+        Redis.zadd(videos, ts + 1, 'v1', ts + 2, 'v2', ts + 3, 'v3')
+        Redis.sadd(FollowingTimeline.CELEBRITY_IDS, author)
+        ids = FollowingTimeline.timeline_ids(uid, 10)
+        self.assertListEqual([vid for vid, _ in ids], ['v3', 'v2', 'v1'])
+        ids = FollowingTimeline.timeline_ids(uid, 2)
+        self.assertListEqual([vid for vid, _ in ids], ['v3', 'v2'])
+        # 不再是不推送用户时, 期间未推送的视频推送到粉丝时间线
+        Redis.zadd(followers, ts, uid)
+        FollowingTimeline.update_celebrity(author, 10)
+        self.assertEqual(Redis.zscore(timeline, 'v3'), ts + 3)
+        Redis.delete(timeline, following, followers, videos, FollowingTimeline.CELEBRITY_IDS)
+
+    def test_activity_vids(self):
+        vid = str(ObjectId())
+        Redis.delete(ActivityVideo.ACTIVITY_VIDS, ActivityVideo.RECENT_VIDS)
+        self.assertFalse(ActivityVideo.in_activity(vid))
+        # 已加载时直接添加
+        ActivityVideo._add_vid(vid)
+        self.assertTrue(ActivityVideo.in_activity(vid))
+        # 加载期间新增的视频: 添加时集合不存在, 加载结果中也没有
+        vid = str(ObjectId())
+        Redis.delete(ActivityVideo.ACTIVITY_VIDS)
+        ActivityVideo._add_vid(vid)
+        self.assertTrue(ActivityVideo.in_activity(vid))
+        self.assertFalse(ActivityVideo.in_activity(str(ObjectId())))
+        # 其他请求正在加载时查询数据库
+        vid = ObjectId()
+        _id = ActivityVideo.collection.insert_one({'video_id': vid}).inserted_id
+        Redis.delete(ActivityVideo.ACTIVITY_VIDS)
+        Redis.setex('lock:%s' % (ActivityVideo.ACTIVITY_VIDS), 10, 1)
+        self.assertTrue(ActivityVideo.in_activity(str(vid)))
+        ActivityVideo.collection.delete_one({'_id': _id})
+        Redis.delete(ActivityVideo.ACTIVITY_VIDS, ActivityVideo.RECENT_VIDS)
+
+    def test_unique_stats(self):
+        target = UniqueStats.VIDEO % ('test')
+        end = datetime.date.today() - datetime.timedelta(days=1)
+        begin = end - datetime.timedelta(days=1)
+        for day in UniqueStats.days(begin, end):
+            Redis.delete(UniqueStats.DAILY_KEY % ({'target': target, 'day': day}))
+        Redis.delete(UniqueStats.MERGED_KEY % ({'target': target, 'begin': begin.strftime('%Y%m%d'),
+                                                'end': end.strftime('%Y%m%d')}))
+        ts = time.mktime(begin.timetuple())
+        for uid in ['a', 'b', 'a']:
+            UniqueStats.record(target, uid, ts)
+        for uid in ['b', 'c']:
+            UniqueStats.record(target, uid, ts + 86400)
+        self.assertListEqual(UniqueStats.daily(target, begin, end),
+                             [(begin.strftime('%Y%m%d'), 2), (end.strftime('%Y%m%d'), 2)])
+        self.assertEqual(UniqueStats.count(target, begin, end), 3)
+        # 已结束的时间段使用合并结果
+        self.assertEqual(UniqueStats.count(target, begin, end), 3)
+
+    def test_credit_ledger(self):
+        uid = str(ObjectId())
+        uc = UserCredit.get_or_create_user_credit(uid)
+        self.assertTrue(uc.add_gold(100, const.TASK, 'test:ledger:%s' % (uid)))
+        # 重复的操作只执行一次
+        self.assertTrue(uc.add_gold(100, const.TASK, 'test:ledger:%s' % (uid)))
+        self.assertEqual(uc.gold, 100)
+        self.assertFalse(uc.reduce_gold(150, const.GIFT))
+        self.assertTrue(uc.reduce_gold(30, const.GIFT))
+        self.assertEqual(UserCredit.get(UserCredit.user_id == uid).gold, 70)
+        self.assertListEqual(UserCredit.reconcile([uid]), [])
+
+    def test_task_progress(self):
+        uid = str(ObjectId())
+        task = Task.create(title='test', description='test', image='', cover='',
+                           task_type=task_model.DAILY_TASK, action=task_model.JOIN_COLLECT,
+                           activity_id='', num=3, product_id=1, product_num=1,
+                           task_platform=task_model.ALL_PLATFORM, button_action='')
+        Redis.delete(task_model.TASK_KEY)
+        task_model.CACHED_ACTION_TASKS.clear()
+        # 创建时初始化用户任务
+        UserCredit.get_or_create_user_credit(uid)
+        db_task = lambda: UserTask.get(UserTask.user_id == uid, UserTask.task_id == task.task_id)
+
+        def refresh():
+            yesterday = datetime.datetime.now() - datetime.timedelta(days=1)
+            UserCredit.update(task_at=yesterday).where(UserCredit.user_id == uid).execute()
+            UserTask.refresh_daily_tasks(uid)
+
+        # 进度先记录在Redis中, 读取时合并
+        UserTask.check_user_tasks(uid, task_model.JOIN_COLLECT)
+        self.assertEqual(UserTask.get_user_task(uid, task.task_id).finish_num, 1)
+        self.assertEqual(db_task().finish_num, 0)
+        # 写回数据库后扣除Redis中的进度
+        UserTask.flush_progress()
+        self.assertEqual(db_task().finish_num, 1)
+        self.assertFalse(Redis.exists(task_model.USER_TASK_PROGRESS_KEY % (uid)))
+        self.assertFalse(Redis.sismember(task_model.TASK_PROGRESS_DIRTY_KEY, uid))
+        self.assertEqual(UserTask.get_user_task(uid, task.task_id).finish_num, 1)
+        # 任务完成时立即写入数据库, 只写入一次
+        UserTask.check_user_tasks(uid, task_model.JOIN_COLLECT, 2)
+        UserTask.check_user_tasks(uid, task_model.JOIN_COLLECT)
+        self.assertEqual((db_task().finish_num, db_task().task_status), (3, task_model.FINISHED))
+        self.assertFalse(Redis.exists(task_model.USER_TASK_PROGRESS_KEY % (uid)))
+        # 刷新每日任务时未写回的进度作废
+        refresh()
+        UserTask.check_user_tasks(uid, task_model.JOIN_COLLECT)
+        refresh()
+        UserTask.flush_progress()
+        self.assertEqual(db_task().finish_num, 0)
+        self.assertEqual(UserTask.get_user_task(uid, task.task_id).finish_num, 0)
+        # 今天已刷新过时不再刷新
+        UserTask.check_user_tasks(uid, task_model.JOIN_COLLECT)
+        UserTask.refresh_daily_tasks(uid)
+        self.assertEqual(UserTask.get_user_task(uid, task.task_id).finish_num, 1)
+
+        UserTask.delete().where(UserTask.user_id == uid).execute()
+        UserCredit.delete().where(UserCredit.user_id == uid).execute()
+        task.delete_instance()
+        Redis.delete(task_model.TASK_KEY, task_model.USER_TASK_KEY % (uid),
+                     task_model.USER_TASK_PROGRESS_KEY % (uid))
+        Redis.srem(task_model.TASK_PROGRESS_DIRTY_KEY, uid)
+        task_model.CACHED_ACTION_TASKS.clear()
 
     def test_config(self):
         self.assertTrue(Config.fetch('no_key', 10, int), 10)
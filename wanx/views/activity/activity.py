@@ -6,6 +6,7 @@ from wanx.models.activity import ActivityConfig, VoteVideo, ActivityVideo, Share
 from wanx.models.game import GameActivity
 from wanx.base import util, error
 from wanx.base.xredis import Redis
+from wanx.models.stats import UniqueStats
 from wanx.models.user import UserShare
 from wanx.models.video import TopicVideo
 from wanx.platforms.migu import Marketing
@@ -31,6 +32,9 @@ def activity_config(aid):
 
     if activity_config:
         activity_config = activity_config.format()
+        user = request.authed_user
+        UniqueStats.record(UniqueStats.ACTIVITY % (aid),
+                           str(user._id) if user else request.values.get('device', None))
 
     return {"activity_games": activity_games, "status": status, "buttons": [],
             'activity_config': activity_config}
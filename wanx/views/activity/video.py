@@ -8,7 +8,7 @@ from wanx.models.video import Video
 from wanx.models.activity import ActivityConfig, ActivityVideo, VoteVideo, Mteam, VoteMteam, \
     MatchCourse, TeamSupport, TeamSupportRecord, Battle
 from wanx.models.game import GameActivity
-from wanx.base import util, error
+from wanx.base import util, error, xcursor
 from wanx.base.guard import Guard
 from wanx.base.xredis import Redis
 
@@ -105,8 +105,10 @@ def activity_popular_videos(aid):
     :uri: activity/<string:aid>/popular/videos
     :param page: 页码
     :param nbr: 每页数量
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略page
     :param device: 终端ID
-    :returns: {'activity_videos': list, 'end_page': bool, 'activity_config': Object }
+    :returns: {'activity_videos': list, 'end_page': bool, 'activity_config': Object,
+               'cursor': str}
     """
 
     params = request.values
@@ -119,6 +121,14 @@ def activity_popular_videos(aid):
         return error.ActivityNotExist
     sort = activity_config.sort
 
+    if 'cursor' in params:
+        activity_videos, cursor, end_page = xcursor.paginate(
+            lambda cursor, num: ActivityVideo.popular_video_items(aid, sort, num, cursor),
+            lambda avids: [v.format() for v in ActivityVideo.get_list(avids)],
+            pagesize, params.get('cursor'))
+        return {'activity_videos': activity_videos, 'end_page': end_page,
+                'activity_config': activity_config.format(), 'cursor': cursor}
+
     avids = ActivityVideo.popular_video_ids(aid, sort, page, pagesize)
     activity_videos.extend([v.format() for v in ActivityVideo.get_list(avids)])
     return {'activity_videos': activity_videos, 'end_page': len(avids) != pagesize,
@@ -133,9 +143,10 @@ def latest_video(aid):
     :uri: activity/<string:aid>/video/current
     :param maxs: 最后时间, 0代表当前时间
     :param nbr: 每页数量
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略maxs
     :param device: 终端ID
     :returns: {'activity_videos': list, 'end_page': bool, 'activity_config': Object,
-               'maxs': timestamp}
+               'maxs': timestamp, 'cursor': str}
     """
 
     params = request.values
@@ -147,6 +158,14 @@ def latest_video(aid):
     if not activity_config:
         return error.ActivityNotExist
 
+    if 'cursor' in params:
+        avideos, cursor, end_page = xcursor.paginate(
+            lambda cursor, num: ActivityVideo.latest_video_items(aid, num, cursor),
+            lambda avids: [v.format() for v in ActivityVideo.get_list(avids)],
+            pagesize, params.get('cursor'))
+        return {'activity_videos': avideos, 'end_page': end_page,
+                'activity_config': activity_config.format(), 'cursor': cursor}
+
     avideos = list()
     avids = list()
     while len(avideos) < pagesize:
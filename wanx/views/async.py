@@ -2,13 +2,12 @@
 from flask import request
 from wanx import app
 from wanx.base import util, error
-from wanx.base.xredis import MRedis
+from wanx.base.xpubsub import MsgMux
 from wanx.models.user import User
 from wanx.models.msg import SysMessage
 
 import json
 import time
-import gevent
 
 from wanx.platforms import Migu
 
@@ -55,18 +54,14 @@ def async_msg():
     while len(msgs) <= 0 and retry_times < 10:
         ts = time.time()
         if user:
-            pubsub = MRedis.pubsub()
-            with gevent.Timeout(retry_seconds, False):
-                user_channel = User.USER_ASYNC_MSG % ({'uid': uid})
-                pubsub.subscribe(user_channel)
-                for item in pubsub.listen():
-                    if item['type'] == 'message':
-                        msgs.append(item['data'])
-                        break
-                pubsub.unsubscribe(user_channel)
-
-            pubsub.close()
-            msgs = [json.loads(m) for m in msgs]
+            user_channel = User.USER_ASYNC_MSG % ({'uid': uid})
+            begin = time.time()
+            data = MsgMux.wait(user_channel, retry_seconds)
+            if data:
+                msgs.append(json.loads(data))
+            elif time.time() - begin < retry_seconds:
+                # 超过等待上限时降级为定时检查
+                time.sleep(retry_seconds - (time.time() - begin))
 
             # 获取发给用户的系统消息
             for sys_msg in SysMessage.sys_user_messages(ts, uid):
@@ -76,29 +71,10 @@ def async_msg():
             time.sleep(retry_seconds)
 
         # 获取并过滤系统消息（平台、渠道、版本、用户组、有效期）
-        for msg in SysMessage.sys_new_messages(ts, time.time()):
-            if msg.os and msg.os not in ['all', os]:
-                continue
-
-            if (msg.version_code_mix and msg.version_code_mix > version_code) or \
-                    (msg.version_code_max and msg.version_code_max < version_code):
-                continue
-
-            if channels and msg.channels and channels not in msg.channels:
-                continue
-
-            if msg.login == 'login' and (not uid or not msg.user_in_group(str(msg.group), uid)):
-                continue
-
-            if msg.province and not province:
-                continue
-
-            if msg.province and province and province not in msg.province:
-                continue
-
-            _msg = dict(obj_type='SysMessage', obj_id=str(msg._id), count=1)
-            msgs.append(_msg)
-            break
+        sys_msgs = SysMessage.feed_messages(ts, time.time(), os, version_code, channels,
+                                            province, uid)
+        if sys_msgs:
+            msgs.append(dict(obj_type='SysMessage', obj_id=str(sys_msgs[0]._id), count=1))
 
         retry_times += 1
 
@@ -10,7 +10,7 @@ from wanx.models.task import UserTask, COMMENT_VIDEO
 from wanx.models.gift import UserGiftLog
 from wanx.models.activity import ActivityVideo, ActivityConfig
 from wanx import app
-from wanx.base import util, error, const
+from wanx.base import util, error, const, xcursor
 
 import time
 
@@ -160,7 +160,8 @@ def video_comments(vid):
     :param maxs: 最后时间, 0代表当前时间, 无此参数按page来分页
     :param page: 页码(数据可能有重复, 建议按照maxs分页)
     :param nbr: 每页数量
-    :returns: {'comments': list, 'end_page': bool, 'maxs': timestamp}
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略maxs和page
+    :returns: {'comments': list, 'end_page': bool, 'maxs': timestamp, 'cursor': str}
     """
     params = request.values
     maxs = params.get('maxs', None)
@@ -168,6 +169,12 @@ def video_comments(vid):
     page = int(params.get('page', 1))
     pagesize = int(params.get('nbr', 10))
 
+    if 'cursor' in params:
+        comments, cursor, end_page = xcursor.paginate(
+            lambda cursor, num: _video_comment_items(vid, num, cursor),
+            _load_comment_items, pagesize, params.get('cursor'), key=lambda m: m[0])
+        return {'comments': _with_replies(comments), 'end_page': end_page, 'cursor': cursor}
+
     comments = list()
     cids = list()
     next_maxs = None
@@ -194,6 +201,33 @@ def video_comments(vid):
         next_maxs = comments[-1]['create_at'] if comments else 1000
         end_page = (len(cids) + len(gift_logs)) < pagesize
 
+    return {'comments': _with_replies(comments), 'end_page': end_page, 'maxs': next_maxs}
+
+
+def _video_comment_items(vid, pagesize, cursor):
+    """按时间倒序合并视频的评论和礼物
+    返回: [((id, gift_log), timestamp), ...], 评论的gift_log为None
+    """
+    items = [((cid, None), score) for cid, score in
+             Comment.video_comment_items(vid, pagesize, cursor)]
+    items.extend([((gid, gl), score) for gid, gl, score in
+                  UserGiftLog.video_gift_items(vid, pagesize, cursor)])
+    return xcursor.sort_items(items, key=lambda m: m[0])[:pagesize]
+
+
+def _load_comment_items(members):
+    cids = [_id for _id, gl in members if gl is None]
+    comments = dict((str(c._id), c.format()) for c in Comment.get_list(cids))
+    ret = list()
+    for _id, gl in members:
+        if gl is not None:
+            ret.append(gl.format())
+        elif _id in comments:
+            ret.append(comments[_id])
+    return ret
+
+
+def _with_replies(comments):
     # 评论增加3个回复
     for comment in comments:
         if 'comment_id' in comment:
@@ -202,8 +236,7 @@ def video_comments(vid):
             comment['type'] = 'comment'
         else:
             comment['type'] = 'gift'
-
-    return {'comments': comments, 'end_page': end_page, 'maxs': next_maxs}
+    return comments
 
 
 @app.route('/replies/create', methods=['GET', 'POST'])
@@ -141,7 +141,7 @@ def datang_play_video(vid):
         }
         return jsonify(result)
 
-    video.update_model({'$inc': {'vv': 1}})
+    DaTangVideo.incr_counter(video._id, 'vv', 1)
     return redirect(video.real_url())
 
 
@@ -3,15 +3,15 @@ from urlparse import urljoin
 
 from flask import request
 from wanx import app
-from wanx.base import util, error, const
+from wanx.base import util, error, const, xcursor
 from wanx.base.xredis import Redis
 from wanx.models.credit import UserCredit
 from wanx.models.live import AnchorWlist
 from wanx.models.product import Product, UserProduct, GiftExchangeCfg
-from wanx.models.gift import Gift, UserGiftLog, PayForGift, PayOrder
+from wanx.models.gift import Gift, UserGiftLog, PayForGift, PayOrder, GiftLeaderboard
 from wanx.models.user import User, UserCertify
 from wanx.models.msg import Message, GiftNum
-from wanx.models.video import Video
+from wanx.models.video import Video, HotVideoRank
 from wanx.models.xconfig import Config
 from wanx.platforms.xlive import Xlive
 from wanx.platforms.migu import Marketing
@@ -433,6 +433,7 @@ def send_gift():
         if video:
             Message.send_gift_msg(str(user._id), from_id, 'gift')
             video.update_model({'$inc': {'gift_count': 1, 'gift_num': num}})
+            HotVideoRank.record(video, 'gift', num)
 
     # 直播发送广播信息
     if ret and gift_from == const.FROM_LIVE:
@@ -485,25 +486,58 @@ def gift_top_users():
 
     :uri: /gifts/top_users
     :param user_id: 主播ID
+    :param live_id: 直播ID(可选, 传入时返回直播间排行)
+    :param period: 排行周期(可选) all:总榜, day:日榜, week:周榜
     :param page: 页码
     :param nbr: 每页数量
-    :return: {'users: list, 'end_page': bool}
+    :return: {'users: list, 'end_page': bool, 'my_rank': int, 'my_gold': int}
     """
     user = request.authed_user
     page = int(request.values.get('page', 1))
     pagesize = int(request.values.get('nbr', 10))
     user_id = request.values.get('user_id')
-    if not user_id:
-        error.InvalidArguments
+    live_id = request.values.get('live_id')
+    period = request.values.get('period', 'all')
+    if not user_id and not live_id:
+        return error.InvalidArguments
+
+    if live_id:
+        scope, target = GiftLeaderboard.LIVE, live_id
+    else:
+        scope, target = GiftLeaderboard.ANCHOR, user_id
+    start = (page - 1) * pagesize
+    uids = GiftLeaderboard.top(scope, target, period, start, start + pagesize - 1)
+    my_rank, my_gold = None, 0
+    if user:
+        my_rank, my_gold = GiftLeaderboard.rank(scope, target, str(user._id), period)
 
-    uids = UserGiftLog.get_top_sender_ids(user_id, page, pagesize)
     users = []
     for uid, gold in uids:
         user = User.get_one(uid).format(exclude_fields=['is_followed'])
         user['total_gold'] = gold
         users.append(user)
 
-    return {'users': users, 'end_page': len(uids) != pagesize}
+    return {'users': users, 'end_page': len(uids) != pagesize,
+            'my_rank': my_rank, 'my_gold': my_gold}
+
+
+def _gift_log_id(log):
+    return log.group_key
+
+
+def _format_gift_logs(logs):
+    return [log.format_log() for log in logs]
+
+
+def _cursor_gift_logs(uid, mode, pagesize, cursor):
+    """按游标分页获取礼物交易记录
+    """
+    def fetch(cursor, num):
+        return UserGiftLog.user_log_items(uid, mode, num, cursor)
+
+    logs, cursor, end_page = xcursor.paginate(fetch, _format_gift_logs, pagesize, cursor,
+                                              key=_gift_log_id)
+    return {'logs': logs, 'end_page': end_page, 'cursor': cursor}
 
 
 @app.route('/gifts/log', methods=('GET', 'POST'))
@@ -515,13 +549,17 @@ def gifts_history():
     :param mode: 类型 1:送礼记录，2：收礼记录
     :param page: 页码
     :param nbr: 每页数量
-    :return: {'logs': list, 'end_page': bool}
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略page
+    :return: {'logs': list, 'end_page': bool, 'cursor': str}
     """
     user = request.authed_user
     mode = int(request.values.get('mode', 1))
     page = int(request.values.get('page', 1))
     pagesize = int(request.values.get('nbr', 10))
 
+    if 'cursor' in request.values:
+        return _cursor_gift_logs(str(user._id), mode, pagesize, request.values.get('cursor'))
+
     logs = UserGiftLog.get_user_logs(str(user._id), mode, page, pagesize)
     if mode==1:
         query = [-1,0,1]
@@ -540,13 +578,17 @@ def gifts_history_search():
     :param mode: 类型 1:送礼记录，2：收礼记录
     :param page: 页码
     :param nbr: 每页数量
-    :return: {'logs': list, 'end_page': bool}
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略page
+    :return: {'logs': list, 'end_page': bool, 'cursor': str}
     """
     user = request.authed_user
     mode = int(request.values.get('mode', 1))
     page = int(request.values.get('page', 1))
     pagesize = int(request.values.get('nbr', 10))
 
+    if 'cursor' in request.values:
+        return _cursor_gift_logs(str(user._id), mode, pagesize, request.values.get('cursor'))
+
     logs = UserGiftLog.get_user_logs(str(user._id), mode, page, pagesize)
     if mode==1:
         query = [-1,0,1]
@@ -6,10 +6,12 @@ from wanx.base.guard import Guard
 from wanx.models.home import (Banner, HomeCategory, HomeCategoryConfig, BannerSdk, LaunchAds,
                               Popup, PopupLog, FixedBanner, BugReport, H5Counter, BottomPhoto,
                               BottomColor, TitleColor, GameRecommend)
-from wanx.models.video import Video, GameRecommendVideo
+from wanx.models.video import Video, GameRecommendVideo, HotVideoRank
 from wanx.models.game import Game, HotGame, UserSubGame
 from wanx.models.user import User, UserDevice
 from wanx.models.activity import ActivityVideo
+from wanx.models.search import SearchCache, HotKeyword
+from wanx.models.stats import UniqueStats
 from wanx.models.xconfig import Config
 from wanx.platforms.xlive import Xlive
 from wanx.platforms.migu import Migu
@@ -42,6 +44,7 @@ def daily_visit():
     if device and appid:
         uid = str(user._id) if user else None
         UserDevice.create_or_update_device(device, uid, appid, action)
+    UniqueStats.record(UniqueStats.VISIT, device)
     return {}
 
 
@@ -596,10 +599,11 @@ def search():
     if not stype or not keyword:
         return error.InvalidArguments
 
+    HotKeyword.record(keyword)
     users = games = videos = activity_videos = lives = list()
 
     if stype in ['user', 'all']:
-        uids = User.search(keyword)
+        uids = SearchCache.search_ids('user', keyword)
         users = [u.format() for u in User.get_list(uids)]
         users = sorted(users, key=lambda x: x['follower_count'])
 
@@ -607,23 +611,23 @@ def search():
         ua_filter = None
         if ua and platform == 'android' and int(version_code) >= 64:
             ua_filter = ua
-        gids = Game.search(keyword, ua_filter)
+        gids = SearchCache.search_ids('game', keyword, ua_filter)
         games = [g.format() for g in Game.get_list(gids, check_online=False)]
 
     if stype in ['video', 'all']:
-        vids = Video.search(keyword)
+        vids = SearchCache.search_ids('video', keyword)
         videos = [v.format() for v in Video.get_list(vids)]
 
     if stype in ['activity_video']:
         activity_id = params.get('activity_id', None)
-        uids = User.search(keyword)
+        uids = SearchCache.search_ids('user', keyword)
         _ids = ActivityVideo.get_activity_video_by_authors(uids, activity_id)
-        avids = ActivityVideo.search(keyword, activity_id)
+        avids = SearchCache.search_ids('activity_video', keyword, activity_id)
         avids.extend(_ids)
         activity_videos = [v.format() for v in ActivityVideo.get_list(set(avids))]
 
     if stype in ['live_number', 'all']:
-        uids = User.search_live_number(keyword)
+        uids = SearchCache.search_ids('live_number', keyword)
         livers = [u.format() for u in User.get_list(uids)]
         livers = sorted(livers, key=lambda x: x['follower_count'])
         lives_map = {}
@@ -643,6 +647,24 @@ def search():
             'activity_videos': activity_videos, 'lives': lives}
 
 
+@app.route('/search/suggest', methods=['GET'])
+@util.jsonapi()
+def search_suggest():
+    """搜索联想词 (GET)
+
+    :uri: /search/suggest
+    :param keyword: 已输入的关键字(支持拼音和首字母)
+    :param nbr: 返回数量
+    :returns: {'keywords': list}
+    """
+    params = request.values
+    keyword = params.get('keyword', '').strip()
+    num = min(int(params.get('nbr', 10)), 20)
+    if not keyword:
+        return {'keywords': [kw for kw, _ in HotKeyword.top_keywords(num)]}
+    return {'keywords': HotKeyword.suggest(keyword, num)}
+
+
 @app.route('/fixed_banners', methods=['GET'])
 @util.jsonapi()
 def fixed_banner():
@@ -845,6 +867,7 @@ def shipment_mg():
         if video:
             Message.send_gift_msg(str(user._id), from_id, 'gift')
             video.update_model({'$inc': {'gift_count': 1, 'gift_num': num}})
+            HotVideoRank.record(video, 'gift', num)
 
     # 直播发送广播信息
     if ret and gift_from == const.FROM_LIVE:
@@ -24,8 +24,8 @@
 """
 from flask import request
 from wanx import app
-from wanx.base import util, error
-from wanx.models.msg import Message, SysMessage, Letter, Suggestion
+from wanx.base import util, error, xcursor
+from wanx.models.msg import Message, SysMessage, Letter, Suggestion, Inbox
 from wanx.models.user import User
 
 import time
@@ -40,7 +40,9 @@ def user_msg_home():
 
     :uri: /messages/home
     :param lrt: 系统消息最后阅读时间
-    :returns: {'msgs': list, 'sys_msgs': list, 'letters': list}
+    :param cursor: 点赞&评论消息分页游标(可选), 首页传空字符串, 不传时返回全部消息
+    :param nbr: 点赞&评论消息每页数量
+    :returns: {'msgs': list, 'sys_msgs': list, 'letters': list, 'cursor': str, 'end_page': bool}
     """
     user = request.authed_user
     params = request.values
@@ -72,40 +74,30 @@ def user_msg_home():
     else:
         ts_user = (cts - 7 * 24 * 3600)
 
-    sys_msgs = []
     # 过滤系统消息（平台、渠道、版本、用户组、有效期）
-    for msg in SysMessage.sys_new_messages(ts, cts):
-        if msg.os and msg.os not in ['all', os]:
-            continue
-
-        if (msg.version_code_mix and msg.version_code_mix > version_code) or\
-                (msg.version_code_max and msg.version_code_max < version_code):
-            continue
-
-        if channels and msg.channels and channels not in msg.channels:
-            continue
-
-        if msg.login == 'login' and (not uid or not msg.user_in_group(str(msg.group), uid)):
-            continue
-
-        if msg.province and not province:
-            continue
-
-        if msg.province and province and province not in msg.province:
-            continue
-
-        sys_msgs.append(msg.format())
+    feed = SysMessage.feed_messages(ts, cts, os, version_code, channels, province, uid)
+    sys_msgs = [msg.format() for msg in feed]
 
     msgs = []
     letters = []
+    ret = dict()
     if user:
         uid = str(user._id)
 
         # 用户系统消息推送
         sys_user_msg = [msg.format() for msg in SysMessage.sys_user_messages(ts_user, uid)]
         sys_msgs.extend(sys_user_msg)
-
-        msgs = [msg.format() for msg in Message.user_new_messages(uid)]
+        Inbox.reset(uid, Inbox.SYS)
+
+        if 'cursor' in params:
+            pagesize = int(params.get('nbr', 20))
+            msgs, cursor, end_page = xcursor.paginate(
+                lambda cursor, num: Inbox.items(uid, num, cursor),
+                lambda ids: [msg.format() for msg in Message.get_messages(ids)],
+                pagesize, params.get('cursor'))
+            ret.update({'cursor': cursor, 'end_page': end_page})
+        else:
+            msgs = [msg.format() for msg in Message.user_new_messages(uid)]
         letters = list()
         _letters = Letter.new_letter_count(uid)
         for _letter in _letters:
@@ -115,7 +107,29 @@ def user_msg_home():
                 count=_letter['count']
             )
             letters.append(temp)
-    return {'msgs': msgs, 'sys_msgs': sys_msgs, 'letters': letters}
+    ret.update({'msgs': msgs, 'sys_msgs': sys_msgs, 'letters': letters})
+    return ret
+
+
+@app.route('/messages/badge', methods=['GET'])
+@util.jsonapi(login_required=True)
+def user_msg_badge():
+    """获取未读消息数(GET&LOGIN)
+
+    :uri: /messages/badge
+    :param lrt: 系统消息最后阅读时间
+    :returns: {'msgs': int, 'letters': int, 'sys_msgs': int}
+    """
+    user = request.authed_user
+    params = request.values
+    uid = str(user._id)
+    ts = float(params.get('lrt', 0) or 0)
+    counts = Inbox.unread(uid)
+    # 全站系统消息从进程内快照中统计
+    counts['sys_msgs'] += len(SysMessage.feed_messages(
+        ts, time.time(), params.get('os', None), int(params.get('version_code', 0)),
+        params.get('channels', None), user.province, uid))
+    return counts
 
 
 @app.route('/messages/delete', methods=['GET', 'POST'])
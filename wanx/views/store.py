@@ -144,6 +144,10 @@ def exchange_product():
         if locked:
             return error.StoreError('兑换太频繁')
 
+        # 先扣除货币, 兑换失败时退回
+        if not uc.pay(item.credit_type, item.credit_value, const.EXCHANGE):
+            return error.StoreError('余额不足，无法兑换此物品哦！')
+
         extra = dict(
             migu_id=user.partner_migu['id'],
             phone=user.phone,
@@ -151,13 +155,8 @@ def exchange_product():
         )
         status = product.add_product2user(str(user._id), item.product_num, const.EXCHANGE, extra)
         if status == const.ORDER_FAILED:
+            uc.refund(item.credit_type, item.credit_value, const.EXCHANGE)
             return error.StoreError('兑换失败')
-        else:
-            # 扣除货币
-            if item.credit_type == const.SALE_GEM:
-                uc.reduce_gem(item.credit_value, const.EXCHANGE)
-            elif item.credit_type == const.SALE_GOLD:
-                uc.reduce_gold(item.credit_value, const.EXCHANGE)
 
     # 更新库存
     item.left_num -= 1
@@ -254,6 +253,10 @@ def draw_lottery():
             if locked:
                 return error.StoreError('抽奖太频繁')
 
+            # 先扣除货币, 兑换抽奖机会失败时退回
+            if not uc.pay(store.credit_type, store.credit_value, const.LOTTERY_REWAED):
+                return error.StoreError('余额不足，无法参与抽奖哦！')
+
             # 进行抽奖机会的兑换
             if not trigger:
                 ret = Marketing.execute_campaign(user.partner_migu['id'], user.phone,
@@ -262,12 +265,8 @@ def draw_lottery():
                 ret = Marketing.execute_campaign(user.partner_migu['id'], user.phone,
                                                  [store.campaign_id], trigger=trigger)
             if not ret or isinstance(ret, error.ApiError):
+                uc.refund(store.credit_type, store.credit_value, const.LOTTERY_REWAED)
                 return error.StoreError('兑换抽奖机会失败')
-            else:  # 扣除货币
-                if store.credit_type == const.SALE_GEM:
-                    uc.reduce_gem(store.credit_value, const.LOTTERY_REWAED)
-                elif store.credit_type == const.SALE_GOLD:
-                    uc.reduce_gold(store.credit_value, const.LOTTERY_REWAED)
 
     # 调用营销平台进行抽奖
     prize = Marketing.draw_lottery(user.partner_migu['id'], store.campaign_id)
@@ -631,10 +630,8 @@ def add_barrage_color(event_id):
             return error.StoreError('购买太频繁')
 
         # 扣除货币
-        if color.credit_type == const.SALE_GEM:
-            uc.reduce_gem(color.credit_value, const.BARRAGE)
-        elif color.credit_type == const.SALE_GOLD:
-            uc.reduce_gold(color.credit_value, const.BARRAGE)
+        if not uc.pay(color.credit_type, color.credit_value, const.BARRAGE):
+            return error.StoreError('余额不足，颜料还在调制中！')
 
     data = dict(
         event_id=event_id,
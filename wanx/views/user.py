@@ -9,7 +9,6 @@ from flask import request
 from wanx.base.log import print_log
 from wanx.base.spam import Spam
 from wanx.base.xredis import Redis
-from wanx.base.xpinyin import Pinyin
 from wanx.models.msg import SysMessage
 from wanx.models.user import User, FriendShip, UserShare, UserCertify
 from wanx.models.game import Game, UserSubGame
@@ -19,7 +18,7 @@ from wanx.models.task import UserTask, FOLLOW_USER, SHARE_VIDEO
 from wanx.models.live import Event
 from wanx.platforms import ChargeSDK, WeiXin, QQ, SMS, Migu, Xlive
 from wanx import app
-from wanx.base import error, const, util
+from wanx.base import error, const, util, xcursor
 
 import os
 import random
@@ -938,6 +937,7 @@ def followers(uid):
     :param maxs: 最后时间, 0代表当前时间, 无此参数按page来分页
     :param page: 页码(数据可能有重复, 建议按照maxs分页)
     :param nbr: 每页数量
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略maxs和page
     :returns: {'users': list}
     """
     params = request.values
@@ -946,6 +946,13 @@ def followers(uid):
     page = int(params.get('page', 1))
     pagesize = int(params.get('nbr', 10))
 
+    if 'cursor' in params:
+        users, cursor, end_page = xcursor.paginate(
+            lambda cursor, num: FriendShip.follower_items(uid, num, cursor),
+            lambda uids: [u.format() for u in User.get_list(uids)],
+            pagesize, params.get('cursor'))
+        return {'users': users, 'end_page': end_page, 'cursor': cursor}
+
     users = list()
     uids = list()
     while len(users) < pagesize:
@@ -1088,15 +1095,14 @@ def contacts():
     user = request.authed_user
 
     uids = FriendShip.contact_ids(str(user._id))
-    _users = [u.format(exclude_fields=['is_followed']) for u in User.get_list(uids)]
-    # 根据nickname(中文转换为拼音)进行排序
-    pinyin = Pinyin()
+    # 根据nickname的拼音(设置昵称时已保存)进行排序
     users = []
-    for u in _users:
-        u['nickpy'] = pinyin.get_pinyin(u['nickname'], '')
-        users.append(u)
+    for u in User.get_list(uids):
+        data = u.format(exclude_fields=['is_followed'])
+        data['nickpy'] = u.nickpy if u.nickpy is not None else User.nickname_pinyin(u.nickname)[0]
+        users.append(data)
 
-    users = sorted(users, key=lambda x: x['nickpy'].lower())
+    users = sorted(users, key=lambda x: x['nickpy'])
     return {'users': users}
 
 
@@ -11,8 +11,10 @@ from wanx.base.xredis import Redis
 from wanx.models.home import Share
 from wanx.models.live import Event
 from wanx.models.show import ShowChannel
+from wanx.models.stats import UniqueStats
 from wanx.models.video import (Video, UserFaverVideo, UserLikeVideo, ReportVideo,
-                               VideoCategory, CategoryVideo, VideoTopic, TopicVideo, EditorVideo)
+                               VideoCategory, CategoryVideo, VideoTopic, TopicVideo, EditorVideo,
+                               FollowingTimeline, HotVideoRank)
 from wanx.models.game import UserSubGame, Game, CategoryGame
 from wanx.models.user import FriendShip
 from wanx.models.msg import Message
@@ -21,7 +23,7 @@ from wanx.models.user import User
 from wanx.models.task import UserTask, CREATE_VIDEO, PLAY_VIDEO
 from wanx.models.activity import ActivityConfig, ActivityVideo
 from wanx import app
-from wanx.base import util, error, const
+from wanx.base import util, error, const, xcursor
 from wanx.base.guard import Guard
 
 import time
@@ -31,6 +33,16 @@ from wanx.models.xconfig import ReportConfig
 from wanx.platforms import Xlive
 
 
+def _cursor_videos(fetch, pagesize, cursor, ex_fields):
+    """按游标分页获取视频列表
+    """
+    def load(vids):
+        return [v.format(exclude_fields=ex_fields) for v in Video.get_list(vids)]
+
+    videos, cursor, end_page = xcursor.paginate(fetch, load, pagesize, cursor)
+    return {'videos': videos, 'end_page': end_page, 'cursor': cursor}
+
+
 @app.route('/migu/videos/<string:vid>')
 @app.route('/videos/<string:vid>', methods=['GET'])
 @util.jsonapi()
@@ -184,10 +196,13 @@ def play_video(vid):
             'time': int(time.time() * 1000) - start,
         }
         return jsonify(result)
-    video.update_model({'$inc': {'vv': 1}})
+    # 播放量延迟写回数据库, 不删除视频缓存
+    Video.incr_counter(video._id, 'vv', 1)
+    UniqueStats.record(UniqueStats.VIDEO % (vid), uid or request.values.get('device', None))
+    HotVideoRank.record(video, 'play')
     # 如果是栏目视频，给对应频道增加播放量
     channel = ShowChannel.get_one(video.channel)
-    channel and channel.update_model({'$inc': {'play_count': 1}})
+    channel and ShowChannel.incr_counter(channel._id, 'play_count', 1)
 
     # 观看视频任务检查
     if uid:
@@ -200,8 +215,7 @@ def play_video(vid):
         aconfig = ActivityConfig.get_one(str(avideo['activity_id']), check_online=False)
         if aconfig and aconfig.status == const.ACTIVITY_BEGIN \
                 and (aconfig.begin_at < ts and aconfig.end_at > ts):
-            avideo = ActivityVideo.get_one(avideo['_id'], check_online=False)
-            avideo.update_model({'$inc': {'vv': 1}})
+            ActivityVideo.incr_counter(avideo['_id'], 'vv', 1)
 
     return redirect(video.real_url())
 
@@ -294,8 +308,7 @@ def like_video():
                     aconfig = ActivityConfig.get_one(str(avideo['activity_id']), check_online=False)
                     if aconfig and aconfig.status == const.ACTIVITY_BEGIN \
                             and (aconfig.begin_at < ts and aconfig.end_at > ts):
-                        avideo = ActivityVideo.get_one(avideo['_id'], check_online=False)
-                        avideo.update_model({'$inc': {'like_count': 1}})
+                        ActivityVideo.incr_counter(avideo['_id'], 'like_count', 1)
 
     return {}
 
@@ -328,8 +341,7 @@ def unlike_video():
             aconfig = ActivityConfig.get_one(str(avideo['activity_id']), check_online=False)
             if aconfig and aconfig.status == const.ACTIVITY_BEGIN \
                     and (aconfig.begin_at < ts and aconfig.end_at > ts):
-                avideo = ActivityVideo.get_one(avideo['_id'], check_online=False)
-                avideo.update_model({'$inc': {'like_count': -1}})
+                ActivityVideo.incr_counter(avideo['_id'], 'like_count', -1)
     return {}
 
 
@@ -544,7 +556,8 @@ def latest_video():
     :param maxs: 最后时间, 0代表当前时间, 无此参数按page来分页
     :param page: 页码
     :param nbr: 每页数量
-    :returns: {'videos': list, 'end_page': bool, 'maxs': timestamp}
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略maxs和page
+    :returns: {'videos': list, 'end_page': bool, 'maxs': timestamp, 'cursor': str}
     """
     params = request.values
     maxs = params.get('maxs', None)
@@ -552,6 +565,11 @@ def latest_video():
     page = int(params.get('page', 1))
     pagesize = int(params.get('nbr', 10))
 
+    if 'cursor' in params:
+        ex_fields = ['is_favored', 'author__is_followed', 'game__subscribed']
+        return _cursor_videos(lambda cursor, num: Video.latest_video_items(num, cursor),
+                              pagesize, params.get('cursor'), ex_fields)
+
     videos = list()
     vids = list()
     while len(videos) < pagesize:
@@ -702,7 +720,8 @@ def user_videos(uid):
     :param maxs: 最后时间, 0代表当前时间, 无此参数按page来分页
     :param page: 页码(数据可能有重复, 建议按照maxs分页)
     :param nbr: 每页数量
-    :returns: {'videos': list, 'end_page': bool, 'maxs': timestamp}
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略maxs和page(仅支持不传game_id)
+    :returns: {'videos': list, 'end_page': bool, 'maxs': timestamp, 'cursor': str}
     """
     params = request.values
     maxs = params.get('maxs', None)
@@ -713,6 +732,11 @@ def user_videos(uid):
     if gid and not Game.get_one(gid):
         return error.GameNotExist
 
+    if 'cursor' in params and not gid:
+        ex_fields = ['is_favored', 'is_liked', 'author__is_followed', 'game__subscribed']
+        return _cursor_videos(lambda cursor, num: Video.user_video_items(uid, num, cursor),
+                              pagesize, params.get('cursor'), ex_fields)
+
     videos = list()
     vids = list()
     while len(videos) < pagesize:
@@ -781,7 +805,8 @@ def game_videos(gid):
     :param page: 页码(数据可能有重复, 建议按照maxs分页)
     :param nbr: 每页数量
     :param orderby: 排序方式 ('create_at': 创建时间, 'vv':播放次数)
-    :returns: {'videos': list, 'end_page': bool, 'maxs': timestamp}
+    :param cursor: 分页游标, 首页传空字符串, 传入时忽略maxs和page(仅支持按创建时间排序)
+    :returns: {'videos': list, 'end_page': bool, 'maxs': timestamp, 'cursor': str}
     """
     params = request.values
     orderby = params.get('orderby', 'create_at')
@@ -793,6 +818,11 @@ def game_videos(gid):
     page = int(params.get('page', 1))
     pagesize = int(params.get('nbr', 10))
 
+    if 'cursor' in params and orderby != 'vv':
+        ex_fields = ['is_favored', 'is_liked', 'author__is_followed', 'game__subscribed']
+        return _cursor_videos(lambda cursor, num: Video.game_video_items(gid, num, cursor),
+                              pagesize, params.get('cursor'), ex_fields)
+
     videos = list()
     vids = list()
     while len(videos) < pagesize:
@@ -896,14 +926,26 @@ def user_followings_videos(uid):
     page = int(params.get('page', 1))
     pagesize = int(params.get('nbr', 10))
     gid = params.get('game_id', None)
-    uids = FriendShip.following_ids(str(user._id))
-    uids = [ObjectId(_uid) for _uid in uids]
+    ex_fields = ['is_favored', 'author__is_followed', 'game__subscribed']
 
     videos = list()
     vids = list()
+    # 按maxs分页时从关注视频时间线读取
+    if maxs is not None and not gid:
+        end_page = False
+        while len(videos) < pagesize and not end_page:
+            nbr = pagesize - len(videos)
+            items = FollowingTimeline.timeline_ids(str(user._id), nbr, maxs)
+            vids = [vid for vid, _ in items]
+            videos.extend([v.format(exclude_fields=ex_fields) for v in Video.get_list(vids)])
+            maxs = items[-1][1] if items else 1000
+            end_page = len(items) < nbr
+        return {'videos': videos, 'end_page': end_page, 'maxs': maxs}
+
+    uids = FriendShip.following_ids(str(user._id))
+    uids = [ObjectId(_uid) for _uid in uids]
     while len(videos) < pagesize:
         vids = Video.users_video_ids(uids, gid, page, pagesize, maxs)
-        ex_fields = ['is_favored', 'author__is_followed', 'game__subscribed']
         videos.extend([v.format(exclude_fields=ex_fields) for v in Video.get_list(vids)])
 
         # 如果按照maxs分页, 不足pagesize个记录则继续查询
@@ -9,10 +9,11 @@ from wanx.base.log import print_log
 from wanx.base.spam import Spam
 from wanx.models.activity import Battle
 from wanx.models.live import WatchLiveTask, WatchLiveTaskItem, LiveRedPacket, UserRedPacket, \
-    LiveRedPacketItem, \
+    LiveRedPacketItem, LivePlayRules, \
     HotWords
 from wanx.models.product import Product
 from wanx.models.store import UserLiveOrder
+from wanx.models.stats import UniqueStats
 from wanx.platforms import Migu
 from wanx.platforms.migu import Marketing
 from wanx.platforms.xlive import Xlive
@@ -108,6 +109,33 @@ def get_game_lives():
     return {'lives': lives}
 
 
+def _play_rewards(live, uid, user_tids, os, version_code, channels, province):
+    """观看直播时可参与的(任务, 红包抽奖机会, 观看时长红包)
+    """
+    red_packet, red_packet_count = None, 0
+    _ids = UserRedPacket.user_red_packets(uid)
+    lrp_ids = set()
+    for urp in UserRedPacket.get_list(_ids):
+        lrp_ids.add(str(urp.active_id))
+        if not LiveRedPacket.get_one(urp.active_id):
+            continue
+        if urp.source == 0:
+            # 过滤掉所有直播间抽奖机会
+            continue
+        if urp.chance <= 0:
+            continue
+        if red_packet is None or red_packet.expire_at > urp.expire_at:
+            red_packet = urp
+        red_packet_count += 1
+    red_packet = red_packet.format(red_packet_count) if red_packet else red_packet
+
+    task, cdrp = LivePlayRules.current().match(live, uid, user_tids, lrp_ids, os,
+                                               version_code, channels, province)
+    task = task.format(uid, user_tids.get(str(task._id))) if task else None
+    cdrp = cdrp.format() if cdrp else None
+    return task, red_packet, cdrp
+
+
 @app.route('/lives/info', methods=['GET'])
 @util.jsonapi()
 def get_live_info():
@@ -137,7 +165,7 @@ def get_live_info():
     if user:
         uid = str(user._id)
         UserTask.check_user_tasks(uid, PLAY_LIVE, 1)
-        task_ids = WatchLiveTask.get_user_tids(uid)
+        user_tids = WatchLiveTask.get_user_tids(uid)
 
         phone = str(user.phone)
 
@@ -152,95 +180,10 @@ def get_live_info():
                 province = None
 
     else:
-        task_ids = WatchLiveTask.get_live_tids()
-
-    task = None
-    for b in WatchLiveTask.get_list(task_ids):
-        if b.os and b.os not in ['all', os]:
-            continue
-
-        if (b.version_code_mix and b.version_code_mix > version_code) or \
-                (b.version_code_max and b.version_code_max < version_code):
-            continue
-
-        if channels and b.channels and channels not in b.channels:
-            continue
-
-        if b.login == 'login' and (not uid or not b.user_in_group(str(b.group), uid)):
-            continue
-
-        if b.province and not province:
-            continue
-
-        if b.province and province and province not in b.province:
-            continue
-
-        task = b.format(uid)
-        break
-
-    red_packet, red_packet_count = None, 0
-    _ids = UserRedPacket.user_red_packets(uid)
-    lrp_ids = []
-    for urp in UserRedPacket.get_list(_ids):
-        lrp_ids.append(str(urp.active_id))
-        if not LiveRedPacket.get_one(urp.active_id):
-            continue
-        if urp.source == 0:
-            # 过滤掉所有直播间抽奖机会
-            continue
-        if urp.chance <= 0:
-            continue
-        if red_packet is None or red_packet.expire_at > urp.expire_at:
-            red_packet = urp
-        red_packet_count += 1
-    red_packet = red_packet.format(red_packet_count) if red_packet else red_packet
-
-    cdrp = None
-    rp_ids = LiveRedPacket.all_ids()
-    for rp in LiveRedPacket.get_list(rp_ids):
-        # 过滤非观看时长红包
-        if rp.mode != 2:
-            continue
-        # 过滤已参与的红包活动id
-        if str(rp._id) in lrp_ids:
-            continue
-
-        if rp.os and rp.os not in ['all', os]:
-            continue
-
-        if (rp.version_code_mix and rp.version_code_mix > version_code) or \
-                (rp.version_code_max and rp.version_code_max < version_code):
-            continue
-
-        if channels and rp.channels and channels not in rp.channels:
-            continue
-
-        if rp.login == 'login' and (not uid or not rp.user_in_group(str(rp.group), uid)):
-            continue
-
-        if rp.province and not province:
-            continue
-
-        if rp.province and province and province not in rp.province:
-            continue
-
-        # 过滤主播
-        live_authors = [] if not rp.live_authors else rp.live_authors.split('\r\n')
-        if live_authors and live['user_id'] not in live_authors:
-            continue
-
-        # 过滤游戏
-        live_games = [] if not rp.live_games else rp.live_games.split('\r\n')
-        if live_games and live['game_id'] not in live_games:
-            continue
+        user_tids = {}
 
-        # 过滤关键字
-        key_words = [] if not rp.keyword else rp.keyword.split(u',')
-        if key_words and not any(map(lambda x: x in live['name'], key_words)):
-            continue
-
-        cdrp = rp.format()
-        break
+    task, red_packet, cdrp = _play_rewards(live, uid, user_tids, os, version_code,
+                                           channels, province)
 
     battle = Battle.get_live_battle(live['user_id'], live['name'], device)
     live['from_following'] = False
@@ -305,7 +248,7 @@ def play_live():
     if user:
         uid = str(user._id)
         UserTask.check_user_tasks(uid, PLAY_LIVE, 1)
-        task_ids = WatchLiveTask.get_user_tids(uid)
+        user_tids = WatchLiveTask.get_user_tids(uid)
 
         phone = str(user.phone)
 
@@ -320,95 +263,11 @@ def play_live():
                 province = None
 
     else:
-        task_ids = WatchLiveTask.get_live_tids()
-
-    task = None
-    for b in WatchLiveTask.get_list(task_ids):
-        if b.os and b.os not in ['all', os]:
-            continue
-
-        if (b.version_code_mix and b.version_code_mix > version_code) or \
-                (b.version_code_max and b.version_code_max < version_code):
-            continue
-
-        if channels and b.channels and channels not in b.channels:
-            continue
-
-        if b.login == 'login' and (not uid or not b.user_in_group(str(b.group), uid)):
-            continue
-
-        if b.province and not province:
-            continue
-
-        if b.province and province and province not in b.province:
-            continue
-
-        task = b.format(uid)
-        break
-
-    red_packet, red_packet_count = None, 0
-    _ids = UserRedPacket.user_red_packets(uid)
-    lrp_ids = []
-    for urp in UserRedPacket.get_list(_ids):
-        lrp_ids.append(str(urp.active_id))
-        if not LiveRedPacket.get_one(urp.active_id):
-            continue
-        if urp.source == 0:
-            # 过滤掉所有直播间抽奖机会
-            continue
-        if urp.chance <= 0:
-            continue
-        if red_packet is None or red_packet.expire_at > urp.expire_at:
-            red_packet = urp
-        red_packet_count += 1
-    red_packet = red_packet.format(red_packet_count) if red_packet else red_packet
-
-    cdrp = None
-    rp_ids = LiveRedPacket.all_ids()
-    for rp in LiveRedPacket.get_list(rp_ids):
-        # 过滤非观看时长红包
-        if rp.mode != 2:
-            continue
-        # 过滤已参与的红包活动id
-        if str(rp._id) in lrp_ids:
-            continue
-
-        if rp.os and rp.os not in ['all', os]:
-            continue
-
-        if (rp.version_code_mix and rp.version_code_mix > version_code) or \
-                (rp.version_code_max and rp.version_code_max < version_code):
-            continue
-
-        if channels and rp.channels and channels not in rp.channels:
-            continue
+        user_tids = {}
 
-        if rp.login == 'login' and (not uid or not rp.user_in_group(str(rp.group), uid)):
-            continue
-
-        if rp.province and not province:
-            continue
-
-        if rp.province and province and province not in rp.province:
-            continue
-
-        # 过滤主播
-        live_authors = [] if not rp.live_authors else rp.live_authors.split('\r\n')
-        if live_authors and live['user_id'] not in live_authors:
-            continue
-
-        # 过滤游戏
-        live_games = [] if not rp.live_games else rp.live_games.split('\r\n')
-        if live_games and live['game_id'] not in live_games:
-            continue
-
-        # 过滤关键字
-        key_words = [] if not rp.keyword else rp.keyword.split(u',')
-        if key_words and not any(map(lambda x: x in live['name'], key_words)):
-            continue
-
-        cdrp = rp.format()
-        break
+    task, red_packet, cdrp = _play_rewards(live, uid, user_tids, os, version_code,
+                                           channels, province)
+    UniqueStats.record(UniqueStats.LIVE % (live['event_id']), uid or params.get('device', None))
 
     return {'ret': True, 'task': task, 'red_packet': red_packet, 'cdrp': cdrp}
 